@@ -0,0 +1,121 @@
+import hashlib
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Union
+
+_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def attack_key(
+        sequence: str,
+        label: int,
+        attacker: str,
+        config: Dict[str, Any],
+        archive_digests: List[str]
+) -> str:
+    # everything that can change the result of an attack
+    content = json.dumps(
+        [sequence, label, attacker, config, archive_digests],
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class AttackCache:
+    """
+    Persistent cache of attack results (`AttackerOutput.__dict__`) stored in an SQLite file.
+    Keys are produced by `attack_key`. When the total size of stored results exceeds `max_size` bytes,
+    the least recently used results are evicted (`last_access` is a counter of reads and writes).
+    """
+
+    def __init__(self, path: Union[str, Path], max_size: int = 1 << 30) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(str(self.path))
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access INTEGER NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+
+    def __enter__(self) -> "AttackCache":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = self._connection.execute("SELECT value FROM results WHERE key = ?", (key, )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        with self._connection:
+            self._connection.execute(
+                "UPDATE results SET last_access = (SELECT MAX(last_access) + 1 FROM results) WHERE key = ?", (key, )
+            )
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        value = json.dumps(value, ensure_ascii=False)
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, last_access) "
+                "VALUES (?, ?, ?, (SELECT COALESCE(MAX(last_access), 0) + 1 FROM results))",
+                (key, value, len(value))
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        to_delete = []
+        for key, size in self._connection.execute("SELECT key, size FROM results ORDER BY last_access"):
+            if total_size <= self.max_size:
+                break
+            to_delete.append((key, ))
+            total_size -= size
+        self._connection.executemany("DELETE FROM results WHERE key = ?", to_delete)
+
+    def get_or_attack(
+            self,
+            keys: List[str],
+            attack: Callable[[List[int]], List[Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns results for all `keys`. `attack` is called only once with indexes of the missing keys
+        and should return their results in the same order.
+        """
+        results = [self.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, attack(missing)):
+                self.put(keys[i], result)
+                results[i] = result
+        return results
+
+    def stats(self) -> Dict[str, int]:
+        num_results, size = self._connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+        ).fetchone()
+        return {"hits": self.hits, "misses": self.misses, "num_results": num_results, "size": size}
@@ -1,7 +1,10 @@
-from .attacker import Attacker, AttackerOutput
+from .attacker import Attacker, AttackerOutput, AttackBudget
 from .cascada import Cascada
 from .distribution_cascada import DistributionCascada
+from .sampling_fool import SamplingFool
 from .hotflip import HotFlipFixed
+from .token_index import TokenEmbeddingIndex
+from .sequence_indexer import SequenceIndexer
 from .fgsm import FGSMAttacker
 from .deepfool import DeepFoolAttacker
 
@@ -1,8 +1,12 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Sequence
 from abc import ABC, abstractmethod
+import math
+import time
 
 from dataclasses import dataclass
 
+import numpy as np
+
 
 @dataclass
 class AttackerOutput:
@@ -18,6 +22,42 @@ class AttackerOutput:
     approx_prob: Optional[float] = None
     approx_wer: Optional[float] = None
     loss_value: Optional[float] = None
+    # True if the attack used all its steps or time, False if it stopped earlier
+    budget_exhausted: Optional[bool] = None
+
+
+@dataclass
+class AttackBudget:
+    """
+    Limits of an attack of one sequence. The attack stops when `max_time` seconds have passed or
+    when the monitored value (e.g. the loss) hasn't improved by more than `min_delta` for `patience` steps.
+    """
+    max_time: Optional[float] = None
+    patience: Optional[int] = None
+    min_delta: float = 0.0
+
+    def start(self) -> "BudgetTracker":
+        return BudgetTracker(self)
+
+
+class BudgetTracker:
+    def __init__(self, budget: AttackBudget) -> None:
+        self.budget = budget
+        self.start_time = time.monotonic()
+        self.best_value = math.inf
+        self.num_bad_steps = 0
+
+    def time_is_up(self) -> bool:
+        return self.budget.max_time is not None and time.monotonic() - self.start_time >= self.budget.max_time
+
+    def update(self, value: float) -> bool:
+        # the smaller the better, returns True if the value has plateaued
+        if value < self.best_value - self.budget.min_delta:
+            self.best_value = value
+            self.num_bad_steps = 0
+        else:
+            self.num_bad_steps += 1
+        return self.budget.patience is not None and self.num_bad_steps >= self.budget.patience
 
 
 class Attacker(ABC):
@@ -25,20 +65,45 @@ class Attacker(ABC):
     def attack(self, sequence_to_attack: str, **kwargs) -> AttackerOutput:
         pass
 
+    def attack_batch(
+            self,
+            sequences_to_attack: List[str],
+            labels_to_attack: List[int],
+            **kwargs
+    ) -> List[AttackerOutput]:
+        return [
+            self.attack(sequence_to_attack, label_to_attack=label_to_attack, **kwargs)
+            for sequence_to_attack, label_to_attack in zip(sequences_to_attack, labels_to_attack)
+        ]
+
+    @staticmethod
+    def find_best_attack_index(
+            attacked_labels: Sequence[int],
+            adversarial_labels: Sequence[int],
+            wers: Sequence[int],
+            prob_diffs: Sequence[float]
+    ) -> int:
+        attacked_labels = np.asarray(attacked_labels)
+        adversarial_labels = np.asarray(adversarial_labels)
+        wers = np.asarray(wers)
+        prob_diffs = np.asarray(prob_diffs, dtype=np.float64)
+
+        changed_label = np.flatnonzero((attacked_labels != adversarial_labels) & (wers > 0))
+        if changed_label.size > 0:
+            # the smallest WER, ties are broken by the largest prob_diff and then by the position
+            order = np.lexsort((changed_label, -prob_diffs[changed_label], wers[changed_label]))
+            return int(changed_label[order[0]])
+        return int(np.argmax(prob_diffs))
+
     @staticmethod
     def find_best_attack(outputs: List[AttackerOutput]) -> AttackerOutput:
         if len(outputs) == 1:
             return outputs[0]
 
-        changed_label_outputs = []
-        for output in outputs:
-            if output.attacked_label != output.adversarial_label and output.wer > 0:
-                changed_label_outputs.append(output)
-
-        if changed_label_outputs:
-            sorted_outputs = sorted(changed_label_outputs, key=lambda x: x.prob_diff, reverse=True)
-            best_output = min(sorted_outputs, key=lambda x: x.wer)
-        else:
-            best_output = max(outputs, key=lambda x: x.prob_diff)
-
-        return best_output
+        best_index = Attacker.find_best_attack_index(
+            attacked_labels=[output.attacked_label for output in outputs],
+            adversarial_labels=[output.adversarial_label for output in outputs],
+            wers=[output.wer for output in outputs],
+            prob_diffs=[output.prob_diff for output in outputs]
+        )
+        return outputs[best_index]
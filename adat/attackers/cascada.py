@@ -1,16 +1,22 @@
+import math
 from pathlib import Path
-from typing import Tuple, Optional, List
+from typing import Tuple, Optional, List, Dict
 from copy import deepcopy
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 
 import torch
 from torch.distributions import Categorical
-from torch.optim import SGD
+from torch.optim import SGD, Optimizer
 from allennlp.models import Model, load_archive
-from allennlp.data import TextFieldTensors, Batch, DatasetReader
-from allennlp.nn.util import move_to_device
+from allennlp.data import TextFieldTensors, DatasetReader
 
-from adat.attackers import Attacker, AttackerOutput
-from adat.utils import calculate_wer
+from adat.attackers import Attacker, AttackerOutput, AttackBudget
+from adat.attackers.attacker import BudgetTracker
+from adat.attackers.sequence_indexer import SequenceIndexer
+from adat.utils import calculate_wer_one_vs_all
+from adat.wer import bounded_wer_one_vs_all
 
 _MAX_NUM_LAYERS = 30
 PARAMETERS = {
@@ -22,6 +28,177 @@ PARAMETERS.update(
 )
 
 
+class ParametersSnapshot:
+    """
+    Keeps a copy of the LM parameters we perturb during an attack. Only the `prefixes` subset is copied
+    (e.g. `_head.linear` and `_seq2seq_encoder._transformer.layers.3`), so restoring is cheap and
+    the rest of the LM is never touched.
+    """
+
+    def __init__(self, model: Model, prefixes: List[str]) -> None:
+        self.parameters = {
+            name: params
+            for name, params in model.named_parameters()
+            if any(name.startswith(prefix) for prefix in prefixes)
+        }
+        self._snapshot = {name: params.detach().clone() for name, params in self.parameters.items()}
+
+    @torch.no_grad()
+    def restore(self) -> None:
+        for name, params in self.parameters.items():
+            params.copy_(self._snapshot[name])
+
+    def copy(self) -> Dict[str, torch.nn.Parameter]:
+        return {name: torch.nn.Parameter(params.clone()) for name, params in self._snapshot.items()}
+
+
+class LowRankAdapters:
+    """
+    Additive low-rank deltas `B A x` for every `torch.nn.Linear` of the LM under `prefixes`.
+    The LM weights stay frozen and shared, each sequence only gets its own small `A` and `B` matrices.
+    `torch.nn.MultiheadAttention` doesn't call its `out_proj` module, so only the feedforward layers
+    of the transformer and the LM head are adapted.
+    """
+
+    def __init__(self, model: Model, prefixes: List[str], rank: int) -> None:
+        self.rank = rank
+        attention_names = [
+            name for name, module in model.named_modules() if isinstance(module, torch.nn.MultiheadAttention)
+        ]
+        self.modules = {
+            name: module
+            for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear)
+            and any(name.startswith(prefix) for prefix in prefixes)
+            and not any(name.startswith(f"{attention_name}.") for attention_name in attention_names)
+        }
+        assert self.modules, f"There are no linear layers to adapt in {prefixes}"
+        self._active_parameters = None
+        for name, module in self.modules.items():
+            module.register_forward_hook(self._get_hook(name))
+
+    def _get_hook(self, name: str):
+        def hook(module, inputs, output):
+            if self._active_parameters is None:
+                return output
+            weight_a = self._active_parameters[f"{name}.adapter_a"]
+            weight_b = self._active_parameters[f"{name}.adapter_b"]
+            return output + torch.nn.functional.linear(torch.nn.functional.linear(inputs[0], weight_a), weight_b)
+        return hook
+
+    def new_parameters(self) -> Dict[str, torch.nn.Parameter]:
+        parameters = dict()
+        for name, module in self.modules.items():
+            weight_a = torch.empty(self.rank, module.in_features, device=module.weight.device)
+            torch.nn.init.kaiming_uniform_(weight_a, a=math.sqrt(5))
+            parameters[f"{name}.adapter_a"] = torch.nn.Parameter(weight_a)
+            # zero `B` means that the LM is not changed before the first update
+            parameters[f"{name}.adapter_b"] = torch.nn.Parameter(
+                torch.zeros(module.out_features, self.rank, device=module.weight.device)
+            )
+        return parameters
+
+    @contextmanager
+    def use_parameters(self, parameters: Dict[str, torch.nn.Parameter]):
+        self._active_parameters = parameters
+        try:
+            yield
+        finally:
+            self._active_parameters = None
+
+
+@dataclass
+class SequenceState:
+    sequence: str
+    label: int
+    inputs: TextFieldTensors
+    initial_prob: float
+    parameters: Dict[str, torch.nn.Parameter]
+    optimizer: Optimizer
+    outputs: List[AttackerOutput] = field(default_factory=list)
+    # LM output for the current parameters, computed with gradients at the end of the previous step
+    lm_output: Optional[Dict[str, torch.Tensor]] = None
+    # Deep Levenshtein encoding of the attacked sequence, it doesn't change during the attack
+    encoded_reference: Optional[torch.Tensor] = None
+    # (1, sequence_length, top_k) vocabulary indexes of the top-k tokens of the initial LM output
+    shortlist: Optional[torch.Tensor] = None
+    tracker: Optional[BudgetTracker] = None
+    budget_exhausted: bool = True
+
+
+def pad_and_concat(tensors: List[torch.Tensor], padding_value: float = 0.0) -> torch.Tensor:
+    # pads the second (sequence length) dimension to the longest tensor and concatenates along the first one
+    max_length = max(tensor.size(1) for tensor in tensors)
+    padded = []
+    for tensor in tensors:
+        pad = [0, 0] * (tensor.dim() - 2) + [0, max_length - tensor.size(1)]
+        padded.append(torch.nn.functional.pad(tensor, pad=pad, value=padding_value))
+    return torch.cat(padded, dim=0)
+
+
+def shortlist_to_vocab(indexes: torch.Tensor, shortlist: torch.Tensor) -> torch.Tensor:
+    # maps positions in the shortlist (..., sequence_length) to vocabulary indexes
+    return shortlist.expand(*indexes.shape, shortlist.size(-1)).gather(-1, indexes.unsqueeze(-1)).squeeze(-1)
+
+
+def gumbel_softmax(
+        logits: torch.Tensor,
+        tau: float = 1.0,
+        generator: Optional[torch.Generator] = None
+) -> torch.Tensor:
+    # the same as `torch.nn.functional.gumbel_softmax(logits, tau=tau, hard=True)`,
+    # but the noise can be drawn from a given generator
+    gumbels = -torch.empty_like(logits).exponential_(generator=generator).log()
+    y_soft = ((logits + gumbels) / tau).softmax(dim=-1)
+    index = y_soft.argmax(dim=-1, keepdim=True)
+    y_hard = torch.zeros_like(y_soft).scatter_(-1, index, 1.0)
+    return y_hard - y_soft.detach() + y_soft
+
+
+class ChunkedGumbelOutputs(torch.autograd.Function):
+    """
+    `Cascada.get_gumbel_outputs` over chunks of `max_gumbel_chunk` samples, so only one chunk
+    of one-hots and activations is kept in memory. The forward pass doesn't build a graph,
+    the backward pass replays every chunk with the same noise and accumulates the gradients w.r.t. the logits.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, mask, labels, encoded_reference, rows, shortlist, attacker, generator):
+        ctx.attacker = attacker
+        ctx.generator = generator
+        ctx.generator_states = []
+        probs, distances = [], []
+        for chunk in rows.split(attacker.max_gumbel_chunk):
+            ctx.generator_states.append(generator.get_state())
+            prob, distance = attacker.get_gumbel_outputs(
+                logits, mask, labels, encoded_reference, chunk, shortlist, generator
+            )
+            probs.append(prob)
+            distances.append(distance)
+        ctx.save_for_backward(logits, mask, labels, encoded_reference, rows, shortlist)
+        return torch.cat(probs), torch.cat(distances)
+
+    @staticmethod
+    def backward(ctx, grad_prob, grad_distance):
+        logits, mask, labels, encoded_reference, rows, shortlist = ctx.saved_tensors
+        chunk_size = ctx.attacker.max_gumbel_chunk
+        grad_logits = torch.zeros_like(logits)
+        with torch.enable_grad():
+            logits = logits.detach().requires_grad_()
+            for chunk, generator_state, chunk_grad_prob, chunk_grad_distance in zip(
+                    rows.split(chunk_size), ctx.generator_states, grad_prob.split(chunk_size),
+                    grad_distance.split(chunk_size)
+            ):
+                ctx.generator.set_state(generator_state)
+                prob, distance = ctx.attacker.get_gumbel_outputs(
+                    logits, mask, labels, encoded_reference, chunk, shortlist, ctx.generator
+                )
+                grad_logits += torch.autograd.grad(
+                    [prob, distance], logits, [chunk_grad_prob, chunk_grad_distance]
+                )[0]
+        return grad_logits, None, None, None, None, None, None, None
+
+
 class Cascada(Attacker):
 
     def __init__(
@@ -37,9 +214,18 @@ class Cascada(Attacker):
             num_samples: int = 5,
             temperature: float = 0.8,
             parameters_to_update: Optional[Tuple[str, ...]] = None,
+            scoring_batch_size: int = 128,
+            max_gumbel_chunk: Optional[int] = None,
+            top_k: Optional[int] = None,
+            adapter_rank: Optional[int] = None,
+            max_wer: Optional[int] = None,
             device: int = -1
     ) -> None:
         assert num_gumbel_samples >= 1
+        assert max_gumbel_chunk is None or max_gumbel_chunk >= 1
+        assert top_k is None or top_k >= 1
+        assert adapter_rank is None or adapter_rank >= 1
+        assert max_wer is None or max_wer >= 0
         masked_lm_dir = Path(masked_lm_dir)
         classifier_dir = Path(classifier_dir)
         deep_levenshtein_dir = Path(deep_levenshtein_dir)
@@ -51,10 +237,7 @@ class Cascada(Attacker):
         self.lm_model = archive.model
         # TODO: should be fixed
         self.lm_model._tokens_masker = None
-
-        # initial LM weights
-        self._lm_state = self.lm_model.state_dict()
-        self.initialize_load_state_dict()
+        self.sequence_indexer = SequenceIndexer.from_reader(self.reader, self.lm_model.vocab)
 
         self.classifier = Model.from_archive(classifier_dir / "model.tar.gz")
         self.deep_levenshtein = Model.from_archive(deep_levenshtein_dir / "model.tar.gz")
@@ -76,161 +259,416 @@ class Cascada(Attacker):
         self.tau = tau
         self.num_samples = num_samples
         self.temperature = temperature
+        self.scoring_batch_size = scoring_batch_size
+        # maximum number of Gumbel samples passed through the classifier and Deep Levenshtein at once
+        self.max_gumbel_chunk = max_gumbel_chunk
+        # each position is restricted to the top-k tokens of the initial LM output
+        self.top_k = top_k
+        # candidates with a larger WER are rejected before they are scored by the classifier
+        self.max_wer = max_wer
         self.parameters_to_update = parameters_to_update or ("all", )
-        self.optimizer = None
-        self.initialize_optimizer()
-
-    def initialize_load_state_dict(self) -> None:
-        self.lm_model.load_state_dict(self._lm_state)
-        self.lm_model.eval()
-
-    def initialize_optimizer(self) -> None:
-        parameters = []
-        for name in self.parameters_to_update:
-            for layer_name, params in self.lm_model.named_parameters():
-                if layer_name.startswith(PARAMETERS[name]):
-                    parameters.append(params)
-        self.optimizer = SGD(parameters, self.lr)
+        prefixes = [PARAMETERS[name] for name in self.parameters_to_update]
+        if adapter_rank is not None:
+            # the LM weights are never updated, each sequence optimizes its own adapters
+            self.adapters = LowRankAdapters(self.lm_model, prefixes, adapter_rank)
+            self.lm_model.requires_grad_(False)
+            self.lm_snapshot = None
+            self.optimizer = None
+        else:
+            self.adapters = None
+            # initial weights of the parameters we are going to update
+            self.lm_snapshot = ParametersSnapshot(self.lm_model, prefixes)
+            self.optimizer = SGD(self.lm_snapshot.parameters.values(), self.lr)
+
+    def reset(self) -> None:
+        if self.lm_snapshot is not None:
+            self.lm_snapshot.restore()
+            self.optimizer.zero_grad()
+            self.optimizer.state.clear()
+
+    def new_parameters(self) -> Dict[str, torch.nn.Parameter]:
+        if self.adapters is not None:
+            return self.adapters.new_parameters()
+        return self.lm_snapshot.copy()
+
+    @contextmanager
+    def use_parameters(self, parameters: Dict[str, torch.nn.Parameter]):
+        if self.adapters is not None:
+            with self.adapters.use_parameters(parameters):
+                yield
+            return
+
+        # temporarily swaps LM parameters with (per-sequence) copies without touching the original tensors,
+        # so autograd graphs built with different copies stay valid
+        replaced = dict()
+        for name, params in parameters.items():
+            module_name, _, param_name = name.rpartition(".")
+            module = self.lm_model
+            for attr in filter(None, module_name.split(".")):
+                module = getattr(module, attr)
+            replaced[name] = (module, param_name, module._parameters[param_name])
+            module._parameters[param_name] = params
+        try:
+            yield
+        finally:
+            for module, param_name, params in replaced.values():
+                module._parameters[param_name] = params
 
     def sequence_to_input(self, sequence: str) -> TextFieldTensors:
-        instances = Batch([
-            self.reader.text_to_instance(sequence)
-        ])
+        return self.sequences_to_input([sequence])
+
+    def sequences_to_input(self, sequences: List[str]) -> TextFieldTensors:
+        return self.sequence_indexer.sequences_to_input(sequences, self.device)
 
-        instances.index_instances(self.lm_model.vocab)
-        inputs = instances.as_tensor_dict()["tokens"]
-        return move_to_device(inputs, self.device)
+    @torch.no_grad()
+    def get_probs(self, sequences: List[str]) -> torch.Tensor:
+        # sequences of the same length are scored together, so there is no padding
+        # and the probabilities are the same as for batches of one
+        indexes_by_length = defaultdict(list)
+        for i, sequence in enumerate(sequences):
+            indexes_by_length[len(sequence.split())].append(i)
+
+        probs = [None] * len(sequences)
+        for indexes in indexes_by_length.values():
+            for start in range(0, len(indexes), self.scoring_batch_size):
+                batch_indexes = indexes[start:start + self.scoring_batch_size]
+                batch_probs = self.classifier(
+                    self.sequences_to_input([sequences[i] for i in batch_indexes])
+                )["probs"]
+                for i, p in zip(batch_indexes, batch_probs):
+                    probs[i] = p
+        # (len(sequences), num_labels)
+        return torch.stack(probs, dim=0)
 
     def calculate_loss(self, prob: torch.Tensor, distance: torch.Tensor) -> torch.Tensor:
         return self.beta * ((torch.tensor(1.0, device=distance.device) - distance) ** 2) - \
                self.alpha * torch.log(torch.tensor(1.0, device=distance.device) - prob)
 
     def indexes_to_string(self, indexes: torch.Tensor) -> str:
-        out = [self.lm_model.vocab.get_token_from_index(idx.item()) for idx in indexes]
-        out = [o for o in out if o not in ["<START>", "<END>"]]
-        return " ".join(out)
+        return self.sequence_indexer.decode(indexes)
 
-    def decode_sequence(self, logits: torch.Tensor) -> List[str]:
+    def decode_sequence(self, logits: torch.Tensor, shortlist: Optional[torch.Tensor] = None) -> List[str]:
         if self.num_samples:
             indexes = Categorical(logits=logits[0] / self.temperature).sample((self.num_samples, ))
-            out = [self.indexes_to_string(ind) for ind in indexes]
         else:
             # only one sample with argmax
-            indexes = logits[0].argmax(dim=-1)
-            out = [self.indexes_to_string(indexes)]
-        return out
+            indexes = logits[0].argmax(dim=-1).unsqueeze(0)
+        if shortlist is not None:
+            indexes = shortlist_to_vocab(indexes, shortlist[0])
+        return self.sequence_indexer.decode_batch(indexes)
 
-    @torch.no_grad()
-    def get_output(
+    def filter_candidates(
             self,
-            sequence_to_attack: str,
-            adversarial_sequence: str,
-            label_to_attack: int,
-            initial_prob: float,
+            sequence: str,
+            adversarial_sequences: List[str]
+    ) -> Tuple[List[str], Optional[List[int]]]:
+        """
+        Drops candidates with WER larger than `self.max_wer` and returns the rest with their WERs.
+        If every candidate is too far, the first one is kept, so that each step has an output.
+        """
+        if self.max_wer is None:
+            return adversarial_sequences, None
+
+        distances = bounded_wer_one_vs_all(sequence, adversarial_sequences, self.max_wer).tolist()
+        kept = [i for i, distance in enumerate(distances) if distance <= self.max_wer]
+        if not kept:
+            return adversarial_sequences[:1], calculate_wer_one_vs_all(sequence, adversarial_sequences[:1])
+        return [adversarial_sequences[i] for i in kept], [distances[i] for i in kept]
+
+    def get_best_output(
+            self,
+            state: SequenceState,
+            adversarial_sequences: List[str],
+            probs: torch.Tensor,
             loss_value: float,
             approx_wer: float,
-            approx_prob: float
+            approx_prob: float,
+            distances: Optional[List[int]] = None
     ) -> AttackerOutput:
-        new_probs = self.classifier(self.sequence_to_input(adversarial_sequence))["probs"][0]
-        new_prob = new_probs[label_to_attack].item()
-        distance = calculate_wer(adversarial_sequence, sequence_to_attack)
-
+        new_probs = probs[:, state.label].tolist()
+        adversarial_labels = probs.argmax(dim=-1).tolist()
+        if distances is None:
+            distances = calculate_wer_one_vs_all(state.sequence, adversarial_sequences)
+        prob_diffs = [state.initial_prob - new_prob for new_prob in new_probs]
+
+        best_index = self.find_best_attack_index(
+            attacked_labels=[state.label] * len(adversarial_sequences),
+            adversarial_labels=adversarial_labels,
+            wers=distances,
+            prob_diffs=prob_diffs
+        )
         output = AttackerOutput(
-            sequence=sequence_to_attack,
-            probability=initial_prob,
-            adversarial_sequence=adversarial_sequence,
-            adversarial_probability=new_prob,
-            wer=distance,
-            prob_diff=(initial_prob - new_prob),
-            attacked_label=label_to_attack,
-            adversarial_label=new_probs.argmax().item(),
+            sequence=state.sequence,
+            probability=state.initial_prob,
+            adversarial_sequence=adversarial_sequences[best_index],
+            adversarial_probability=new_probs[best_index],
+            wer=distances[best_index],
+            prob_diff=prob_diffs[best_index],
+            attacked_label=state.label,
+            adversarial_label=adversarial_labels[best_index],
             approx_wer=approx_wer,
             approx_prob=approx_prob,
             loss_value=loss_value
         )
         return output
 
-    def step(
+    def get_lm_output(self, state: SequenceState) -> Dict[str, torch.Tensor]:
+        with self.use_parameters(state.parameters):
+            output = self.lm_model(state.inputs)
+        if state.shortlist is not None:
+            # (1, sequence_length, top_k)
+            output["logits"] = output["logits"].gather(-1, state.shortlist)
+        return output
+
+    def get_gumbel_outputs(
             self,
-            inputs: TextFieldTensors,
-            sequence_to_attack: str,
-            label_to_attack: int,
-            initial_prob: float,
-            **kwargs
-    ) -> AttackerOutput:
-        # (1, sequence_length, vocab_size)
-        logits = self.lm_model(inputs)["logits"]
-
-        # (self.num_gumbel_samples, sequence_length, vocab_size)
-        onehot_with_gradients = torch.cat(
-            [
-                torch.nn.functional.gumbel_softmax(logits, tau=self.tau, hard=True)
-                for _ in range(self.num_gumbel_samples)
-            ]
-        )
+            logits: torch.Tensor,
+            mask: torch.Tensor,
+            labels: torch.Tensor,
+            encoded_reference: torch.Tensor,
+            rows: torch.Tensor,
+            shortlist: Optional[torch.Tensor] = None,
+            generator: Optional[torch.Generator] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # one Gumbel sample for each element of `rows` (indexes of the attacked sequences)
+        # (len(rows), sequence_length, vocab_size or top_k)
+        onehot_with_gradients = gumbel_softmax(logits[rows], tau=self.tau, generator=generator)
+        # padding positions stay zero vectors
+        onehot_with_gradients = onehot_with_gradients * mask[rows].unsqueeze(-1)
+        if shortlist is not None:
+            shortlist = shortlist[rows]
+
+        # (len(rows), )
+        prob = self.classifier(onehot_with_gradients, shortlist=shortlist, hard_onehot=True)["probs"]
+        prob = prob.gather(1, labels[rows].unsqueeze(1))[:, 0]
+        # (len(rows), )
+        distance = self.deep_levenshtein.forward_on_encoded(
+            onehot_with_gradients, encoded_reference[rows], shortlist=shortlist, hard_onehot=True
+        )["distance"][:, 0]
+        return prob, distance
+
+    def get_surrogate_outputs(
+            self,
+            states: List[SequenceState],
+            lm_outputs: List[Dict[str, torch.Tensor]]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # sequences of the same length are passed through the surrogates together: CNN encoders max-pool
+        # over padded windows too, so padding would make the outputs depend on the other sequences of the batch
+        indexes_by_length = defaultdict(list)
+        for i, output in enumerate(lm_outputs):
+            indexes_by_length[output["logits"].size(1)].append(i)
+
+        probs, distances = [], []
+        for indexes in indexes_by_length.values():
+            group_prob, group_distance = self.get_group_surrogate_outputs(
+                [states[i] for i in indexes], [lm_outputs[i] for i in indexes]
+            )
+            probs.append(group_prob)
+            distances.append(group_distance)
 
-        # (self.num_gumbel_samples, )
-        prob = self.classifier(onehot_with_gradients)["probs"][:, label_to_attack].mean()
-        # (self.num_gumbel_samples, )
-        distance = self.deep_levenshtein(
-            onehot_with_gradients,
-            {"tokens": {"tokens": inputs["tokens"]["tokens"].repeat(self.num_gumbel_samples, 1)}}
-        )["distance"].mean()
-
-        loss = self.calculate_loss(
-            prob,
-            distance
+        order = torch.tensor(
+            [i for indexes in indexes_by_length.values() for i in indexes], device=probs[0].device
         )
-        loss.backward()
-        self.optimizer.step()
-        self.optimizer.zero_grad()
-
-        # (1, sequence_length, vocab_size)
-        logits = self.lm_model(inputs)["logits"]
-        # max(self.num_samples, 1) adversarial attacks
-        adversarial_sequences = self.decode_sequence(logits)
-
-        outputs = []
-        for adversarial_sequence in set(adversarial_sequences):
-            output = self.get_output(
-                sequence_to_attack=sequence_to_attack,
-                adversarial_sequence=adversarial_sequence,
-                label_to_attack=label_to_attack,
-                initial_prob=initial_prob,
-                loss_value=loss.item(),
-                approx_wer=distance.item(),
-                approx_prob=prob.item()
+        inverse_order = torch.empty_like(order)
+        inverse_order[order] = torch.arange(len(order), device=order.device)
+        # (len(states), )
+        return torch.cat(probs)[inverse_order], torch.cat(distances)[inverse_order]
+
+    def get_group_surrogate_outputs(
+            self,
+            states: List[SequenceState],
+            lm_outputs: List[Dict[str, torch.Tensor]]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # all sequences have the same length
+        # (len(states), sequence_length, vocab_size or top_k)
+        logits = torch.cat([output["logits"] for output in lm_outputs])
+        mask = torch.cat([output["mask"].float() for output in lm_outputs])
+        shortlist = torch.cat([state.shortlist for state in states]) if self.top_k else None
+        labels = torch.tensor([state.label for state in states], device=logits.device)
+        encoded_reference = torch.cat([state.encoded_reference for state in states])
+        # samples of a sequence are adjacent: (len(states) * self.num_gumbel_samples, )
+        rows = torch.arange(len(states), device=logits.device).repeat_interleave(self.num_gumbel_samples)
+
+        # a separate generator lets us replay the same noise when the samples are processed in chunks
+        generator = torch.Generator(device=logits.device)
+        generator.manual_seed(int(torch.randint(2 ** 62, size=(1, ))))
+        if self.max_gumbel_chunk is None or len(rows) <= self.max_gumbel_chunk:
+            prob, distance = self.get_gumbel_outputs(
+                logits, mask, labels, encoded_reference, rows, shortlist, generator
+            )
+        else:
+            prob, distance = ChunkedGumbelOutputs.apply(
+                logits, mask, labels, encoded_reference, rows, shortlist, self, generator
             )
-            outputs.append(output)
 
-        return self.find_best_attack(outputs)
+        # (len(states), )
+        prob = prob.view(len(states), self.num_gumbel_samples).mean(dim=1)
+        # (len(states), )
+        distance = distance.view(len(states), self.num_gumbel_samples).mean(dim=1)
+        return prob, distance
+
+    def step(self, states: List[SequenceState]) -> List[AttackerOutput]:
+        lm_outputs = [
+            state.lm_output if state.lm_output is not None else self.get_lm_output(state)
+            for state in states
+        ]
+        prob, distance = self.get_surrogate_outputs(states, lm_outputs)
+
+        # (len(states), ), each sequence is optimized with its own parameters
+        loss = self.calculate_loss(prob, distance)
+        loss.sum().backward()
+        for state in states:
+            state.optimizer.step()
+            state.optimizer.zero_grad()
+
+        adversarial_sequences, distances = [], []
+        for state in states:
+            # the same forward pass is used to decode candidates and to optimize during the next step
+            state.lm_output = self.get_lm_output(state)
+            # (1, sequence_length, vocab_size or top_k)
+            logits = state.lm_output["logits"].detach()
+            # max(self.num_samples, 1) unique adversarial attacks
+            candidates, candidate_distances = self.filter_candidates(
+                state.sequence, list(dict.fromkeys(self.decode_sequence(logits, state.shortlist)))
+            )
+            adversarial_sequences.append(candidates)
+            distances.append(candidate_distances)
+
+        # candidates of all sequences are scored together
+        probs = self.get_probs([sequence for sequences in adversarial_sequences for sequence in sequences])
+        probs = probs.split([len(sequences) for sequences in adversarial_sequences])
+
+        step_outputs = []
+        for i, state in enumerate(states):
+            output = self.get_best_output(
+                state,
+                adversarial_sequences=adversarial_sequences[i],
+                probs=probs[i],
+                loss_value=loss[i].item(),
+                approx_wer=distance[i].item(),
+                approx_prob=prob[i].item(),
+                distances=distances[i]
+            )
+            step_outputs.append(output)
+        return step_outputs
 
-    def attack(
+    def encode_reference(self, state: SequenceState) -> torch.Tensor:
+        return self.deep_levenshtein.encode_sequence(state.inputs)
+
+    def initialize_state(
             self,
             sequence_to_attack: str,
-            label_to_attack: int = 1,
-            max_steps: int = 5,
-            early_stopping: bool = False
-    ) -> AttackerOutput:
-        assert max_steps > 0
+            label_to_attack: int,
+            parameters: Dict[str, torch.nn.Parameter],
+            optimizer: Optimizer
+    ) -> SequenceState:
         inputs = self.sequence_to_input(sequence_to_attack)
         with torch.no_grad():
             prob = self.classifier(inputs)["probs"][0, label_to_attack].item()
 
-        outputs = []
+        state = SequenceState(
+            sequence=sequence_to_attack,
+            label=label_to_attack,
+            inputs=inputs,
+            initial_prob=prob,
+            parameters=parameters,
+            optimizer=optimizer
+        )
+        with torch.no_grad():
+            state.encoded_reference = self.encode_reference(state)
+            if self.top_k:
+                state.shortlist = self.get_lm_output(state)["logits"].topk(self.top_k, dim=-1)[1]
+        return state
+
+    def run_attack(
+            self,
+            states: List[SequenceState],
+            max_steps: int = 5,
+            early_stopping: bool = False,
+            budget: Optional[AttackBudget] = None
+    ) -> List[AttackerOutput]:
+        assert max_steps > 0
+        budget = budget or AttackBudget()
+        for state in states:
+            # sequences of a batch are attacked together, so they share the clock
+            state.tracker = budget.start()
+
+        active_states = list(states)
         for _ in range(max_steps):
-            output = self.step(
-                inputs,
-                sequence_to_attack=sequence_to_attack,
-                label_to_attack=label_to_attack,
-                initial_prob=prob
-            )
-            outputs.append(output)
-            if early_stopping and output.adversarial_label != label_to_attack:
+            step_outputs = self.step(active_states)
+
+            still_active = []
+            for state, output in zip(active_states, step_outputs):
+                state.outputs.append(output)
+                converged = state.tracker.update(output.loss_value)
+                # finished sequences drop out of the batch
+                if (early_stopping and output.adversarial_label != state.label) or converged:
+                    state.budget_exhausted = False
+                    state.lm_output = None
+                elif state.tracker.time_is_up():
+                    state.lm_output = None
+                else:
+                    still_active.append(state)
+            active_states = still_active
+            if not active_states:
                 break
 
-        output = self.find_best_attack(outputs)
-        output.history = [deepcopy(o.__dict__) for o in outputs]
-        self.initialize_load_state_dict()
-        self.initialize_optimizer()
+        for state in active_states:
+            # releases the graph of the last forward pass
+            state.lm_output = None
+
+        final_outputs = []
+        for state in states:
+            output = self.find_best_attack(state.outputs)
+            output.history = [deepcopy(o.__dict__) for o in state.outputs]
+            output.budget_exhausted = state.budget_exhausted
+            final_outputs.append(output)
+        return final_outputs
+
+    def attack(
+            self,
+            sequence_to_attack: str,
+            label_to_attack: int = 1,
+            max_steps: int = 5,
+            early_stopping: bool = False,
+            budget: Optional[AttackBudget] = None
+    ) -> AttackerOutput:
+        if self.adapters is not None:
+            # adapters are created for the attack and dropped afterwards, there is nothing to restore
+            return self.attack_batch(
+                [sequence_to_attack], [label_to_attack], max_steps, early_stopping, budget
+            )[0]
+
+        state = self.initialize_state(
+            sequence_to_attack,
+            label_to_attack,
+            parameters=self.lm_snapshot.parameters,
+            optimizer=self.optimizer
+        )
+        output = self.run_attack([state], max_steps=max_steps, early_stopping=early_stopping, budget=budget)[0]
+        self.reset()
         return output
+
+    def attack_batch(
+            self,
+            sequences_to_attack: List[str],
+            labels_to_attack: List[int],
+            max_steps: int = 5,
+            early_stopping: bool = False,
+            budget: Optional[AttackBudget] = None
+    ) -> List[AttackerOutput]:
+        assert len(sequences_to_attack) == len(labels_to_attack)
+        states = []
+        for sequence_to_attack, label_to_attack in zip(sequences_to_attack, labels_to_attack):
+            # every sequence gets its own copy of the perturbed weights (or its own adapters)
+            # and its own optimizer, the original LM weights are never modified
+            parameters = self.new_parameters()
+            state = self.initialize_state(
+                sequence_to_attack,
+                label_to_attack,
+                parameters=parameters,
+                optimizer=SGD(parameters.values(), self.lr)
+            )
+            states.append(state)
+
+        return self.run_attack(states, max_steps=max_steps, early_stopping=early_stopping, budget=budget)
@@ -1,18 +1,20 @@
 """Deepfool: a simple and accurate method to fool deep neural networks"""
 
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional
+from collections import defaultdict
 from copy import deepcopy
-from functools import lru_cache
 import random
 
 import torch
 from allennlp.models import load_archive
-from allennlp.data import TextFieldTensors, Batch, DatasetReader
-from allennlp.nn.util import move_to_device
+from allennlp.data import TextFieldTensors, DatasetReader
 from allennlp.nn import util
 
-from adat.attackers import Attacker, AttackerOutput
+from adat.attackers import Attacker, AttackerOutput, AttackBudget
+from adat.attackers.sequence_indexer import SequenceIndexer
+from adat.attackers.token_index import TokenEmbeddingIndex
+from adat.models.incremental_scorer import IncrementalScorer
 from adat.utils import calculate_wer
 
 
@@ -24,17 +26,22 @@ class DeepFoolAttacker(Attacker):
             num_steps: int = 10,
             max_steps: int = 10,
             epsilon: float = 1.02,
+            num_positions: int = 1,
+            index_params: Optional[Dict[str, Any]] = None,
             device: int = -1
     ) -> None:
 
         archive = load_archive(Path(classifier_dir) / "model.tar.gz")
         self.reader = DatasetReader.from_params(archive.config["dataset_reader"])
         self.classifier = archive.model
+        self.sequence_indexer = SequenceIndexer.from_reader(self.reader, self.classifier.vocab)
         self.classifier.eval()
 
         self.num_steps = num_steps
         self.max_steps = max_steps
         self.epsilon = epsilon
+        # random positions attacked at every step, the best substitution is kept
+        self.num_positions = num_positions
         self.device = device
 
         if self.device >= 0 and torch.cuda.is_available():
@@ -43,6 +50,10 @@ class DeepFoolAttacker(Attacker):
         self.emb_layer = self._construct_embedding_matrix()
         self.num_labels = self.classifier._num_labels
         self.vocab_size = self.classifier.vocab.get_vocab_size()
+        # special tokens are never returned, see `TokenEmbeddingIndex` for the parameters
+        self.token_index = TokenEmbeddingIndex.from_vocab(self.emb_layer, self.classifier.vocab, **(index_params or {}))
+        # candidates differ from the attacked sequences in a few tokens
+        self.scorer = IncrementalScorer(self.classifier)
 
     def _construct_embedding_matrix(self):
         embedding_layer = util.find_embedding_layer(self.classifier)
@@ -50,19 +61,10 @@ class DeepFoolAttacker(Attacker):
         return embedding_layer.weight
 
     def indexes_to_string(self, indexes: torch.Tensor) -> str:
-        out = [self.classifier.vocab.get_token_from_index(idx.item()) for idx in indexes]
-        out = [o for o in out if o not in ["<START>", "<END>"]]
-        return " ".join(out)
+        return self.sequence_indexer.decode(indexes)
 
-    @lru_cache(maxsize=1000)
     def sequence_to_input(self, sequence: str) -> TextFieldTensors:
-        instances = Batch([
-            self.reader.text_to_instance(sequence)
-        ])
-
-        instances.index_instances(self.classifier.vocab)
-        inputs = instances.as_tensor_dict()["tokens"]
-        return move_to_device(inputs, self.device)
+        return self.sequence_indexer.sequences_to_input([sequence], self.device)
 
     def attack(
             self,
@@ -70,114 +72,199 @@ class DeepFoolAttacker(Attacker):
             label_to_attack: int = 1,
             max_steps: Optional[int] = None,
             num_steps: Optional[int] = None,
-            epsilon: Optional[float] = None
+            epsilon: Optional[float] = None,
+            budget: Optional[AttackBudget] = None
     ) -> AttackerOutput:
-        seq_length = len(sequence_to_attack.split())
-        max_steps = max_steps or self.max_steps
-        num_steps = num_steps or self.num_steps
-        epsilon = epsilon or self.epsilon
-        inputs = self.sequence_to_input(sequence_to_attack)
-
-        # trick to make the variable a leaf variable
-        emb_inp = self.classifier.get_embeddings(inputs)
-        embs = emb_inp['embedded_text'].detach()
-        # probability of the original sequence
-        initial_prob = self.classifier.forward_on_embeddings(
-            embs
-        )["probs"][0, label_to_attack].item()
-        embs = [e for e in embs[0]]
-
-        history = []
-        # we replace random tokens `num_steps` times
-        for i in range(num_steps):
-            random_idx = random.randint(1, max(1, seq_length - 2))
-            # this embedding will be changed
-            cloned_emb = embs[random_idx].clone()
-            embs[random_idx].requires_grad = True
-
-            perturbations = []
-            adv_pred = label_to_attack
-            # let's find final perturbation \hat{r}
-            while adv_pred == label_to_attack and len(perturbations) <= max_steps:
-                weights = dict()
-                delta_probs = dict()
-
-                probs = self.classifier.forward_on_embeddings(
-                    torch.stack(embs, dim=0).unsqueeze(0)
-                )["probs"][0]
-
-                self.classifier.zero_grad()
-                probs[label_to_attack].backward(retain_graph=True)
-                # \nabla f_{\hat{k}}, where \hat{k} is `label_to_attack`
-                f_k_star_grad = embs[random_idx].grad
-
-                for k in range(self.num_labels):
-                    if k != label_to_attack:
-                        self.classifier.zero_grad()
-                        embs[random_idx].grad = None
-                        probs[k].backward(retain_graph=True)
-
-                        # w' = \nabla f_k - \nabla f_{\hat{k}}
-                        weights[k] = embs[random_idx].grad - f_k_star_grad
-                        # f' = f_k - f_{\hat{k}}
-                        delta_probs[k] = probs[label_to_attack] - probs[k].item()
-
-                # |f'| / || w' ||_2^2 for all k
-                coefs = {
-                    k: abs(delta_probs[k]) / torch.norm(weights[k], p=2.0) ** 2
-                    for k in weights.keys()
-                }
-
-                # k with the minimum |f'| / || w' ||_2^2
-                l_star = min(coefs)
-                perturbation = coefs[l_star] * weights[l_star]
-                perturbations.append(perturbation)
-
-                embs[random_idx] = embs[random_idx] + perturbation
-                embs = [e.detach() for e in embs]
-                embs[random_idx].requires_grad = True
-
-                adv_out = self.classifier.forward_on_embeddings(
-                    torch.stack(embs, dim=0).unsqueeze(0)
-                )
-                adv_pred = adv_out["probs"][0].argmax().item()
+        return self.attack_batch([sequence_to_attack], [label_to_attack], max_steps, num_steps, epsilon, budget)[0]
 
-            final_perturbation = torch.stack(perturbations, dim=0).sum(dim=0)
-            embs[random_idx] = cloned_emb + epsilon * final_perturbation
+    def attack_batch(
+            self,
+            sequences_to_attack: List[str],
+            labels_to_attack: List[int],
+            max_steps: Optional[int] = None,
+            num_steps: Optional[int] = None,
+            epsilon: Optional[float] = None,
+            budget: Optional[AttackBudget] = None
+    ) -> List[AttackerOutput]:
+        assert len(sequences_to_attack) == len(labels_to_attack)
+        # sequences of the same length are attacked together, so there is no padding
+        # and the results are the same as for batches of one
+        indexes_by_length = defaultdict(list)
+        token_ids = []
+        for i, sequence in enumerate(sequences_to_attack):
+            token_ids.append(self.sequence_to_input(sequence)["tokens"]["tokens"])
+            indexes_by_length[token_ids[-1].size(1)].append(i)
+
+        outputs = [None] * len(sequences_to_attack)
+        for indexes in indexes_by_length.values():
+            group_outputs = self._attack_group(
+                [sequences_to_attack[i] for i in indexes],
+                [labels_to_attack[i] for i in indexes],
+                torch.cat([token_ids[i] for i in indexes]),
+                max_steps or self.max_steps,
+                num_steps or self.num_steps,
+                epsilon or self.epsilon,
+                budget
+            )
+            for i, output in zip(indexes, group_outputs):
+                outputs[i] = output
+        return outputs
 
-            distances = torch.nn.functional.pairwise_distance(
-                embs[random_idx],
-                self.emb_layer
+    def get_perturbations(
+            self,
+            embs: torch.Tensor,
+            positions: torch.Tensor,
+            labels: torch.Tensor,
+            max_steps: int
+    ) -> torch.Tensor:
+        """
+        DeepFool for the embeddings at `positions` of every sequence of `embs` (batch_size, seq_length, emb_dim).
+        Returns (batch_size, emb_dim) final perturbations (sums of the perturbations of all iterations).
+        Gradients of all classes are computed in one backward pass: every sequence is repeated `num_labels` times
+        and the k-th copy is differentiated w.r.t. f_k.
+        """
+        batch_size, seq_length, emb_dim = embs.size()
+        num_labels = self.num_labels
+        # `l_star` has always been `min(coefs)`, the smallest label different from `label_to_attack`
+        l_star = (labels == 0).long()
+        label_indexes = torch.arange(num_labels, device=embs.device)
+
+        perturbations = torch.zeros(batch_size, emb_dim, device=embs.device)
+        num_perturbations = torch.zeros(batch_size, dtype=torch.long, device=embs.device)
+        is_active = torch.ones(batch_size, dtype=torch.bool, device=embs.device)
+        # let's find final perturbations \hat{r}
+        while is_active.any():
+            indexes = is_active.nonzero(as_tuple=True)[0]
+            rows = torch.arange(len(indexes), device=embs.device)
+            active_positions = positions[indexes]
+
+            # (num_active, num_labels, emb_dim)
+            perturbed_embs = embs[indexes, active_positions] + perturbations[indexes]
+            perturbed_embs = perturbed_embs.unsqueeze(1).repeat(1, num_labels, 1).requires_grad_()
+            repeated_embs = embs[indexes].unsqueeze(1).repeat(1, num_labels, 1, 1)
+            repeated_embs[rows.unsqueeze(1), label_indexes.unsqueeze(0), active_positions.unsqueeze(1)] = (
+                perturbed_embs
             )
-            # @UNK@, @PAD@, @MASK@, @START@, @END@
-            to_drop_indexes = [0, 1] + list(range(self.vocab_size - 3, self.vocab_size))
-            distances[to_drop_indexes] = 10e6
-            closest_idx = distances.argmin().item()
-
-            embs[random_idx] = self.emb_layer[closest_idx]
-            embs = [e.detach() for e in embs]
-
-            adversarial_idexes = inputs["tokens"]["tokens"].clone()
-            adversarial_idexes[0, random_idx] = closest_idx
-
-            adverarial_seq = self.indexes_to_string(adversarial_idexes[0])
-            new_clf_output = self.classifier.forward(self.sequence_to_input(adverarial_seq))
-            new_probs = new_clf_output["probs"]
-            adv_prob = new_probs[0, label_to_attack].item()
-
-            output = AttackerOutput(
-                sequence=sequence_to_attack,
-                probability=initial_prob,
-                adversarial_sequence=adverarial_seq,
-                adversarial_probability=adv_prob,
-                wer=calculate_wer(sequence_to_attack, adverarial_seq),
-                prob_diff=(initial_prob - adv_prob),
-                attacked_label=label_to_attack,
-                adversarial_label=new_probs.argmax().item()
+            # (num_active, num_labels, num_labels)
+            repeated_probs = self.classifier.forward_on_embeddings(
+                repeated_embs.view(-1, seq_length, emb_dim)
+            )["probs"].view(-1, num_labels, num_labels)
+            probs = repeated_probs[:, 0].detach()
+
+            # the prediction has changed or we've run out of steps
+            is_done = (num_perturbations[indexes] > 0) & (
+                (probs.argmax(dim=-1) != labels[indexes]) | (num_perturbations[indexes] > max_steps)
             )
+            is_active[indexes[is_done]] = False
+            if is_done.all():
+                break
+
+            # \nabla f_k for all k
+            grads, = torch.autograd.grad(repeated_probs.diagonal(dim1=1, dim2=2).sum(), perturbed_embs)
+            indexes, rows, grads, probs = indexes[~is_done], rows[:(~is_done).sum()], grads[~is_done], probs[~is_done]
+            k_star, l_star_active = labels[indexes], l_star[indexes]
+
+            # w' = \nabla f_l - \nabla f_{\hat{k}}, where \hat{k} is `label_to_attack`
+            weights = grads[rows, l_star_active] - grads[rows, k_star]
+            # f' = f_{\hat{k}} - f_l
+            delta_probs = probs[rows, k_star] - probs[rows, l_star_active]
+            # |f'| / || w' ||_2^2
+            coefs = delta_probs.abs() / torch.norm(weights, p=2.0, dim=-1) ** 2
+
+            perturbations[indexes] += coefs.unsqueeze(-1) * weights
+            num_perturbations[indexes] += 1
+
+        return perturbations
+
+    def _sample_positions(self, seq_length: int) -> List[int]:
+        max_position = max(1, seq_length - 2)
+        if self.num_positions == 1:
+            return [random.randint(1, max_position)]
+        return random.sample(range(1, max_position + 1), min(self.num_positions, max_position))
+
+    def _attack_group(
+            self,
+            sequences_to_attack: List[str],
+            labels_to_attack: List[int],
+            token_ids: torch.Tensor,
+            max_steps: int,
+            num_steps: int,
+            epsilon: float,
+            budget: Optional[AttackBudget] = None
+    ) -> List[AttackerOutput]:
+        labels = torch.tensor(labels_to_attack, device=token_ids.device)
+        # all candidates are compared to the original sequences
+        scoring_state = self.scorer.prepare(token_ids)
+
+        emb_inp = self.classifier.get_embeddings({"tokens": {"tokens": token_ids}})
+        embs = emb_inp['embedded_text'].detach()
+        with torch.no_grad():
+            # probabilities of the original sequences
+            initial_probs = self.classifier.forward_on_embeddings(embs)["probs"]
+        initial_probs = initial_probs[torch.arange(len(labels), device=embs.device), labels].tolist()
+
+        trackers = [(budget or AttackBudget()).start() for _ in sequences_to_attack]
+        budget_exhausted = [True] * len(sequences_to_attack)
+        histories = [[] for _ in sequences_to_attack]
+        active_indexes = list(range(len(sequences_to_attack)))
+        # we replace random tokens `num_steps` times
+        for _ in range(num_steps):
+            if not active_indexes:
+                break
+
+            sequence_indexes = []
+            positions = []
+            for i in active_indexes:
+                for position in self._sample_positions(len(sequences_to_attack[i].split())):
+                    sequence_indexes.append(i)
+                    positions.append(position)
+            sequence_indexes = torch.tensor(sequence_indexes, device=embs.device)
+            positions = torch.tensor(positions, device=embs.device)
+
+            final_perturbations = self.get_perturbations(
+                embs[sequence_indexes], positions, labels[sequence_indexes], max_steps
+            )
+            closest_indexes = self.token_index.query(
+                embs[sequence_indexes, positions] + epsilon * final_perturbations
+            )[1][:, 0]
+
+            # every candidate differs from the original sequence in one token
+            adversarial_indexes = token_ids[sequence_indexes]
+            adversarial_indexes[torch.arange(len(positions), device=embs.device), positions] = closest_indexes
+            new_probs = self.scorer.score(scoring_state, adversarial_indexes, sequence_indexes)
+
+            still_active = []
+            for i in active_indexes:
+                candidates = (sequence_indexes == i).nonzero(as_tuple=True)[0]
+                best = candidates[new_probs[candidates, labels_to_attack[i]].argmin()]
+                embs[i, positions[best]] = self.emb_layer[closest_indexes[best]].detach()
+
+                adverarial_seq = self.indexes_to_string(adversarial_indexes[best][adversarial_indexes[best] != 0])
+                adv_prob = new_probs[best, labels_to_attack[i]].item()
+                output = AttackerOutput(
+                    sequence=sequences_to_attack[i],
+                    probability=initial_probs[i],
+                    adversarial_sequence=adverarial_seq,
+                    adversarial_probability=adv_prob,
+                    wer=calculate_wer(sequences_to_attack[i], adverarial_seq),
+                    prob_diff=(initial_probs[i] - adv_prob),
+                    attacked_label=labels_to_attack[i],
+                    adversarial_label=new_probs[best].argmax().item()
+                )
 
-            history.append(output)
-
-        output = self.find_best_attack(history)
-        output.history = [deepcopy(o.__dict__) for o in history]
-        return output
+                histories[i].append(output)
+                if trackers[i].update(-output.prob_diff):
+                    budget_exhausted[i] = False
+                    continue
+                if trackers[i].time_is_up():
+                    continue
+                still_active.append(i)
+            active_indexes = still_active
+
+        outputs = []
+        for i, history in enumerate(histories):
+            output = self.find_best_attack(history)
+            output.history = [deepcopy(o.__dict__) for o in history]
+            output.budget_exhausted = budget_exhausted[i]
+            outputs.append(output)
+        return outputs
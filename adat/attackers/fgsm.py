@@ -2,32 +2,47 @@
 Generating Natural Language Adversarial Examples on a Large Scale with Generative Models"""
 
 from pathlib import Path
-from typing import Optional
+from typing import Any, Dict, List, Optional
+from collections import defaultdict
 from copy import deepcopy
-from functools import lru_cache
 import random
 
 import torch
 from allennlp.models import load_archive
-from allennlp.data import TextFieldTensors, Batch, DatasetReader
-from allennlp.nn.util import move_to_device
+from allennlp.data import TextFieldTensors, DatasetReader
 from allennlp.nn import util
 
-from adat.attackers import Attacker, AttackerOutput
+from adat.attackers import Attacker, AttackerOutput, AttackBudget
+from adat.attackers.sequence_indexer import SequenceIndexer
+from adat.attackers.token_index import TokenEmbeddingIndex
+from adat.models.incremental_scorer import IncrementalScorer
 from adat.utils import calculate_wer
 
 
 class FGSMAttacker(Attacker):
 
-    def __init__(self, classifier_dir: str, num_steps: int = 10, epsilon: float = 0.01, device: int = -1):
+    def __init__(
+            self,
+            classifier_dir: str,
+            num_steps: int = 10,
+            epsilon: float = 0.01,
+            vectorized: bool = False,
+            scoring_batch_size: int = 128,
+            index_params: Optional[Dict[str, Any]] = None,
+            device: int = -1
+    ) -> None:
 
         archive = load_archive(Path(classifier_dir) / "model.tar.gz")
         self.reader = DatasetReader.from_params(archive.config["dataset_reader"])
         self.classifier = archive.model
+        self.sequence_indexer = SequenceIndexer.from_reader(self.reader, self.classifier.vocab)
         self.classifier.eval()
 
         self.num_steps = num_steps
         self.epsilon = epsilon
+        # perturb all positions at every step and keep the best single substitution
+        self.vectorized = vectorized
+        self.scoring_batch_size = scoring_batch_size
         self.device = device
 
         if self.device >= 0 and torch.cuda.is_available():
@@ -35,6 +50,10 @@ class FGSMAttacker(Attacker):
 
         self.emb_layer = self._construct_embedding_matrix()
         self.vocab_size = self.classifier.vocab.get_vocab_size()
+        # special tokens are never returned, see `TokenEmbeddingIndex` for the parameters
+        self.token_index = TokenEmbeddingIndex.from_vocab(self.emb_layer, self.classifier.vocab, **(index_params or {}))
+        # candidates differ from the attacked sequences in a few tokens
+        self.scorer = IncrementalScorer(self.classifier, self.scoring_batch_size)
 
     def _construct_embedding_matrix(self):
         embedding_layer = util.find_embedding_layer(self.classifier)
@@ -42,27 +61,22 @@ class FGSMAttacker(Attacker):
         return embedding_layer.weight
 
     def indexes_to_string(self, indexes: torch.Tensor) -> str:
-        out = [self.classifier.vocab.get_token_from_index(idx.item()) for idx in indexes]
-        out = [o for o in out if o not in ["<START>", "<END>"]]
-        return " ".join(out)
+        return self.sequence_indexer.decode(indexes)
 
-    @lru_cache(maxsize=1000)
     def sequence_to_input(self, sequence: str) -> TextFieldTensors:
-        instances = Batch([
-            self.reader.text_to_instance(sequence)
-        ])
-
-        instances.index_instances(self.classifier.vocab)
-        inputs = instances.as_tensor_dict()["tokens"]
-        return move_to_device(inputs, self.device)
+        return self.sequence_indexer.sequences_to_input([sequence], self.device)
 
     def attack(
             self,
             sequence_to_attack: str,
             label_to_attack: int = 1,
             num_steps: Optional[int] = None,
-            epsilon: Optional[float] = None
+            epsilon: Optional[float] = None,
+            budget: Optional[AttackBudget] = None
     ) -> AttackerOutput:
+        if self.vectorized:
+            return self.attack_batch([sequence_to_attack], [label_to_attack], num_steps, epsilon, budget)[0]
+
         seq_length = len(sequence_to_attack.split())
         num_steps = num_steps or self.num_steps
         epsilon = epsilon or self.epsilon
@@ -78,16 +92,16 @@ class FGSMAttacker(Attacker):
             emb_inp["mask"],
             label=label
         )["probs"][0, label_to_attack].item()
-        embs = [e for e in embs[0]]
 
+        tracker = (budget or AttackBudget()).start()
+        budget_exhausted = True
         history = []
         for i in range(num_steps):
             random_idx = random.randint(1, max(1, seq_length - 2))
-            embs[random_idx].requires_grad = True
-            embeddings_tensor = torch.stack(embs, dim=0).unsqueeze(0)
+            embs.requires_grad = True
 
             clf_output = self.classifier.forward_on_embeddings(
-                embeddings_tensor,
+                embs,
                 emb_inp["mask"],
                 label=label
             )
@@ -96,19 +110,12 @@ class FGSMAttacker(Attacker):
             self.classifier.zero_grad()
             loss.backward()
 
-            embs[random_idx] = embs[random_idx] + epsilon * embs[random_idx].grad.data.sign()
-
-            distances = torch.nn.functional.pairwise_distance(
-                embs[random_idx],
-                self.emb_layer
-            )
-            # @UNK@, @PAD@, @MASK@, @START@, @END@
-            to_drop_indexes = [0, 1] + list(range(self.vocab_size - 3, self.vocab_size))
-            distances[to_drop_indexes] = 10e6
-
-            closest_idx = distances.argmin().item()
-            embs[random_idx] = self.emb_layer[closest_idx]
-            embs = [e.detach() for e in embs]
+            with torch.no_grad():
+                closest_idx = self.token_index.query(
+                    (embs[0, random_idx] + epsilon * embs.grad[0, random_idx].sign()).unsqueeze(0)
+                )[1][0, 0].item()
+                embs = embs.detach()
+                embs[0, random_idx] = self.emb_layer[closest_idx]
 
             adversarial_idexes = inputs["tokens"]["tokens"].clone()
             adversarial_idexes[0, random_idx] = closest_idx
@@ -130,7 +137,174 @@ class FGSMAttacker(Attacker):
             )
 
             history.append(output)
+            if tracker.update(-output.prob_diff):
+                budget_exhausted = False
+                break
+            if tracker.time_is_up():
+                break
 
         output = self.find_best_attack(history)
         output.history = [deepcopy(o.__dict__) for o in history]
+        output.budget_exhausted = budget_exhausted
         return output
+
+    def attack_batch(
+            self,
+            sequences_to_attack: List[str],
+            labels_to_attack: List[int],
+            num_steps: Optional[int] = None,
+            epsilon: Optional[float] = None,
+            budget: Optional[AttackBudget] = None
+    ) -> List[AttackerOutput]:
+        assert len(sequences_to_attack) == len(labels_to_attack)
+        if not self.vectorized:
+            return super().attack_batch(
+                sequences_to_attack, labels_to_attack, num_steps=num_steps, epsilon=epsilon, budget=budget
+            )
+
+        # sequences of the same length are attacked together, so there is no padding
+        # and the results are the same as for batches of one
+        indexes_by_length = defaultdict(list)
+        token_ids = []
+        for i, sequence in enumerate(sequences_to_attack):
+            token_ids.append(self.sequence_to_input(sequence)["tokens"]["tokens"])
+            indexes_by_length[token_ids[-1].size(1)].append(i)
+
+        outputs = [None] * len(sequences_to_attack)
+        for indexes in indexes_by_length.values():
+            group_outputs = self._attack_vectorized(
+                [sequences_to_attack[i] for i in indexes],
+                [labels_to_attack[i] for i in indexes],
+                torch.cat([token_ids[i] for i in indexes]),
+                num_steps or self.num_steps,
+                epsilon or self.epsilon,
+                budget
+            )
+            for i, output in zip(indexes, group_outputs):
+                outputs[i] = output
+        return outputs
+
+    @torch.no_grad()
+    def get_probs(self, token_ids: torch.Tensor) -> torch.Tensor:
+        return torch.cat([
+            self.classifier.forward({"tokens": {"tokens": token_ids[i:i + self.scoring_batch_size]}})["probs"]
+            for i in range(0, token_ids.size(0), self.scoring_batch_size)
+        ])
+
+    def _attack_vectorized(
+            self,
+            sequences_to_attack: List[str],
+            labels_to_attack: List[int],
+            token_ids: torch.Tensor,
+            num_steps: int,
+            epsilon: float,
+            budget: Optional[AttackBudget] = None
+    ) -> List[AttackerOutput]:
+        """
+        At every step all tokens (except <START>, <END> and padding) are moved by `epsilon` in the direction
+        of the gradient sign and projected onto the vocabulary. All single substitutions are scored in one batch
+        and the best one is kept, so the substitutions accumulate over the steps.
+        """
+        labels = torch.tensor(labels_to_attack, device=token_ids.device)
+        mask = token_ids != 0
+        lengths = mask.sum(dim=1, keepdim=True)
+        positions = torch.arange(token_ids.size(1), device=token_ids.device).unsqueeze(0)
+        can_be_replaced = (positions > 0) & (positions < lengths - 1)
+
+        initial_probs = self.get_probs(token_ids)
+        initial_probs = initial_probs[torch.arange(len(labels)), labels].tolist()
+
+        trackers = [(budget or AttackBudget()).start() for _ in sequences_to_attack]
+        budget_exhausted = [True] * len(sequences_to_attack)
+        histories = [[] for _ in sequences_to_attack]
+        active_indexes = list(range(len(sequences_to_attack)))
+        for _ in range(num_steps):
+            if not active_indexes:
+                break
+
+            ids = token_ids[active_indexes]
+            embs = torch.nn.functional.embedding(ids, self.emb_layer.detach()).requires_grad_()
+            loss = self.classifier.forward_on_embeddings(
+                embs,
+                mask[active_indexes],
+                label=labels[active_indexes]
+            )["loss"]
+            grad, = torch.autograd.grad(loss, embs)
+
+            # all positions are projected in one query
+            replaceable = can_be_replaced[active_indexes]
+            new_ids = ids.clone()
+            new_ids[replaceable] = self.token_index.query((embs.detach() + epsilon * grad.sign())[replaceable])[1][:, 0]
+
+            rows, columns = (new_ids != ids).nonzero(as_tuple=True)
+            if len(rows) == 0:
+                # the projection doesn't change anything anymore
+                for i in active_indexes:
+                    budget_exhausted[i] = False
+                break
+
+            candidates = ids[rows]
+            candidates[torch.arange(len(rows)), columns] = new_ids[rows, columns]
+            probs = self.scorer.score(self.scorer.prepare(ids), candidates, rows)
+            adv_probs = probs[torch.arange(len(rows)), labels[active_indexes][rows]]
+
+            still_active = []
+            for row, i in enumerate(active_indexes):
+                candidate_indexes = (rows == row).nonzero(as_tuple=True)[0]
+                if len(candidate_indexes) == 0:
+                    # the projection doesn't change anything anymore
+                    budget_exhausted[i] = False
+                    continue
+
+                best = candidate_indexes[adv_probs[candidate_indexes].argmin()]
+                token_ids[i] = candidates[best]
+                output = self._get_output(
+                    sequences_to_attack[i], labels_to_attack[i], initial_probs[i], token_ids[i], probs[best]
+                )
+                histories[i].append(output)
+                if trackers[i].update(-output.prob_diff):
+                    budget_exhausted[i] = False
+                    continue
+                if trackers[i].time_is_up():
+                    continue
+                still_active.append(i)
+            active_indexes = still_active
+
+        outputs = []
+        for i, history in enumerate(histories):
+            if history:
+                output = self.find_best_attack(history)
+            else:
+                # nothing to replace
+                output = self._get_output(
+                    sequences_to_attack[i],
+                    labels_to_attack[i],
+                    initial_probs[i],
+                    token_ids[i],
+                    self.get_probs(token_ids[i:i + 1])[0]
+                )
+            output.history = [deepcopy(o.__dict__) for o in history]
+            output.budget_exhausted = budget_exhausted[i]
+            outputs.append(output)
+        return outputs
+
+    def _get_output(
+            self,
+            sequence_to_attack: str,
+            label_to_attack: int,
+            initial_prob: float,
+            adversarial_indexes: torch.Tensor,
+            adversarial_probs: torch.Tensor
+    ) -> AttackerOutput:
+        adverarial_seq = self.indexes_to_string(adversarial_indexes[adversarial_indexes != 0])
+        adv_prob = adversarial_probs[label_to_attack].item()
+        return AttackerOutput(
+            sequence=sequence_to_attack,
+            probability=initial_prob,
+            adversarial_sequence=adverarial_seq,
+            adversarial_probability=adv_prob,
+            wer=calculate_wer(sequence_to_attack, adverarial_seq),
+            prob_diff=(initial_prob - adv_prob),
+            attacked_label=label_to_attack,
+            adversarial_label=adversarial_probs.argmax().item()
+        )
@@ -1,18 +1,22 @@
+from collections import defaultdict
 from copy import deepcopy
-from typing import List
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numpy
 import torch
 
 from allennlp.common.util import JsonDict, sanitize
+from allennlp.data import Instance
 from allennlp.data.fields import TextField
 from allennlp.data.tokenizers import Token
-from allennlp.data.vocabulary import DEFAULT_OOV_TOKEN, DEFAULT_PADDING_TOKEN
+from allennlp.data.vocabulary import DEFAULT_OOV_TOKEN, DEFAULT_PADDING_TOKEN, Vocabulary
 from allennlp.interpret.attackers import utils
 from allennlp.nn import util
 from allennlp.predictors.predictor import Predictor
 from allennlp.interpret.attackers import Hotflip
 
+from adat.models.incremental_scorer import IncrementalScorer
 from adat.tokens_masker import MASK_TOKEN
 
 DEFAULT_IGNORE_TOKENS = ["@@NULL@@", ".", ",", ";", "!", "?", "[MASK]",
@@ -20,16 +24,113 @@ DEFAULT_IGNORE_TOKENS = ["@@NULL@@", ".", ",", ";", "!", "?", "[MASK]",
 TO_DROP_TOKENS = [DEFAULT_OOV_TOKEN, DEFAULT_PADDING_TOKEN, MASK_TOKEN, "<START>", "<END>"]
 
 
+@dataclass
+class FlipState:
+    instance: Instance
+    original_tokens: List[Token]
+    fields_to_compare: JsonDict
+    target: Optional[JsonDict]
+    # indexes of token ids we don't flip anymore
+    flipped: List[int]
+    # (seq_length, embedding_dim) gradients of the current instance, can be padded
+    grad: numpy.ndarray
+    outputs: JsonDict
+
+    @property
+    def sign(self) -> int:
+        return -1 if self.target is None else 1
+
+
+class ReplacementIndex:
+    """
+    Embeddings of the tokens that can replace others (without `TO_DROP_TOKENS` and tokens after `max_tokens`).
+    Built once and scores replacements of many positions with one matmul (first order taylor approximation).
+    """
+
+    def __init__(self, embedding_matrix: torch.Tensor, replacement_ids: torch.Tensor) -> None:
+        self.embedding_matrix = embedding_matrix.detach()
+        self.replacement_ids = replacement_ids.to(self.embedding_matrix.device)
+        # (num_replacements, embedding_dim)
+        self.replacement_embeddings = self.embedding_matrix[self.replacement_ids]
+
+    @classmethod
+    def from_vocab(
+        cls,
+        embedding_matrix: torch.Tensor,
+        vocab: Vocabulary,
+        namespace: str = "tokens",
+        max_tokens: Optional[int] = None,
+        tokens_to_drop: List[str] = None,
+    ) -> "ReplacementIndex":
+        tokens_to_drop = TO_DROP_TOKENS if tokens_to_drop is None else tokens_to_drop
+        num_tokens = embedding_matrix.size(0)
+        if max_tokens is not None:
+            num_tokens = min(num_tokens, max_tokens)
+
+        is_valid = torch.ones(num_tokens, dtype=torch.bool)
+        token_to_index = vocab.get_token_to_index_vocabulary(namespace)
+        for token in tokens_to_drop:
+            index = token_to_index.get(token)
+            if index is not None and index < num_tokens:
+                is_valid[index] = False
+        return cls(embedding_matrix, torch.arange(num_tokens)[is_valid])
+
+    def scores(self, grad: torch.Tensor, original_ids: torch.Tensor, sign: torch.Tensor) -> torch.Tensor:
+        """
+        grad: (num_positions, embedding_dim), original_ids: (num_positions, ), sign: (num_positions, )
+        Returns (num_positions, num_replacements) approximate changes of the loss
+        """
+        with torch.no_grad():
+            prev_embed_dot_grad = (grad * self.embedding_matrix[original_ids]).sum(dim=-1, keepdim=True)
+            new_embed_dot_grad = grad @ self.replacement_embeddings.t()
+            return sign.unsqueeze(-1) * (prev_embed_dot_grad - new_embed_dot_grad)
+
+    def top_candidates(
+        self,
+        grad: torch.Tensor,
+        original_ids: torch.Tensor,
+        sign: torch.Tensor,
+        num_candidates: int = 1
+    ) -> torch.Tensor:
+        """
+        Returns (num_positions, num_candidates) vocab ids of the best replacements
+        """
+        scores = self.scores(grad, original_ids, sign)
+        indices = scores.topk(min(num_candidates, scores.size(1)), dim=-1).indices
+        return self.replacement_ids[indices]
+
+
 class HotFlipFixed(Hotflip):
     def __init__(self,
                  predictor: Predictor,
                  vocab_namespace: str = "tokens",
-                 max_tokens: int = 20000) -> None:
+                 max_tokens: int = 20000,
+                 num_positions: int = 1,
+                 num_candidates: int = 1) -> None:
         super().__init__(predictor, vocab_namespace, max_tokens)
-        self.invalid_replacement_indices: List[int] = []
-        for i in self.vocab._index_to_token[self.namespace]:
-            if self.vocab._index_to_token[self.namespace][i] in TO_DROP_TOKENS:
-                self.invalid_replacement_indices.append(i)
+        assert num_positions >= 1 and num_candidates >= 1
+        # at every step we try `num_candidates` replacements for each of `num_positions` positions
+        # with the largest gradients and keep the best flip
+        self.num_positions = num_positions
+        self.num_candidates = num_candidates
+        # shared by all attacked sequences
+        self.replacement_index: Optional[ReplacementIndex] = None
+        self.scorer: Optional[IncrementalScorer] = None
+
+    def initialize(self) -> None:
+        super().initialize()
+        if self.replacement_index is None:
+            # `Hotflip` already limits the embedding matrix to `max_tokens` for character-level embedders,
+            # a plain `Embedding` is used as is, so every token stays a candidate
+            self.replacement_index = ReplacementIndex.from_vocab(self.embedding_matrix, self.vocab, self.namespace)
+        if self.scorer is None and self.num_positions * self.num_candidates > 1:
+            self.scorer = IncrementalScorer(self.predictor._model)
+
+    def _first_order_taylor(self, grad: numpy.ndarray, token_idx: torch.Tensor, sign: int) -> int:
+        grad = util.move_to_device(torch.from_numpy(grad), self.cuda_device)
+        original_ids = util.move_to_device(token_idx.view(1), self.cuda_device)
+        sign = util.move_to_device(torch.tensor([sign], dtype=grad.dtype), self.cuda_device)
+        return int(self.replacement_index.top_candidates(grad.unsqueeze(0), original_ids, sign)[0, 0])
 
     def attack_from_json(
         self,
@@ -64,66 +165,319 @@ class HotFlipFixed(Hotflip):
             text_field: TextField = instance[input_field_to_attack]  # type: ignore
             grads, outputs = self.predictor.get_gradients([instance])
 
-            # start, end and pad tokens
-            min_length = 5  # [token_min_padding_length]
-            seq_length = len(text_field.tokens)
-            flipped: List[int] = [0, -1]
-            if seq_length < min_length:
-                flipped += list(range(seq_length - min_length, -1))
-            for index, token in enumerate(text_field.tokens):
-                if token.text in ignore_tokens:
-                    flipped.append(index + 1)
-
-            while True:
-                grad = grads[grad_input_field][0]
-                grads_magnitude = [g.dot(g) for g in grad]
-
-                for index in flipped:
-                    grads_magnitude[index] = -1
-
-                index_of_token_to_flip = numpy.argmax(grads_magnitude)
-                if grads_magnitude[index_of_token_to_flip] == -1:
-                    # If we've already flipped all of the tokens, we give up.
-                    break
-                flipped.append(index_of_token_to_flip)
-
-                text_field_tensors = text_field.as_tensor(text_field.get_padding_lengths())
-                input_tokens = util.get_token_ids_from_text_field_tensors(text_field_tensors)
-                original_id_of_token_to_flip = input_tokens[index_of_token_to_flip]
-
-                # Get new token using taylor approximation.
-                new_id = self._first_order_taylor(
-                    grad[index_of_token_to_flip], original_id_of_token_to_flip, sign
+            flipped = self._get_initially_flipped(text_field, ignore_tokens)
+
+            if self.num_positions > 1 or self.num_candidates > 1:
+                state = FlipState(
+                    instance=instance,
+                    original_tokens=original_tokens,
+                    fields_to_compare=fields_to_compare,
+                    target=target,
+                    flipped=flipped,
+                    grad=grads[grad_input_field][0],
+                    outputs=outputs
                 )
+                for _ in self._run_flips([state], input_field_to_attack, grad_input_field):
+                    pass
+                text_field, outputs = state.instance[input_field_to_attack], state.outputs
+            else:
+                while True:
+                    grad = grads[grad_input_field][0]
+                    grads_magnitude = [g.dot(g) for g in grad]
 
-                new_token = Token(
-                    self.vocab._index_to_token[self.namespace][new_id]
-                )  # type: ignore
-                text_field.tokens[index_of_token_to_flip - 1] = new_token
-                instance.indexed = False
+                    for index in flipped:
+                        grads_magnitude[index] = -1
 
-                grads, outputs = self.predictor.get_gradients([instance])  # predictions
-                for key, output in outputs.items():
-                    if isinstance(output, torch.Tensor):
-                        outputs[key] = output.detach().cpu().numpy().squeeze()
-                    elif isinstance(output, list):
-                        outputs[key] = output[0]
+                    index_of_token_to_flip = numpy.argmax(grads_magnitude)
+                    if grads_magnitude[index_of_token_to_flip] == -1:
+                        # If we've already flipped all of the tokens, we give up.
+                        break
+                    flipped.append(index_of_token_to_flip)
 
-                labeled_instance = self.predictor.predictions_to_labeled_instances(
-                    instance, outputs
-                )[0]
+                    text_field_tensors = text_field.as_tensor(text_field.get_padding_lengths())
+                    input_tokens = util.get_token_ids_from_text_field_tensors(text_field_tensors)
+                    original_id_of_token_to_flip = input_tokens[index_of_token_to_flip]
+
+                    # Get new token using taylor approximation.
+                    new_id = self._first_order_taylor(
+                        grad[index_of_token_to_flip], original_id_of_token_to_flip, sign
+                    )
+
+                    new_token = Token(
+                        self.vocab._index_to_token[self.namespace][new_id]
+                    )  # type: ignore
+                    text_field.tokens[index_of_token_to_flip - 1] = new_token
+                    instance.indexed = False
 
-                has_changed = utils.instance_has_changed(labeled_instance, fields_to_compare)
-                if target is None and has_changed:
-                    break
-                if target is not None and not has_changed:
-                    break
+                    grads, outputs = self.predictor.get_gradients([instance])  # predictions
+                    for key, output in outputs.items():
+                        if isinstance(output, torch.Tensor):
+                            outputs[key] = output.detach().cpu().numpy().squeeze()
+                        elif isinstance(output, list):
+                            outputs[key] = output[0]
 
-            tokens_to_add = []
-            for token in text_field.tokens:
-                if token.text not in ["<START>", "<END>", DEFAULT_PADDING_TOKEN]:
-                    tokens_to_add.append(token)
+                    labeled_instance = self.predictor.predictions_to_labeled_instances(
+                        instance, outputs
+                    )[0]
 
-            final_tokens.append(tokens_to_add)
+                    has_changed = utils.instance_has_changed(labeled_instance, fields_to_compare)
+                    if target is None and has_changed:
+                        break
+                    if target is not None and not has_changed:
+                        break
+
+            final_tokens.append(self._get_final_tokens(text_field))
 
         return sanitize({"final": final_tokens, "original": original_tokens, "outputs": outputs})
+
+    def attack_batch_from_json(
+        self,
+        inputs: List[JsonDict],
+        input_field_to_attack: str = "tokens",
+        grad_input_field: str = "grad_input_1",
+        ignore_tokens: List[str] = None,
+        targets: Optional[List[JsonDict]] = None,
+    ) -> Iterator[Tuple[int, JsonDict]]:
+        """
+        Attacks all `inputs` together: flips of all unfinished sequences of the same length are evaluated in one batch.
+        Yields `(index, result)` as soon as a sequence is finished, `result` is the same as in `attack_from_json`.
+        """
+        if self.embedding_matrix is None:
+            self.initialize()
+        ignore_tokens = DEFAULT_IGNORE_TOKENS if ignore_tokens is None else ignore_tokens
+        targets = targets or [None] * len(inputs)
+        assert len(inputs) == len(targets)
+
+        instances = []
+        for json_input, target in zip(inputs, targets):
+            instance = self.predictor._json_to_instance(json_input)
+            if target is None:
+                output_dict = self.predictor._model.forward_on_instance(instance)
+            else:
+                output_dict = target
+            labeled_instances = self.predictor.predictions_to_labeled_instances(instance, output_dict)
+            assert len(labeled_instances) == 1, "Only one labeled instance per input is supported"
+            instances.append(labeled_instances[0])
+
+        grads, outputs = self._get_gradients_by_length(instances, input_field_to_attack)
+        states = []
+        for i, (json_input, instance, target) in enumerate(zip(inputs, instances, targets)):
+            text_field: TextField = instance[input_field_to_attack]  # type: ignore
+            states.append(
+                FlipState(
+                    instance=instance,
+                    original_tokens=deepcopy(text_field.tokens),
+                    fields_to_compare=utils.get_fields_to_compare(json_input, instance, input_field_to_attack),
+                    target=target,
+                    flipped=self._get_initially_flipped(text_field, ignore_tokens),
+                    grad=grads[i][grad_input_field],
+                    outputs=outputs[i]
+                )
+            )
+
+        for i in self._run_flips(states, input_field_to_attack, grad_input_field):
+            final_tokens = self._get_final_tokens(states[i].instance[input_field_to_attack])
+            yield i, sanitize(
+                {"final": [final_tokens], "original": states[i].original_tokens, "outputs": states[i].outputs}
+            )
+
+    @staticmethod
+    def _get_initially_flipped(text_field: TextField, ignore_tokens: List[str]) -> List[int]:
+        # start, end and pad tokens
+        min_length = 5  # [token_min_padding_length]
+        seq_length = len(text_field.tokens)
+        flipped: List[int] = [0, -1]
+        if seq_length < min_length:
+            flipped += list(range(seq_length - min_length, -1))
+        for index, token in enumerate(text_field.tokens):
+            if token.text in ignore_tokens:
+                flipped.append(index + 1)
+        return flipped
+
+    @staticmethod
+    def _get_final_tokens(text_field: TextField) -> List[Token]:
+        tokens_to_add = []
+        for token in text_field.tokens:
+            if token.text not in ["<START>", "<END>", DEFAULT_PADDING_TOKEN]:
+                tokens_to_add.append(token)
+        return tokens_to_add
+
+    @staticmethod
+    def _get_instance_outputs(outputs: JsonDict, index: int) -> JsonDict:
+        instance_outputs = dict()
+        for key, output in outputs.items():
+            if isinstance(output, torch.Tensor):
+                instance_outputs[key] = output[index].detach().cpu().numpy()
+            elif isinstance(output, list):
+                instance_outputs[key] = output[index]
+        return instance_outputs
+
+    def _get_gradients_by_length(
+        self,
+        instances: List[Instance],
+        input_field_to_attack: str
+    ) -> Tuple[List[Dict[str, numpy.ndarray]], List[JsonDict]]:
+        """
+        `predictor.get_gradients` for groups of instances of the same length. The CNN encoder max-pools
+        over padded windows too, so padding would make the outputs depend on the other instances of the batch.
+        Returns gradients and outputs of every instance.
+        """
+        indexes_by_length = defaultdict(list)
+        for i, instance in enumerate(instances):
+            indexes_by_length[len(instance[input_field_to_attack].tokens)].append(i)
+
+        grads = [None] * len(instances)
+        outputs = [None] * len(instances)
+        for indexes in indexes_by_length.values():
+            group_grads, group_outputs = self.predictor.get_gradients([instances[i] for i in indexes])
+            for j, i in enumerate(indexes):
+                grads[i] = {key: grad[j] for key, grad in group_grads.items()}
+                outputs[i] = self._get_instance_outputs(group_outputs, j)
+        return grads, outputs
+
+    def _get_flip_positions(
+        self,
+        state: FlipState,
+        input_field_to_attack: str
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """
+        Returns positions with the largest gradients, their token ids, gradients and all token ids
+        (None if all tokens are already flipped)
+        """
+        text_field: TextField = state.instance[input_field_to_attack]  # type: ignore
+        text_field_tensors = text_field.as_tensor(text_field.get_padding_lengths())
+        input_tokens = util.get_token_ids_from_text_field_tensors(text_field_tensors)
+
+        # gradients are computed for batches of the same length, but can be padded to the minimal padding length
+        # (seq_length, embedding_dim)
+        grad = util.move_to_device(torch.from_numpy(state.grad[:len(input_tokens)]), self.cuda_device)
+        grads_magnitude = (grad * grad).sum(dim=-1)
+        grads_magnitude[state.flipped] = -1
+
+        num_positions = min(self.num_positions, int((grads_magnitude > -1).sum()))
+        if num_positions == 0:
+            # If we've already flipped all of the tokens, we give up.
+            return None
+        positions = grads_magnitude.topk(num_positions).indices
+        original_ids = util.move_to_device(input_tokens[positions.cpu()], self.cuda_device)
+        return positions, original_ids, grad[positions], input_tokens
+
+    def _get_flipped_instances(
+        self,
+        state: FlipState,
+        input_field_to_attack: str,
+        positions: List[int],
+        candidates: List[List[int]]
+    ) -> Tuple[List[Instance], List[int]]:
+        flipped_instances = []
+        flipped_positions = []
+        for index_of_token_to_flip, new_ids in zip(positions, candidates):
+            for new_id in new_ids:
+                flipped_instance = deepcopy(state.instance)
+                flipped_instance[input_field_to_attack].tokens[index_of_token_to_flip - 1] = Token(
+                    self.vocab._index_to_token[self.namespace][new_id]
+                )
+                flipped_instance.indexed = False
+                flipped_instances.append(flipped_instance)
+                flipped_positions.append(index_of_token_to_flip)
+        return flipped_instances, flipped_positions
+
+    def _run_flips(
+        self,
+        states: List[FlipState],
+        input_field_to_attack: str,
+        grad_input_field: str,
+    ) -> Iterator[int]:
+        """
+        Greedily flips tokens of all `states` until their labels change (or reach the targets).
+        Candidate flips of all unfinished states are evaluated together (in batches of the same length),
+        the gradients are reused at the next step.
+        Yields indexes of finished states.
+        """
+        active_indexes = list(range(len(states)))
+        while active_indexes:
+            flip_positions = dict()
+            for i in active_indexes:
+                positions = self._get_flip_positions(states[i], input_field_to_attack)
+                if positions is None:
+                    yield i
+                else:
+                    flip_positions[i] = positions
+
+            if not flip_positions:
+                break
+
+            # first order taylor approximation for all positions of all states at once
+            grad = torch.cat([positions_grad for _, _, positions_grad, _ in flip_positions.values()])
+            original_ids = torch.cat([ids for _, ids, _, _ in flip_positions.values()])
+            sign = torch.tensor(
+                [states[i].sign for i, (positions, *_) in flip_positions.items() for _ in range(len(positions))],
+                dtype=grad.dtype,
+                device=grad.device
+            )
+            candidates = self.replacement_index.top_candidates(grad, original_ids, sign, self.num_candidates).tolist()
+
+            batch = []
+            batch_positions = []
+            batch_slices = dict()
+            best_flips = dict()
+            num_seen = 0
+            for i, (positions, _, _, input_tokens) in flip_positions.items():
+                state_candidates = candidates[num_seen:num_seen + len(positions)]
+                flipped_instances, flipped_positions = self._get_flipped_instances(
+                    states[i],
+                    input_field_to_attack,
+                    positions.tolist(),
+                    state_candidates
+                )
+                num_seen += len(positions)
+                batch_slices[i] = slice(len(batch), len(batch) + len(flipped_instances))
+                batch.extend(flipped_instances)
+                batch_positions.extend(flipped_positions)
+
+                if self.scorer is not None:
+                    # flips differ from the current instance in one token, so they are scored incrementally
+                    # and the gradients are computed only for the kept flips
+                    input_tokens = util.move_to_device(input_tokens, self.cuda_device)
+                    flipped_ids = input_tokens.repeat(len(flipped_positions), 1)
+                    flipped_ids[torch.arange(len(flipped_positions)), flipped_positions] = flipped_ids.new_tensor(
+                        [new_id for new_ids in state_candidates for new_id in new_ids]
+                    )
+                    probs = self.scorer.score(self.scorer.prepare(input_tokens.unsqueeze(0)), flipped_ids)
+                    label = states[i].instance["label"].label
+                    # the closest to the target (or the farthest from the prediction) flip is kept
+                    best_flips[i] = batch_slices[i].start + int((states[i].sign * probs[:, label]).argmax())
+
+            if self.scorer is None:
+                grads, outputs = self._get_gradients_by_length(batch, input_field_to_attack)
+                for i, batch_slice in batch_slices.items():
+                    label = states[i].instance["label"].label
+                    # the closest to the target (or the farthest from the prediction) flip is kept
+                    scores = states[i].sign * numpy.array([output["probs"][label] for output in outputs[batch_slice]])
+                    best_flips[i] = batch_slice.start + int(scores.argmax())
+                output_indexes = best_flips
+            else:
+                grads, outputs = self._get_gradients_by_length(
+                    [batch[best] for best in best_flips.values()], input_field_to_attack
+                )
+                output_indexes = {i: j for j, i in enumerate(best_flips)}
+
+            still_active = []
+            for i, best in best_flips.items():
+                state = states[i]
+                state.instance = batch[best]
+                state.flipped.append(batch_positions[best])
+                state.grad = grads[output_indexes[i]][grad_input_field]
+                state.outputs = outputs[output_indexes[i]]
+
+                labeled_instance = self.predictor.predictions_to_labeled_instances(
+                    state.instance, state.outputs
+                )[0]
+                has_changed = utils.instance_has_changed(labeled_instance, state.fields_to_compare)
+                if state.target is None and has_changed:
+                    yield i
+                elif state.target is not None and not has_changed:
+                    yield i
+                else:
+                    still_active.append(i)
+            active_indexes = still_active
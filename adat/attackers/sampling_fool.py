@@ -0,0 +1,112 @@
+from copy import deepcopy
+from typing import List, Optional
+
+import torch
+from torch.distributions import Categorical
+
+from adat.attackers.attacker import AttackerOutput, AttackBudget
+from .cascada import Cascada, SequenceState, pad_and_concat, shortlist_to_vocab
+
+
+class SamplingFool(Cascada):
+    """
+    Cascada with `lr=0.0`: the LM is never updated, so there is nothing to optimize.
+    We run the LM once without gradients and only sample adversarial sequences from it.
+    """
+
+    def attack(
+            self,
+            sequence_to_attack: str,
+            label_to_attack: int = 1,
+            max_steps: int = 1,
+            early_stopping: bool = False,
+            budget: Optional[AttackBudget] = None
+    ) -> AttackerOutput:
+        return self.attack_batch([sequence_to_attack], [label_to_attack], max_steps, early_stopping, budget)[0]
+
+    @torch.no_grad()
+    def attack_batch(
+            self,
+            sequences_to_attack: List[str],
+            labels_to_attack: List[int],
+            max_steps: int = 1,
+            early_stopping: bool = False,
+            budget: Optional[AttackBudget] = None
+    ) -> List[AttackerOutput]:
+        assert max_steps > 0
+        assert len(sequences_to_attack) == len(labels_to_attack)
+        budget = budget or AttackBudget()
+        initial_probs = self.get_probs(sequences_to_attack)
+        states = []
+        for i, (sequence_to_attack, label_to_attack) in enumerate(zip(sequences_to_attack, labels_to_attack)):
+            state = SequenceState(
+                sequence=sequence_to_attack,
+                label=label_to_attack,
+                inputs=self.sequence_to_input(sequence_to_attack),
+                initial_prob=initial_probs[i, label_to_attack].item(),
+                parameters=dict(),
+                optimizer=None,
+                tracker=budget.start()
+            )
+            states.append(state)
+
+        inputs = {"tokens": {"tokens": pad_and_concat([state.inputs["tokens"]["tokens"] for state in states])}}
+        # (len(states), max_sequence_length, vocab_size)
+        logits = self.lm_model(inputs)["logits"]
+        shortlist = None
+        if self.top_k:
+            # (len(states), max_sequence_length, self.top_k)
+            logits, shortlist = logits.topk(self.top_k, dim=-1)
+        lengths = [state.inputs["tokens"]["tokens"].size(1) for state in states]
+
+        active_indexes = list(range(len(states)))
+        for _ in range(max_steps):
+            if self.num_samples:
+                # (self.num_samples, len(active_indexes), max_sequence_length)
+                indexes = Categorical(logits=logits[active_indexes] / self.temperature).sample((self.num_samples,))
+            else:
+                # only one sample with argmax
+                indexes = logits[active_indexes].argmax(dim=-1).unsqueeze(0)
+            if shortlist is not None:
+                indexes = shortlist_to_vocab(indexes, shortlist[active_indexes])
+
+            adversarial_sequences, distances = [], []
+            for j, i in enumerate(active_indexes):
+                candidates, candidate_distances = self.filter_candidates(
+                    states[i].sequence,
+                    list(dict.fromkeys(self.sequence_indexer.decode_batch(indexes[:, j, :lengths[i]])))
+                )
+                adversarial_sequences.append(candidates)
+                distances.append(candidate_distances)
+            probs = self.get_probs([sequence for sequences in adversarial_sequences for sequence in sequences])
+            probs = probs.split([len(sequences) for sequences in adversarial_sequences])
+
+            still_active = []
+            for j, i in enumerate(active_indexes):
+                output = self.get_best_output(
+                    states[i],
+                    adversarial_sequences=adversarial_sequences[j],
+                    probs=probs[j],
+                    loss_value=None,
+                    approx_wer=None,
+                    approx_prob=None,
+                    distances=distances[j]
+                )
+                states[i].outputs.append(output)
+                # there is no loss, so we wait for the best prob_diff to plateau
+                converged = states[i].tracker.update(-output.prob_diff)
+                if (early_stopping and output.adversarial_label != states[i].label) or converged:
+                    states[i].budget_exhausted = False
+                elif not states[i].tracker.time_is_up():
+                    still_active.append(i)
+            active_indexes = still_active
+            if not active_indexes:
+                break
+
+        final_outputs = []
+        for state in states:
+            output = self.find_best_attack(state.outputs)
+            output.history = [deepcopy(o.__dict__) for o in state.outputs]
+            output.budget_exhausted = state.budget_exhausted
+            final_outputs.append(output)
+        return final_outputs
@@ -0,0 +1,143 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+from allennlp.data import DatasetReader, TextFieldTensors, Vocabulary
+from allennlp.data.vocabulary import DEFAULT_OOV_TOKEN
+from allennlp.nn.util import move_to_device
+
+START_TOKEN = "<START>"
+END_TOKEN = "<END>"
+
+
+class SequenceIndexer:
+    """
+    Strings to token ids and back without `Batch.index_instances`, the same ids as the dataset reader
+    with a single id token indexer produces.
+
+    Encoded sequences are stored on CPU in an LRU cache of at most `max_size` bytes,
+    so the cache neither holds device memory nor references the attacker.
+    Decoding is a lookup in an array of tokens, start and end tokens are dropped.
+    """
+
+    def __init__(
+            self,
+            vocab: Vocabulary,
+            namespace: str = "tokens",
+            start_tokens: Sequence[str] = (START_TOKEN, ),
+            end_tokens: Sequence[str] = (END_TOKEN, ),
+            lowercase_tokens: bool = False,
+            min_padding_length: int = 0,
+            max_sequence_length: Optional[int] = None,
+            max_size: int = 1 << 26
+    ) -> None:
+        self.lowercase_tokens = lowercase_tokens
+        self.min_padding_length = min_padding_length
+        self.max_sequence_length = max_sequence_length
+        self.max_size = max_size
+
+        self.token_to_index = dict(vocab.get_token_to_index_vocabulary(namespace))
+        self.oov_index = self.token_to_index.get(DEFAULT_OOV_TOKEN)
+        self.start_ids = [self._token_index(token) for token in start_tokens]
+        self.end_ids = [self._token_index(token) for token in end_tokens]
+
+        index_to_token = vocab.get_index_to_token_vocabulary(namespace)
+        self.tokens = np.array([index_to_token[i] for i in range(len(index_to_token))], dtype=object)
+        self.is_dropped = np.zeros(len(self.tokens), dtype=bool)
+        for token in {START_TOKEN, END_TOKEN, *start_tokens, *end_tokens}:
+            if token in self.token_to_index:
+                self.is_dropped[self.token_to_index[token]] = True
+
+        self._cache: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._cache_size = 0
+
+    @classmethod
+    def from_reader(
+            cls,
+            reader: DatasetReader,
+            vocab: Vocabulary,
+            max_size: int = 1 << 26
+    ) -> "SequenceIndexer":
+        # sequences are split on spaces, see `tokenizer` in the configs
+        indexer = reader._token_indexers["tokens"]
+        return cls(
+            vocab,
+            namespace=indexer.namespace,
+            start_tokens=[token.text for token in indexer._start_tokens],
+            end_tokens=[token.text for token in indexer._end_tokens],
+            lowercase_tokens=indexer.lowercase_tokens,
+            min_padding_length=indexer._token_min_padding_length,
+            max_sequence_length=getattr(reader, "_max_sequence_length", None),
+            max_size=max_size
+        )
+
+    def _token_index(self, token: str) -> int:
+        if self.lowercase_tokens:
+            token = token.lower()
+        index = self.token_to_index.get(token, self.oov_index)
+        if index is None:
+            raise KeyError(f"{token} is not in the vocabulary and there is no OOV token")
+        return index
+
+    def encode(self, sequence: str) -> torch.Tensor:
+        """
+        Returns (sequence_length, ) token ids on CPU
+        """
+        token_ids = self._cache.get(sequence)
+        if token_ids is not None:
+            self._cache.move_to_end(sequence)
+            return token_ids
+
+        tokens = sequence.split()
+        if self.max_sequence_length is not None:
+            tokens = tokens[:self.max_sequence_length]
+        token_ids = torch.tensor(
+            self.start_ids + [self._token_index(token) for token in tokens] + self.end_ids,
+            dtype=torch.long
+        )
+
+        self._cache[sequence] = token_ids
+        self._cache_size += self._entry_size(sequence, token_ids)
+        while self._cache_size > self.max_size and self._cache:
+            evicted_sequence, evicted_ids = self._cache.popitem(last=False)
+            self._cache_size -= self._entry_size(evicted_sequence, evicted_ids)
+        return token_ids
+
+    @staticmethod
+    def _entry_size(sequence: str, token_ids: torch.Tensor) -> int:
+        return len(sequence) + token_ids.numel() * token_ids.element_size()
+
+    def sequences_to_input(self, sequences: List[str], device: int = -1) -> TextFieldTensors:
+        """
+        The same as `Batch(instances).as_tensor_dict()["tokens"]`: (len(sequences), max_length) ids
+        padded with zeros to at least `min_padding_length`
+        """
+        encoded = [self.encode(sequence) for sequence in sequences]
+        max_length = max([self.min_padding_length] + [token_ids.size(0) for token_ids in encoded])
+        token_ids = torch.zeros(len(encoded), max_length, dtype=torch.long)
+        for i, ids in enumerate(encoded):
+            token_ids[i, :ids.size(0)] = ids
+        return move_to_device({"tokens": {"tokens": token_ids}}, device)
+
+    def decode(self, indexes: torch.Tensor) -> str:
+        """
+        indexes: (sequence_length, ) token ids
+        """
+        indexes = indexes.detach().cpu().numpy()
+        return " ".join(self.tokens[indexes[~self.is_dropped[indexes]]])
+
+    def decode_batch(self, indexes: torch.Tensor, lengths: Optional[List[int]] = None) -> List[str]:
+        """
+        indexes: (num_sequences, sequence_length) token ids, only the first `lengths[i]` ids of the i-th sequence
+        are decoded (all of them by default)
+        """
+        indexes = indexes.detach().cpu().numpy()
+        tokens = self.tokens[indexes]
+        is_kept = ~self.is_dropped[indexes]
+        if lengths is not None:
+            is_kept &= np.arange(indexes.shape[1]) < np.asarray(lengths)[:, None]
+        return [" ".join(row_tokens[row_is_kept]) for row_tokens, row_is_kept in zip(tokens, is_kept)]
+
+    def cache_info(self) -> Dict[str, int]:
+        return {"num_sequences": len(self._cache), "size": self._cache_size}
@@ -0,0 +1,140 @@
+import math
+from typing import Optional, Sequence, Tuple, List
+
+import torch
+from allennlp.data.vocabulary import Vocabulary, DEFAULT_OOV_TOKEN, DEFAULT_PADDING_TOKEN
+
+from adat.tokens_masker import MASK_TOKEN
+
+SPECIAL_TOKENS = [DEFAULT_OOV_TOKEN, DEFAULT_PADDING_TOKEN, MASK_TOKEN, "<START>", "<END>"]
+
+
+class TokenEmbeddingIndex:
+    """
+    Nearest neighbours of vectors among token embeddings (euclidean distance).
+    Excluded tokens (e.g. special tokens) are not stored in the index, so they are never returned.
+
+    Backends:
+        "exact": distances to all tokens, one matmul per `batch_size` queries
+        "ivf": tokens are clustered with k-means into `num_clusters` clusters (sqrt(num_tokens) by default),
+            a query is compared only with tokens of its `num_probes` closest clusters
+    """
+
+    def __init__(
+            self,
+            embedding_matrix: torch.Tensor,
+            excluded_ids: Sequence[int] = (),
+            backend: str = "exact",
+            num_clusters: Optional[int] = None,
+            num_probes: int = 8,
+            num_iterations: int = 10,
+            batch_size: int = 256,
+            seed: int = 0
+    ) -> None:
+        assert backend in ("exact", "ivf"), f"Unknown backend: {backend}"
+        self.backend = backend
+        self.batch_size = batch_size
+
+        embedding_matrix = embedding_matrix.detach()
+        is_included = torch.ones(embedding_matrix.size(0), dtype=torch.bool)
+        is_included[list(excluded_ids)] = False
+        # vocab ids of the stored embeddings
+        self.token_ids = torch.arange(embedding_matrix.size(0))[is_included].to(embedding_matrix.device)
+        self.embeddings = embedding_matrix[self.token_ids]
+        self.norms = (self.embeddings ** 2).sum(dim=-1)
+
+        if self.backend == "ivf":
+            num_clusters = num_clusters or int(math.sqrt(self.embeddings.size(0)))
+            self.num_probes = min(num_probes, num_clusters)
+            self.centroids = self._kmeans(num_clusters, num_iterations, seed)
+            assignments = self._closest(self.embeddings, self.centroids, k=1)[1][:, 0]
+            # positions of the stored embeddings sorted by cluster, members of the cluster `c` are
+            # `self.members[self.offsets[c]:self.offsets[c + 1]]`
+            self.members = assignments.argsort()
+            counts = torch.bincount(assignments, minlength=num_clusters)
+            self.offsets = torch.cat([counts.new_zeros(1), counts.cumsum(dim=0)]).tolist()
+
+    @classmethod
+    def from_vocab(
+            cls,
+            embedding_matrix: torch.Tensor,
+            vocab: Vocabulary,
+            namespace: str = "tokens",
+            excluded_tokens: Optional[List[str]] = None,
+            **kwargs
+    ) -> "TokenEmbeddingIndex":
+        excluded_tokens = SPECIAL_TOKENS if excluded_tokens is None else excluded_tokens
+        token_to_index = vocab.get_token_to_index_vocabulary(namespace)
+        excluded_ids = [token_to_index[token] for token in excluded_tokens if token in token_to_index]
+        return cls(embedding_matrix, excluded_ids, **kwargs)
+
+    @torch.no_grad()
+    def query(self, vectors: torch.Tensor, k: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        vectors: (num_vectors, emb_dim)
+        Returns (num_vectors, k) distances and vocab ids of the closest tokens. If the probed clusters
+        have less than `k` tokens, the rest of the ids are -1 with infinite distances.
+        """
+        distances, indexes = [], []
+        for i in range(0, vectors.size(0), self.batch_size):
+            batch = vectors[i:i + self.batch_size]
+            if self.backend == "exact":
+                batch_distances, batch_indexes = self._closest(batch, self.embeddings, k, self.norms)
+            else:
+                batch_distances, batch_indexes = self._query_ivf(batch, k)
+            distances.append(batch_distances)
+            indexes.append(batch_indexes)
+
+        distances = torch.cat(distances)
+        indexes = torch.cat(indexes)
+        token_ids = torch.where(indexes >= 0, self.token_ids[indexes.clamp(min=0)], indexes)
+        return distances, token_ids
+
+    @staticmethod
+    def _closest(
+            vectors: torch.Tensor,
+            points: torch.Tensor,
+            k: int,
+            points_norms: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if points_norms is None:
+            points_norms = (points ** 2).sum(dim=-1)
+        squared_distances = (vectors ** 2).sum(dim=-1, keepdim=True) + points_norms - 2 * vectors @ points.t()
+        top = squared_distances.topk(min(k, points.size(0)), dim=-1, largest=False)
+        return top.values.clamp(min=0).sqrt(), top.indices
+
+    def _query_ivf(self, vectors: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        # (num_vectors, num_probes)
+        probes = self._closest(vectors, self.centroids, self.num_probes)[1]
+        # the best `k` tokens of every probed cluster
+        candidate_distances = vectors.new_full((vectors.size(0), self.num_probes, k), float("inf"))
+        candidate_indexes = probes.new_full((vectors.size(0), self.num_probes, k), -1)
+        for cluster in probes.unique().tolist():
+            members = self.members[self.offsets[cluster]:self.offsets[cluster + 1]]
+            if len(members) == 0:
+                continue
+            rows, probe_ranks = (probes == cluster).nonzero(as_tuple=True)
+            distances, indexes = self._closest(vectors[rows], self.embeddings[members], k, self.norms[members])
+            candidate_distances[rows, probe_ranks, :distances.size(1)] = distances
+            candidate_indexes[rows, probe_ranks, :distances.size(1)] = members[indexes]
+
+        top = candidate_distances.view(vectors.size(0), -1).topk(k, dim=-1, largest=False)
+        return top.values, candidate_indexes.view(vectors.size(0), -1).gather(1, top.indices)
+
+    def _kmeans(self, num_clusters: int, num_iterations: int, seed: int) -> torch.Tensor:
+        generator = torch.Generator().manual_seed(seed)
+        initial = torch.randperm(self.embeddings.size(0), generator=generator)[:num_clusters]
+        centroids = self.embeddings[initial.to(self.embeddings.device)].clone()
+        for _ in range(num_iterations):
+            assignments = torch.cat([
+                self._closest(self.embeddings[i:i + self.batch_size], centroids, k=1)[1][:, 0]
+                for i in range(0, self.embeddings.size(0), self.batch_size)
+            ])
+            sums = torch.zeros_like(centroids).index_add_(0, assignments, self.embeddings)
+            counts = torch.bincount(assignments, minlength=num_clusters)
+            # empty clusters keep their centroids
+            is_empty = counts == 0
+            centroids = torch.where(
+                is_empty.unsqueeze(-1), centroids, sums / counts.clamp(min=1).unsqueeze(-1).to(sums.dtype)
+            )
+        return centroids
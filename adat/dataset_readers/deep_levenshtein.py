@@ -1,5 +1,4 @@
 from typing import Optional, Dict
-import json
 
 import numpy as np
 from allennlp.common.file_utils import cached_path
@@ -8,6 +7,8 @@ from allennlp.data.fields import TextField, ArrayField
 from allennlp.data.tokenizers import Tokenizer
 from allennlp.data.token_indexers import TokenIndexer
 
+from adat.jsonl import read_jsonlines
+
 
 @DatasetReader.register(name="deep_levenshtein")
 class DeepLevenshteinReader(DatasetReader):
@@ -22,16 +23,12 @@ class DeepLevenshteinReader(DatasetReader):
         self._tokenizer = tokenizer
 
     def _read(self, file_path):
-        with open(cached_path(file_path), "r") as data_file:
-            for line in data_file.readlines():
-                if not line:
-                    continue
-                items = json.loads(line)
-                seq_a = items["seq_a"]
-                seq_b = items["seq_b"]
-                dist = items.get("dist")
-                instance = self.text_to_instance(sequence_a=seq_a, sequence_b=seq_b, distance=dist)
-                yield instance
+        for items in read_jsonlines(cached_path(file_path)):
+            seq_a = items["seq_a"]
+            seq_b = items["seq_b"]
+            dist = items.get("dist")
+            instance = self.text_to_instance(sequence_a=seq_a, sequence_b=seq_b, distance=dist)
+            yield instance
 
     def text_to_instance(
         self,
@@ -1,5 +1,4 @@
 from typing import Dict
-import json
 
 from allennlp_models.lm import SimpleLanguageModelingDatasetReader
 from allennlp.common.file_utils import cached_path
@@ -9,6 +8,8 @@ from allennlp.data.instance import Instance
 from allennlp.data.token_indexers.token_indexer import TokenIndexer
 from allennlp.data.tokenizers.tokenizer import Tokenizer
 
+from adat.jsonl import read_jsonlines
+
 
 @DatasetReader.register("simple_language_modeling_fixed")
 class SimpleLanguageModelingDatasetReaderFixed(SimpleLanguageModelingDatasetReader):
@@ -44,12 +45,8 @@ class SimpleLanguageModelingDatasetReaderFixed(SimpleLanguageModelingDatasetRead
         return return_instance
 
     def _read(self, file_path):
-        with open(cached_path(file_path), "r") as data_file:
-            for line in data_file.readlines():
-                if not line:
-                    continue
-                items = json.loads(line)
-                sent = items.get("text")
-                seq = items.get("sequence")
-                instance = self.text_to_instance(sequence=seq, sentence=sent)
-                yield instance
+        for items in read_jsonlines(cached_path(file_path)):
+            sent = items.get("text")
+            seq = items.get("sequence")
+            instance = self.text_to_instance(sequence=seq, sentence=sent)
+            yield instance
@@ -0,0 +1,130 @@
+import itertools
+import json
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional, Union
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def get_loads(backend: str = "auto") -> Callable[[bytes], Any]:
+    # "auto" uses orjson if it is installed
+    if backend == "auto":
+        backend = "json" if orjson is None else "orjson"
+    if backend == "orjson":
+        if orjson is None:
+            raise ImportError("orjson is not installed, use backend='json'")
+        return orjson.loads
+    if backend == "json":
+        return json.loads
+    raise ValueError(f"Unknown backend: {backend}")
+
+
+class JsonlReader:
+    """
+    Lazy reader of a JSON lines file, empty lines are skipped.
+
+    `iter(offset, limit, shard, num_shards)` yields the same records as
+    `load_jsonlines(path)[offset:offset + limit][shard::num_shards]`, but only lines of the selected shard
+    are parsed and nothing after the last record is read.
+
+    The index holds byte offsets of all records, so that `reader[i]` and `iter(offset=i)` seek to the record
+    instead of skipping `i` lines. It is built on the first `len` or indexing (or `iter` with an offset
+    if `index_path` is given) and stored in `index_path` together with the size and the modification time
+    of the file, so the next readers load it instead of scanning the file.
+    """
+
+    def __init__(
+            self,
+            path: Union[str, Path],
+            backend: str = "auto",
+            index_path: Optional[Union[str, Path]] = None
+    ) -> None:
+        self.path = Path(path)
+        self.loads = get_loads(backend)
+        self.index_path = None if index_path is None else Path(index_path)
+        self._offsets = None
+
+    @property
+    def offsets(self) -> np.ndarray:
+        if self._offsets is None:
+            self._offsets = self._load_index()
+            if self._offsets is None:
+                self._offsets = self._build_index()
+        return self._offsets
+
+    def _load_index(self) -> Optional[np.ndarray]:
+        if self.index_path is None or not self.index_path.exists():
+            return None
+        stat = self.path.stat()
+        with np.load(str(self.index_path)) as index:
+            if int(index["size"]) == stat.st_size and int(index["mtime_ns"]) == stat.st_mtime_ns:
+                return index["offsets"]
+        return None
+
+    def _build_index(self) -> np.ndarray:
+        stat = self.path.stat()
+        offsets = []
+        position = 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                if line.strip():
+                    offsets.append(position)
+                position += len(line)
+        offsets = np.array(offsets, dtype=np.int64)
+
+        if self.index_path is not None:
+            # a file object, so that numpy does not add the .npz extension
+            with open(self.index_path, "wb") as file:
+                np.savez(file, offsets=offsets, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        return offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        with open(self.path, "rb") as file:
+            file.seek(int(self.offsets[index]))
+            return self.loads(file.readline())
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self.iter()
+
+    def iter(
+            self,
+            offset: int = 0,
+            limit: Optional[int] = None,
+            shard: int = 0,
+            num_shards: int = 1
+    ) -> Iterator[Dict[str, Any]]:
+        assert offset >= 0 and (limit is None or limit >= 0)
+        assert 0 <= shard < num_shards
+        start, skip = 0, offset
+        if offset > 0 and (self._offsets is not None or self.index_path is not None):
+            # the first record is found with the index instead of skipping `offset` lines
+            if offset >= len(self.offsets):
+                return
+            start, skip = int(self.offsets[offset]), 0
+
+        with open(self.path, "rb") as file:
+            file.seek(start)
+            lines = (line for line in file if line.strip())
+            for i, line in enumerate(itertools.islice(lines, skip, None if limit is None else skip + limit)):
+                if i % num_shards == shard:
+                    yield self.loads(line)
+
+
+def read_jsonlines(
+        path: Union[str, Path],
+        offset: int = 0,
+        limit: Optional[int] = None,
+        shard: int = 0,
+        num_shards: int = 1,
+        backend: str = "auto",
+        index_path: Optional[Union[str, Path]] = None
+) -> Iterator[Dict[str, Any]]:
+    return JsonlReader(path, backend=backend, index_path=index_path).iter(offset, limit, shard, num_shards)
@@ -0,0 +1,98 @@
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+
+def _nads(wers: np.ndarray, y_true: np.ndarray, y_adv: np.ndarray, gamma: float) -> np.ndarray:
+    # 1 / wer ** gamma for successful attacks, 0 otherwise
+    is_successful = (wers > 0) & (y_true != y_adv)
+    nads = np.zeros(len(wers), dtype=np.float64)
+    nads[is_successful] = 1 / wers[is_successful].astype(np.float64) ** gamma
+    return nads
+
+
+def _perplexity_weights(perp_true: np.ndarray, perp_adv: np.ndarray) -> np.ndarray:
+    return perp_true / np.maximum(perp_true, perp_adv)
+
+
+def normalized_accuracy_drop(
+        wers: Sequence[int],
+        y_true: Sequence[int],
+        y_adv: Sequence[int],
+        gamma: float = 1.0
+) -> float:
+    assert len(y_true) == len(y_adv)
+    return float(np.mean(_nads(np.asarray(wers), np.asarray(y_true), np.asarray(y_adv), gamma)))
+
+
+def normalized_accuracy_drop_with_perplexity(
+        wers: Sequence[int],
+        y_true: Sequence[int],
+        y_adv: Sequence[int],
+        perp_true: Sequence[float],
+        perp_adv: Sequence[float],
+        gamma: float = 1.0
+) -> float:
+    assert len(y_true) == len(y_adv)
+    nads = _nads(np.asarray(wers), np.asarray(y_true), np.asarray(y_adv), gamma)
+    weights = _perplexity_weights(np.asarray(perp_true, dtype=np.float64), np.asarray(perp_adv, dtype=np.float64))
+    return float(np.mean(nads * weights))
+
+
+class AttackMetrics:
+    """
+    Metrics of `evaluate_attack.py` accumulated batch by batch, only sums are stored.
+    Perplexities are either given for every batch or never.
+    """
+
+    def __init__(self, gamma: float = 1.0) -> None:
+        self.gamma = gamma
+        self.num_examples = 0
+        self.num_misclassified = 0
+        self.prob_diff_sum = 0.0
+        self.wer_sum = 0.0
+        self.nad_sum = 0.0
+        self.nad_with_perplexity_sum = 0.0
+        self.perplexity_rise_sum = 0.0
+        self.with_perplexity = None
+
+    def update(
+            self,
+            wers: Sequence[int],
+            y_true: Sequence[int],
+            y_adv: Sequence[int],
+            prob_diffs: Sequence[float],
+            perp_true: Optional[Sequence[float]] = None,
+            perp_adv: Optional[Sequence[float]] = None
+    ) -> None:
+        assert len(wers) == len(y_true) == len(y_adv) == len(prob_diffs)
+        with_perplexity = perp_true is not None and perp_adv is not None
+        assert self.with_perplexity in (None, with_perplexity)
+        self.with_perplexity = with_perplexity
+
+        wers, y_true, y_adv = np.asarray(wers), np.asarray(y_true), np.asarray(y_adv)
+        nads = _nads(wers, y_true, y_adv, self.gamma)
+        self.num_examples += len(wers)
+        self.num_misclassified += int((y_true != y_adv).sum())
+        self.prob_diff_sum += float(np.sum(prob_diffs, dtype=np.float64))
+        self.wer_sum += float(np.sum(wers, dtype=np.float64))
+        self.nad_sum += float(nads.sum())
+        if with_perplexity:
+            perp_true = np.asarray(perp_true, dtype=np.float64)
+            perp_adv = np.asarray(perp_adv, dtype=np.float64)
+            self.nad_with_perplexity_sum += float((nads * _perplexity_weights(perp_true, perp_adv)).sum())
+            self.perplexity_rise_sum += float(np.maximum(0.0, perp_adv - perp_true).sum())
+
+    def get_metrics(self) -> Dict[str, Optional[float]]:
+        assert self.num_examples > 0
+        metrics = dict(
+            mean_prob_diff=self.prob_diff_sum / self.num_examples,
+            mean_wer=self.wer_sum / self.num_examples,
+            mean_perplexity_rise=self.perplexity_rise_sum / self.num_examples if self.with_perplexity else None
+        )
+        metrics[f"NAD_{self.gamma}"] = self.nad_sum / self.num_examples
+        metrics["misclassification_error"] = self.num_misclassified / self.num_examples
+        metrics[f"NAD_with_perplexity_{self.gamma}"] = (
+            self.nad_with_perplexity_sum / self.num_examples if self.with_perplexity else None
+        )
+        return metrics
@@ -1,11 +1,11 @@
-from typing import Dict, Union
+from typing import Dict, Optional, Union
 
 import torch
 from allennlp.models import BasicClassifier, Model
 from allennlp.nn.util import get_text_field_mask, get_token_ids_from_text_field_tensors
 from allennlp.data import TextFieldTensors
 
-from .deep_levenshtein import OneHot
+from .onehot import OneHot, onehot_embedding, onehot_token_ids
 
 
 @Model.register(name="basic_classifier_one_hot_support")
@@ -22,12 +22,16 @@ class BasicClassifierOneHotSupport(BasicClassifier):
                 device=embedded_text.device
             )
 
-        output_dict = dict()
         if self._seq2seq_encoder:
             embedded_text = self._seq2seq_encoder(embedded_text, mask=mask)
 
         embedded_text = self._seq2vec_encoder(embedded_text, mask=mask)
+        return self.forward_on_encoded(embedded_text, label)
 
+    def forward_on_encoded(self, embedded_text: torch.Tensor,
+                           label: torch.IntTensor = None) -> Dict[str, torch.Tensor]:
+        # everything after the seq2vec encoder
+        output_dict = dict()
         if self._dropout:
             embedded_text = self._dropout(embedded_text)
 
@@ -46,11 +50,17 @@ class BasicClassifierOneHotSupport(BasicClassifier):
 
         return output_dict
 
-    def get_embeddings(self, tokens: Union[TextFieldTensors, OneHot]) -> Dict[str, torch.Tensor]:
+    def get_embeddings(
+        self,
+        tokens: Union[TextFieldTensors, OneHot],
+        shortlist: Optional[torch.Tensor] = None,
+        hard_onehot: bool = False
+    ) -> Dict[str, torch.Tensor]:
         if isinstance(tokens, OneHot):
-            # TODO: sparse tensors support
-            embedded_text = torch.matmul(tokens, self._text_field_embedder._token_embedders["tokens"].weight)
-            indexes = torch.argmax(tokens, dim=-1)
+            embedded_text = onehot_embedding(
+                tokens, self._text_field_embedder._token_embedders["tokens"].weight, shortlist, hard=hard_onehot
+            )
+            indexes = onehot_token_ids(tokens, shortlist)
             mask = (~torch.eq(indexes, 0)).float()
             token_ids = indexes
         else:
@@ -61,10 +71,14 @@ class BasicClassifierOneHotSupport(BasicClassifier):
         return {"embedded_text": embedded_text, "mask": mask, "token_ids": token_ids}
 
     def forward(  # type: ignore
-        self, tokens: Union[TextFieldTensors, OneHot], label: torch.IntTensor = None
+        self,
+        tokens: Union[TextFieldTensors, OneHot],
+        label: torch.IntTensor = None,
+        shortlist: Optional[torch.Tensor] = None,
+        hard_onehot: bool = False
     ) -> Dict[str, torch.Tensor]:
 
-        emb_out = self.get_embeddings(tokens)
+        emb_out = self.get_embeddings(tokens, shortlist, hard_onehot)
 
         output_dict = self.forward_on_embeddings(emb_out["embedded_text"], emb_out["mask"], label)
         output_dict["token_ids"] = emb_out["token_ids"]
@@ -6,8 +6,7 @@ from allennlp.modules import TextFieldEmbedder, Seq2VecEncoder, Seq2SeqEncoder
 from allennlp.data import TextFieldTensors, Vocabulary
 from allennlp.nn import util
 
-
-OneHot = torch.Tensor
+from .onehot import OneHot, onehot_embedding, onehot_token_ids
 
 
 @Model.register(name="deep_levenshtein")
@@ -26,12 +25,18 @@ class DeepLevenshtein(Model):
         self.linear = torch.nn.Linear(self.seq2vec_encoder.get_output_dim() * 3, 1)
         self._loss = torch.nn.MSELoss()
 
-    def encode_sequence(self, sequence: Union[OneHot, TextFieldTensors]) -> torch.Tensor:
+    def encode_sequence(
+        self,
+        sequence: Union[OneHot, TextFieldTensors],
+        shortlist: Optional[torch.Tensor] = None,
+        hard_onehot: bool = False
+    ) -> torch.Tensor:
 
         if isinstance(sequence, OneHot):
-            # TODO: sparse tensors support
-            embedded_sequence = torch.matmul(sequence, self.text_field_embedder._token_embedders["tokens"].weight)
-            indexes = torch.argmax(sequence, dim=-1)
+            embedded_sequence = onehot_embedding(
+                sequence, self.text_field_embedder._token_embedders["tokens"].weight, shortlist, hard=hard_onehot
+            )
+            indexes = onehot_token_ids(sequence, shortlist)
             mask = (~torch.eq(indexes, 0)).float()
         else:
             embedded_sequence = self.text_field_embedder(sequence)
@@ -43,14 +48,20 @@ class DeepLevenshtein(Model):
         embedded_sequence_vector = self.seq2vec_encoder(embedded_sequence, mask=mask)
         return embedded_sequence_vector
 
-    def forward(
+    def forward_on_encoded(
         self,
         sequence_a: Union[OneHot, TextFieldTensors],
-        sequence_b: Union[OneHot, TextFieldTensors],
+        encoded_sequence_b: torch.Tensor,
         distance: Optional[torch.Tensor] = None,
+        shortlist: Optional[torch.Tensor] = None,
+        hard_onehot: bool = False,
     ) -> Dict[str, torch.Tensor]:
-        embedded_sequence_a = self.encode_sequence(sequence_a)
-        embedded_sequence_b = self.encode_sequence(sequence_b)
+        """
+        `encoded_sequence_b` is the output of `encode_sequence` and can be computed once
+        for a reference sequence. It is broadcasted along the batch of `sequence_a`.
+        """
+        embedded_sequence_a = self.encode_sequence(sequence_a, shortlist, hard_onehot)
+        embedded_sequence_b = encoded_sequence_b.expand_as(embedded_sequence_a)
         diff = torch.abs(embedded_sequence_a - embedded_sequence_b)
 
         representation = torch.cat([embedded_sequence_a, embedded_sequence_b, diff], dim=-1)
@@ -60,3 +71,11 @@ class DeepLevenshtein(Model):
         if distance is not None:
             output_dict["loss"] = self._loss(approx_distance.view(-1), distance.view(-1))
         return output_dict
+
+    def forward(
+        self,
+        sequence_a: Union[OneHot, TextFieldTensors],
+        sequence_b: Union[OneHot, TextFieldTensors],
+        distance: Optional[torch.Tensor] = None,
+    ) -> Dict[str, torch.Tensor]:
+        return self.forward_on_encoded(sequence_a, self.encode_sequence(sequence_b), distance)
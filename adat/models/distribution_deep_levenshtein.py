@@ -37,8 +37,21 @@ class DistributionDeepLevenshtein(Model):
             lm_output_b: Dict[str, torch.Tensor],
             distance: Optional[torch.Tensor] = None
     ) -> Dict[str, torch.Tensor]:
+        encoded_sequence_b = self.encode_sequence(lm_output_b["logits"], lm_output_b["mask"])
+        return self.forward_on_encoded(lm_output_a, encoded_sequence_b, distance)
+
+    def forward_on_encoded(
+            self,
+            lm_output_a: Dict[str, torch.Tensor],
+            encoded_sequence_b: torch.Tensor,
+            distance: Optional[torch.Tensor] = None
+    ) -> Dict[str, torch.Tensor]:
+        """
+        The same as `forward_on_lm_output`, but the second sequence is already passed through `encode_sequence`
+        (e.g. the initial LM output of an attacked sequence).
+        """
         embedded_sequence_a = self.encode_sequence(lm_output_a["logits"], lm_output_a["mask"])
-        embedded_sequence_b = self.encode_sequence(lm_output_b["logits"], lm_output_b["mask"])
+        embedded_sequence_b = encoded_sequence_b.expand_as(embedded_sequence_a)
         diff = torch.abs(embedded_sequence_a - embedded_sequence_b)
 
         representation = torch.cat([embedded_sequence_a, embedded_sequence_b, diff], dim=-1)
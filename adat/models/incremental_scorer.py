@@ -0,0 +1,193 @@
+from typing import List, Optional
+
+import torch
+from dataclasses import dataclass
+from allennlp.models import Model
+from allennlp.modules.seq2seq_encoders import PytorchSeq2SeqWrapper
+from allennlp.modules.seq2vec_encoders import CnnEncoder
+
+
+@dataclass
+class ScoringState:
+    # (num_sequences, seq_length)
+    token_ids: torch.Tensor
+    mask: torch.Tensor
+    # (num_sequences, seq_length, emb_dim)
+    embeddings: torch.Tensor
+    # pre-activations of every convolution or outputs of the GRU
+    cache: List[torch.Tensor]
+
+
+class IncrementalScorer:
+    """
+    Probabilities of candidates that differ from already scored sequences in a few tokens,
+    the same as `classifier.forward` on the candidates.
+
+    CNN encoders (without a seq2seq encoder): a convolution is linear, so only the windows covering
+    the changed tokens are updated by the kernel applied to the change of the embeddings, then max-pooled.
+    One layer GRU encoders: the forward direction is resumed from the cached state before the first changed token,
+    the backward direction from the cached state after the last one.
+    Other classifiers are scored with the full forward.
+    """
+
+    def __init__(self, classifier: Model, batch_size: int = 128) -> None:
+        self.classifier = classifier
+        self.batch_size = batch_size
+        self.embedder = classifier._text_field_embedder._token_embedders["tokens"]
+
+        seq2seq_encoder = classifier._seq2seq_encoder
+        self.mode = "full"
+        if hasattr(classifier, "forward_on_encoded"):
+            if seq2seq_encoder is None and isinstance(classifier._seq2vec_encoder, CnnEncoder):
+                self.mode = "cnn"
+            elif (
+                    isinstance(seq2seq_encoder, PytorchSeq2SeqWrapper)
+                    and isinstance(seq2seq_encoder._module, torch.nn.GRU)
+                    and seq2seq_encoder._module.num_layers == 1
+            ):
+                self.mode = "gru"
+
+    @torch.no_grad()
+    def prepare(self, token_ids: torch.Tensor) -> ScoringState:
+        """
+        token_ids: (num_sequences, seq_length) sequences to which the candidates are compared
+        """
+        mask = token_ids != 0
+        embeddings = self.embedder(token_ids)
+        cache = []
+        if self.mode == "cnn":
+            encoder = self.classifier._seq2vec_encoder
+            embeddings = embeddings * mask.unsqueeze(-1)
+            cache = [convolution(embeddings.transpose(1, 2)) for convolution in encoder._convolution_layers]
+        elif self.mode == "gru":
+            cache = [self.classifier._seq2seq_encoder(embeddings, mask=mask)]
+        return ScoringState(token_ids=token_ids, mask=mask, embeddings=embeddings, cache=cache)
+
+    @torch.no_grad()
+    def score(
+            self,
+            state: ScoringState,
+            candidate_ids: torch.Tensor,
+            sequence_indexes: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        candidate_ids: (num_candidates, seq_length), sequence_indexes: (num_candidates, ) indexes of
+        the sequences of `state` the candidates are compared to (all to the first one by default)
+        Returns (num_candidates, num_labels) probabilities
+        """
+        if sequence_indexes is None:
+            sequence_indexes = candidate_ids.new_zeros(candidate_ids.size(0))
+
+        probs = []
+        for i in range(0, candidate_ids.size(0), self.batch_size):
+            batch_ids = candidate_ids[i:i + self.batch_size]
+            batch_indexes = sequence_indexes[i:i + self.batch_size]
+            if self.mode == "cnn":
+                encoded = self._encode_cnn(state, batch_ids, batch_indexes)
+            elif self.mode == "gru":
+                encoded = self._encode_gru(state, batch_ids, batch_indexes)
+            else:
+                probs.append(self.classifier.forward({"tokens": {"tokens": batch_ids}})["probs"])
+                continue
+            probs.append(self.classifier.forward_on_encoded(encoded)["probs"])
+        return torch.cat(probs)
+
+    def _encode_cnn(
+            self,
+            state: ScoringState,
+            candidate_ids: torch.Tensor,
+            sequence_indexes: torch.Tensor
+    ) -> torch.Tensor:
+        encoder = self.classifier._seq2vec_encoder
+        rows, positions = (candidate_ids != state.token_ids[sequence_indexes]).nonzero(as_tuple=True)
+        # (num_changes, emb_dim)
+        deltas = self.embedder(candidate_ids[rows, positions]) - state.embeddings[sequence_indexes[rows], positions]
+        deltas = deltas * state.mask[sequence_indexes[rows], positions].unsqueeze(-1)
+
+        filter_outputs = []
+        for convolution, pre_activations in zip(encoder._convolution_layers, state.cache):
+            ngram_size = convolution.kernel_size[0]
+            # (num_candidates, num_windows, num_filters)
+            windows = pre_activations[sequence_indexes].transpose(1, 2).clone()
+            # a change at the t-th token of a window adds `weight[:, :, t] @ delta` to it
+            # (num_changes, ngram_size, num_filters)
+            contributions = torch.einsum("fdt,kd->ktf", convolution.weight, deltas)
+            starts = positions.unsqueeze(1) - torch.arange(ngram_size, device=positions.device).unsqueeze(0)
+            is_valid = (starts >= 0) & (starts < windows.size(1))
+            windows.index_put_(
+                (rows.unsqueeze(1).expand_as(starts)[is_valid], starts[is_valid]),
+                contributions[is_valid],
+                accumulate=True
+            )
+            filter_outputs.append(encoder._activation(windows).max(dim=1)[0])
+
+        maxpool_output = torch.cat(filter_outputs, dim=1) if len(filter_outputs) > 1 else filter_outputs[0]
+        if encoder.projection_layer:
+            return encoder.projection_layer(maxpool_output)
+        return maxpool_output
+
+    def _encode_gru(
+            self,
+            state: ScoringState,
+            candidate_ids: torch.Tensor,
+            sequence_indexes: torch.Tensor
+    ) -> torch.Tensor:
+        gru = self.classifier._seq2seq_encoder._module
+        hidden_size = gru.hidden_size
+        mask = state.mask[sequence_indexes]
+        lengths = mask.sum(dim=1)
+        embeddings = self.embedder(candidate_ids)
+        # (num_candidates, seq_length, num_directions * hidden_size)
+        outputs = state.cache[0][sequence_indexes].clone()
+
+        is_changed = (candidate_ids != state.token_ids[sequence_indexes]) & mask
+        positions = torch.arange(candidate_ids.size(1), device=candidate_ids.device).unsqueeze(0)
+        # the first and the last changed positions (`lengths` and -1 if nothing has changed)
+        first = torch.where(is_changed, positions, lengths.unsqueeze(1)).min(dim=1)[0]
+        last = torch.where(is_changed, positions, torch.full_like(positions, -1)).max(dim=1)[0]
+
+        rows = torch.arange(candidate_ids.size(0), device=candidate_ids.device)
+        forward_state = torch.where(
+            (first > 0).unsqueeze(1), outputs[rows, (first - 1).clamp(min=0), :hidden_size], outputs.new_zeros(1)
+        )
+        self._resume(outputs, embeddings, first, lengths - first, 1, forward_state, slice(0, hidden_size), "")
+        if gru.bidirectional:
+            backward_state = torch.where(
+                (last < lengths - 1).unsqueeze(1),
+                outputs[rows, (last + 1).clamp(max=candidate_ids.size(1) - 1), hidden_size:],
+                outputs.new_zeros(1)
+            )
+            self._resume(outputs, embeddings, last, last + 1, -1, backward_state, slice(hidden_size, None), "_reverse")
+
+        return self.classifier._seq2vec_encoder(outputs, mask=mask)
+
+    def _resume(
+            self,
+            outputs: torch.Tensor,
+            embeddings: torch.Tensor,
+            starts: torch.Tensor,
+            num_steps: torch.Tensor,
+            direction: int,
+            hidden: torch.Tensor,
+            output_slice: slice,
+            suffix: str
+    ) -> None:
+        # runs one direction of the GRU from `starts` for `num_steps` and writes the states to `outputs`
+        gru = self.classifier._seq2seq_encoder._module
+        weight_ih, weight_hh = getattr(gru, "weight_ih_l0" + suffix), getattr(gru, "weight_hh_l0" + suffix)
+        bias_ih = getattr(gru, "bias_ih_l0" + suffix) if gru.bias else None
+        bias_hh = getattr(gru, "bias_hh_l0" + suffix) if gru.bias else None
+
+        rows = torch.arange(outputs.size(0), device=outputs.device)
+        for step in range(int(num_steps.max().clamp(min=0))):
+            is_active = step < num_steps
+            positions = (starts + direction * step).clamp(0, outputs.size(1) - 1)
+            input_gates = torch.nn.functional.linear(embeddings[rows, positions], weight_ih, bias_ih)
+            hidden_gates = torch.nn.functional.linear(hidden, weight_hh, bias_hh)
+            input_reset, input_update, input_new = input_gates.chunk(3, dim=-1)
+            hidden_reset, hidden_update, hidden_new = hidden_gates.chunk(3, dim=-1)
+            reset = torch.sigmoid(input_reset + hidden_reset)
+            update = torch.sigmoid(input_update + hidden_update)
+            new = torch.tanh(input_new + reset * hidden_new)
+            hidden = torch.where(is_active.unsqueeze(1), (1 - update) * new + update * hidden, hidden)
+            outputs[rows[is_active], positions[is_active], output_slice] = hidden[is_active]
@@ -0,0 +1,79 @@
+from typing import Optional
+
+import torch
+
+
+# (..., vocab_size) or (..., shortlist_size) hard one-hots or distributions over tokens,
+# token ids (and so the masks) are taken as the argmax of the distributions
+OneHot = torch.Tensor
+
+
+class OneHotEmbedding(torch.autograd.Function):
+    """
+    Embedding lookup for hard one-hot vectors, e.g. `gumbel_softmax(..., hard=True)`.
+    The forward pass gathers rows of the embedding matrix instead of multiplying by it, the backward pass
+    gives the same gradients as `torch.matmul(onehot, weight)`, so the straight-through gradients
+    still reach the LM logits.
+    If `shortlist` is given, one-hots are over `shortlist.size(-1)` candidates of each position
+    and `shortlist` holds their vocabulary indexes.
+    """
+
+    @staticmethod
+    def forward(ctx, onehot: OneHot, weight: torch.Tensor, shortlist: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # every row is `value * e_i`: `value` is 1.0 for hard one-hots and 0.0 for padding
+        values, token_ids = onehot.max(dim=-1)
+        if shortlist is not None:
+            token_ids = shortlist.gather(-1, token_ids.unsqueeze(-1)).squeeze(-1)
+        ctx.save_for_backward(token_ids, values, weight, shortlist)
+        return torch.nn.functional.embedding(token_ids, weight) * values.unsqueeze(-1)
+
+    @staticmethod
+    def backward(ctx, grad_output: torch.Tensor):
+        token_ids, values, weight, shortlist = ctx.saved_tensors
+        grad_onehot = grad_weight = None
+        if ctx.needs_input_grad[0]:
+            if shortlist is None:
+                grad_onehot = torch.matmul(grad_output, weight.t())
+            else:
+                # (..., shortlist_size, embedding_dim) x (..., embedding_dim, 1)
+                grad_onehot = torch.matmul(
+                    torch.nn.functional.embedding(shortlist, weight), grad_output.unsqueeze(-1)
+                ).squeeze(-1)
+        if ctx.needs_input_grad[1]:
+            grad_weight = torch.zeros_like(weight).index_add_(
+                0,
+                token_ids.reshape(-1),
+                (grad_output * values.unsqueeze(-1)).reshape(-1, weight.size(1))
+            )
+        return grad_onehot, grad_weight, None
+
+
+def is_hard_onehot(onehot: OneHot) -> bool:
+    # at most one non-zero value in every row, scans the whole tensor
+    return bool(((onehot != 0).sum(dim=-1) <= 1).all())
+
+
+def onehot_embedding(
+        onehot: OneHot,
+        weight: torch.Tensor,
+        shortlist: Optional[torch.Tensor] = None,
+        hard: bool = False
+) -> torch.Tensor:
+    """
+    The same as `torch.matmul(onehot, weight)` (over the shortlisted embeddings if `shortlist` is given).
+    If the caller knows that `onehot` holds hard one-hots (e.g. Gumbel samples with `hard=True`),
+    `hard=True` uses the index lookup of `OneHotEmbedding`, soft distributions need `hard=False`.
+    """
+    if hard:
+        return OneHotEmbedding.apply(onehot, weight, shortlist)
+    if shortlist is None:
+        return torch.matmul(onehot, weight)
+    # (..., 1, shortlist_size) x (..., shortlist_size, embedding_dim)
+    return torch.matmul(onehot.unsqueeze(-2), torch.nn.functional.embedding(shortlist, weight)).squeeze(-2)
+
+
+def onehot_token_ids(onehot: OneHot, shortlist: Optional[torch.Tensor] = None) -> torch.Tensor:
+    token_ids = torch.argmax(onehot, dim=-1)
+    if shortlist is not None:
+        token_ids = shortlist.gather(-1, token_ids.unsqueeze(-1)).squeeze(-1)
+    return token_ids
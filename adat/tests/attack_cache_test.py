@@ -0,0 +1,41 @@
+from adat.attack_cache import AttackCache, attack_key
+
+
+def test_attack_key():
+    key = attack_key("a b c", 1, "cascada", {"lr": 0.1, "alpha": 2.0}, ["digest"])
+    assert key == attack_key("a b c", 1, "cascada", {"alpha": 2.0, "lr": 0.1}, ["digest"])
+    assert key != attack_key("a b c", 0, "cascada", {"lr": 0.1, "alpha": 2.0}, ["digest"])
+    assert key != attack_key("a b c", 1, "cascada", {"lr": 0.2, "alpha": 2.0}, ["digest"])
+    assert key != attack_key("a b c", 1, "cascada", {"lr": 0.1, "alpha": 2.0}, ["other_digest"])
+
+
+def test_get_or_attack(tmp_path):
+    attacked = []
+
+    def attack(indexes):
+        attacked.extend(indexes)
+        return [{"index": i} for i in indexes]
+
+    with AttackCache(tmp_path / "cache.db") as cache:
+        assert cache.get_or_attack(["a", "b"], attack) == [{"index": 0}, {"index": 1}]
+        assert cache.get_or_attack(["c", "a", "b"], attack) == [{"index": 0}, {"index": 0}, {"index": 1}]
+        assert attacked == [0, 1, 0]
+        assert cache.stats() == {"hits": 2, "misses": 3, "num_results": 3, "size": 36}
+
+    # the results are persistent
+    with AttackCache(tmp_path / "cache.db") as cache:
+        assert cache.get("b") == {"index": 1}
+
+
+def test_eviction(tmp_path):
+    # every result takes 12 bytes
+    with AttackCache(tmp_path / "cache.db", max_size=30) as cache:
+        cache.put("a", {"index": 0})
+        cache.put("b", {"index": 1})
+        cache.get("a")
+        cache.put("c", {"index": 2})
+
+        # "b" is the least recently used
+        assert cache.get("b") is None
+        assert cache.get("a") == {"index": 0}
+        assert cache.get("c") == {"index": 2}
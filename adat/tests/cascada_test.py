@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import torch
+from allennlp.data import Vocabulary
+from allennlp.common import Params
+from allennlp.models import Model
+
+from adat.attackers.cascada import Cascada, SequenceState
+
+PROJECT_ROOT = (Path(__file__).parent / ".." / "..").resolve()
+
+
+def _model_from_config(config_path: str, vocab: Vocabulary, **ext_vars) -> Model:
+    params = Params.from_file(str(PROJECT_ROOT / config_path), ext_vars=dict(LM_VOCAB_PATH="", **ext_vars))
+    return Model.from_params(params=params["model"], vocab=vocab).eval()
+
+
+def test_surrogate_outputs_do_not_depend_on_batch():
+    torch.manual_seed(0)
+    vocab = Vocabulary()
+    vocab.add_tokens_to_namespace([f"w{i}" for i in range(50)], "tokens")
+    vocab_size = vocab.get_vocab_size()
+
+    # only the surrogate models are needed, archives are not loaded
+    attacker = Cascada.__new__(Cascada)
+    attacker.classifier = _model_from_config(
+        "configs/models/classifier/cnn_classifier.jsonnet",
+        vocab,
+        CLS_TRAIN_DATA_PATH="",
+        CLS_VALID_DATA_PATH="",
+        CLS_NUM_CLASSES="3"
+    )
+    attacker.deep_levenshtein = _model_from_config(
+        "configs/models/levenshtein/cnn_deep_levenshtein.jsonnet",
+        vocab,
+        DL_TRAIN_DATA_PATH="",
+        DL_VALID_DATA_PATH=""
+    )
+    attacker.tau = 1.0
+    attacker.num_gumbel_samples = 2
+    attacker.max_gumbel_chunk = None
+    attacker.top_k = None
+
+    states, lm_outputs = [], []
+    for label, length in enumerate([7, 12, 5, 7]):
+        token_ids = torch.randint(2, vocab_size, (1, length))
+        inputs = {"tokens": {"tokens": token_ids}}
+        state = SequenceState(
+            sequence="", label=label % 3, inputs=inputs, initial_prob=0.0, parameters=dict(), optimizer=None
+        )
+        with torch.no_grad():
+            state.encoded_reference = attacker.deep_levenshtein.encode_sequence(inputs)
+        states.append(state)
+        # peaked logits, so that Gumbel samples are the same tokens for any noise
+        adversarial_ids = torch.randint(2, vocab_size, (1, length))
+        lm_outputs.append({
+            "logits": torch.nn.functional.one_hot(adversarial_ids, vocab_size).float() * 1e4,
+            "mask": torch.ones(1, length, dtype=torch.bool)
+        })
+
+    with torch.no_grad():
+        prob, distance = attacker.get_surrogate_outputs(states, lm_outputs)
+        for i in range(len(states)):
+            expected_prob, expected_distance = attacker.get_surrogate_outputs(states[i:i + 1], lm_outputs[i:i + 1])
+            assert torch.allclose(prob[i:i + 1], expected_prob, atol=1e-6)
+            assert torch.allclose(distance[i:i + 1], expected_distance, atol=1e-6)
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+from allennlp.common import Params
+from allennlp.data import DatasetReader, Vocabulary
+from allennlp.models import Model
+from allennlp.predictors import TextClassifierPredictor
+
+from adat.attackers import HotFlipFixed
+
+PROJECT_ROOT = (Path(__file__).parent / ".." / "..").resolve()
+
+
+@pytest.mark.parametrize("num_positions, num_candidates", [(1, 1), (2, 3)])
+def test_attack_batch_does_not_depend_on_batch(num_positions, num_candidates):
+    torch.manual_seed(0)
+    params = Params.from_file(
+        str(PROJECT_ROOT / "configs/models/classifier/cnn_classifier.jsonnet"),
+        ext_vars={
+            "CLS_TRAIN_DATA_PATH": "",
+            "CLS_VALID_DATA_PATH": "",
+            "LM_VOCAB_PATH": "",
+            "CLS_NUM_CLASSES": "3"
+        }
+    )
+    vocab = Vocabulary()
+    vocab.add_tokens_to_namespace(["<START>", "<END>"] + [f"w{i}" for i in range(40)], "tokens")
+    classifier = Model.from_params(params=params["model"], vocab=vocab).eval()
+    reader = DatasetReader.from_params(params["dataset_reader"])
+    attacker = HotFlipFixed(
+        TextClassifierPredictor(classifier, reader), num_positions=num_positions, num_candidates=num_candidates
+    )
+
+    # sequences of different lengths, shorter ones are padded in a batch
+    inputs = [
+        {"sentence": " ".join(f"w{(7 * i + j) % 40}" for j in range(length))}
+        for i, length in enumerate([2, 6, 4, 6, 9])
+    ]
+    results = dict(attacker.attack_batch_from_json(inputs))
+    assert sorted(results) == list(range(len(inputs)))
+    for i, json_input in enumerate(inputs):
+        (_, expected), = list(attacker.attack_batch_from_json([json_input]))
+        assert results[i]["final"] == expected["final"]
+        assert np.allclose(results[i]["outputs"]["probs"], expected["outputs"]["probs"], atol=1e-6)
@@ -0,0 +1,52 @@
+from pathlib import Path
+
+import pytest
+import torch
+from allennlp.data import Vocabulary
+from allennlp.common import Params
+from allennlp.models import Model
+
+from adat.models import IncrementalScorer
+
+PROJECT_ROOT = (Path(__file__).parent / ".." / "..").resolve()
+
+
+@pytest.mark.parametrize("config_name, mode", [("cnn_classifier", "cnn"), ("gru_classifier", "gru")])
+def test_incremental_scorer(config_name, mode):
+    torch.manual_seed(0)
+    params = Params.from_file(
+        str(PROJECT_ROOT / f"configs/models/classifier/{config_name}.jsonnet"),
+        ext_vars={
+            "CLS_TRAIN_DATA_PATH": "",
+            "CLS_VALID_DATA_PATH": "",
+            "LM_VOCAB_PATH": "",
+            "CLS_NUM_CLASSES": "3"
+        }
+    )
+    vocab = Vocabulary()
+    vocab.add_tokens_to_namespace([f"w{i}" for i in range(50)], "tokens")
+    classifier = Model.from_params(params=params["model"], vocab=vocab).eval()
+    scorer = IncrementalScorer(classifier, batch_size=7)
+    assert scorer.mode == mode
+
+    # the second sequence is padded
+    token_ids = torch.randint(2, vocab.get_vocab_size(), (2, 10))
+    token_ids[1, 7:] = 0
+    candidate_ids, sequence_indexes = [], []
+    for i, length in enumerate([10, 7]):
+        for position in range(length):
+            candidate = token_ids[i].clone()
+            candidate[position] = (candidate[position] + 1) % (vocab.get_vocab_size() - 2) + 2
+            candidate_ids.append(candidate)
+            sequence_indexes.append(i)
+        # several changes and no changes
+        candidate = token_ids[i].clone()
+        candidate[[1, length - 2]] = 2
+        candidate_ids.extend([candidate, token_ids[i].clone()])
+        sequence_indexes.extend([i, i])
+    candidate_ids = torch.stack(candidate_ids)
+
+    probs = scorer.score(scorer.prepare(token_ids), candidate_ids, torch.tensor(sequence_indexes))
+    with torch.no_grad():
+        expected_probs = classifier.forward({"tokens": {"tokens": candidate_ids}})["probs"]
+    assert torch.allclose(probs, expected_probs, atol=1e-6)
@@ -0,0 +1,28 @@
+import json
+
+from adat.jsonl import JsonlReader, read_jsonlines
+
+
+def test_read_jsonlines(tmp_path):
+    path = tmp_path / "data.json"
+    records = [{"text": f"sequence {i}", "label": i % 3} for i in range(10)]
+    with open(path, "w") as file:
+        for i, record in enumerate(records):
+            file.write(json.dumps(record) + "\n")
+            if i == 4:
+                file.write("\n")
+
+    for backend in ["auto", "json"]:
+        assert list(read_jsonlines(path, backend=backend)) == records
+    assert list(read_jsonlines(path, offset=3, limit=4)) == records[3:7]
+    assert list(read_jsonlines(path, offset=2, limit=7, shard=1, num_shards=3)) == records[2:9][1::3]
+    assert list(read_jsonlines(path, offset=20)) == []
+
+    index_path = tmp_path / "data.idx"
+    reader = JsonlReader(path, index_path=index_path)
+    assert len(reader) == 10
+    assert reader[7] == records[7]
+    assert list(reader.iter(offset=5, limit=2)) == records[5:7]
+    assert index_path.exists()
+    # the stored index is used by the next readers
+    assert list(JsonlReader(path, index_path=index_path).iter(offset=8)) == records[8:]
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from adat.metrics import AttackMetrics, normalized_accuracy_drop, normalized_accuracy_drop_with_perplexity
+
+
+@pytest.mark.parametrize("gamma", [1.0, 2.0])
+def test_attack_metrics(gamma):
+    rng = np.random.RandomState(0)
+    num_examples = 1000
+    wers = rng.randint(0, 5, size=num_examples)
+    y_true = rng.randint(0, 3, size=num_examples)
+    y_adv = rng.randint(0, 3, size=num_examples)
+    prob_diffs = rng.uniform(-1, 1, size=num_examples)
+    perp_true = rng.uniform(1, 100, size=num_examples)
+    perp_adv = rng.uniform(1, 100, size=num_examples)
+
+    nads = [
+        1 / wer ** gamma if wer > 0 and label != adversarial_label else 0.0
+        for wer, label, adversarial_label in zip(wers.tolist(), y_true, y_adv)
+    ]
+    weights = [pt / max(pt, pa) for pt, pa in zip(perp_true, perp_adv)]
+    expected_nad = sum(nads) / num_examples
+    expected_nad_with_perplexity = sum(nad * weight for nad, weight in zip(nads, weights)) / num_examples
+
+    assert normalized_accuracy_drop(wers, y_true, y_adv, gamma) == pytest.approx(expected_nad)
+    assert normalized_accuracy_drop_with_perplexity(
+        wers, y_true, y_adv, perp_true, perp_adv, gamma
+    ) == pytest.approx(expected_nad_with_perplexity)
+
+    accumulator = AttackMetrics(gamma=gamma)
+    for start in range(0, num_examples, 300):
+        batch = slice(start, start + 300)
+        accumulator.update(
+            wers[batch], y_true[batch], y_adv[batch], prob_diffs[batch], perp_true[batch], perp_adv[batch]
+        )
+    metrics = accumulator.get_metrics()
+    assert metrics[f"NAD_{gamma}"] == pytest.approx(expected_nad)
+    assert metrics[f"NAD_with_perplexity_{gamma}"] == pytest.approx(expected_nad_with_perplexity)
+    assert metrics["mean_prob_diff"] == pytest.approx(np.mean(prob_diffs))
+    assert metrics["mean_wer"] == pytest.approx(np.mean(wers))
+    assert metrics["misclassification_error"] == pytest.approx((y_true != y_adv).mean())
+    assert metrics["mean_perplexity_rise"] == pytest.approx(np.mean(np.maximum(0.0, perp_adv - perp_true)))
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from adat.models.onehot import is_hard_onehot, onehot_embedding
+
+
+@pytest.mark.parametrize("hard", [True, False])
+@pytest.mark.parametrize("with_shortlist", [True, False])
+def test_onehot_embedding(hard, with_shortlist):
+    torch.manual_seed(0)
+    weight = torch.randn(30, 8, requires_grad=True)
+    shortlist = torch.randint(0, 30, (2, 6, 5)) if with_shortlist else None
+    logits = torch.randn(2, 6, 5 if with_shortlist else 30, requires_grad=True)
+    onehot = torch.nn.functional.gumbel_softmax(logits, hard=hard)
+    # padding
+    onehot = onehot * torch.tensor([[1.0] * 6, [1.0] * 4 + [0.0] * 2]).unsqueeze(-1)
+    assert is_hard_onehot(onehot) == hard
+
+    embeddings = weight[shortlist] if with_shortlist else weight
+    expected = torch.matmul(onehot.unsqueeze(-2), embeddings).squeeze(-2)
+    expected_grads = torch.autograd.grad(expected.sum(), [logits, weight], retain_graph=True)
+
+    output = onehot_embedding(onehot, weight, shortlist, hard=hard)
+    grads = torch.autograd.grad(output.sum(), [logits, weight])
+    assert torch.allclose(output, expected, atol=1e-6)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-5)
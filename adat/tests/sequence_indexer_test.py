@@ -0,0 +1,33 @@
+import torch
+from allennlp.data import Batch, Vocabulary
+from allennlp.data.dataset_readers import TextClassificationJsonReader
+from allennlp.data.token_indexers import SingleIdTokenIndexer
+from allennlp.data.tokenizers import WhitespaceTokenizer
+
+from adat.attackers.sequence_indexer import SequenceIndexer
+
+
+def test_sequence_indexer():
+    reader = TextClassificationJsonReader(
+        token_indexers={
+            "tokens": SingleIdTokenIndexer(
+                start_tokens=["<START>"], end_tokens=["<END>"], token_min_padding_length=5
+            )
+        },
+        tokenizer=WhitespaceTokenizer(),
+        max_sequence_length=6
+    )
+    vocab = Vocabulary()
+    vocab.add_tokens_to_namespace(["<START>", "<END>"] + [f"w{i}" for i in range(10)], "tokens")
+    # the size of one encoded sequence is less than 100 bytes
+    indexer = SequenceIndexer.from_reader(reader, vocab, max_size=100)
+
+    sequences = ["w1 w2", "w3 unknown w4 w5", "w1 w2 w3 w4 w5 w6 w7 w8", "w1 w2"]
+    instances = Batch([reader.text_to_instance(sequence) for sequence in sequences])
+    instances.index_instances(vocab)
+    expected = instances.as_tensor_dict()["tokens"]["tokens"]
+    assert torch.equal(indexer.sequences_to_input(sequences)["tokens"]["tokens"], expected)
+    assert indexer.cache_info()["num_sequences"] == 1
+
+    assert indexer.decode(expected[0]) == "w1 w2" + " @@PADDING@@" * 4
+    assert indexer.decode_batch(expected[:2], lengths=[4, 6]) == ["w1 w2", "w3 @@UNKNOWN@@ w4 w5"]
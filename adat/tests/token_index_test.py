@@ -0,0 +1,35 @@
+import torch
+
+from adat.attackers.token_index import TokenEmbeddingIndex
+
+
+def test_exact_index():
+    torch.manual_seed(0)
+    embeddings = torch.randn(100, 16)
+    vectors = torch.randn(30, 16)
+    index = TokenEmbeddingIndex(embeddings, excluded_ids=[0, 1, 99], batch_size=7)
+    distances, token_ids = index.query(vectors, k=5)
+
+    expected = torch.cdist(vectors, embeddings)
+    expected[:, [0, 1, 99]] = float("inf")
+    expected_distances, expected_token_ids = expected.topk(5, dim=-1, largest=False)
+    assert torch.equal(token_ids, expected_token_ids)
+    assert torch.allclose(distances, expected_distances, atol=1e-4)
+
+    # excluded tokens are never returned, even for their own embeddings
+    assert not set(index.query(embeddings[[0, 1, 99]])[1][:, 0].tolist()) & {0, 1, 99}
+
+
+def test_ivf_index():
+    torch.manual_seed(0)
+    embeddings = torch.randn(200, 8)
+    vectors = torch.randn(50, 8)
+    exact = TokenEmbeddingIndex(embeddings, excluded_ids=[0, 1])
+
+    # all clusters are probed, the search is exact
+    ivf = TokenEmbeddingIndex(embeddings, excluded_ids=[0, 1], backend="ivf", num_clusters=10, num_probes=10)
+    assert torch.equal(ivf.query(vectors, k=3)[1], exact.query(vectors, k=3)[1])
+
+    # the closest token of a stored embedding is always in its own cluster
+    ivf = TokenEmbeddingIndex(embeddings, excluded_ids=[0, 1], backend="ivf", num_clusters=10, num_probes=1)
+    assert ivf.query(embeddings[2:])[1][:, 0].tolist() == list(range(2, 200))
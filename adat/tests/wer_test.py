@@ -0,0 +1,49 @@
+import random
+
+import numpy as np
+
+from adat.utils import calculate_wer, pairwise_wer
+from adat.wer import batch_wer, bounded_wer_one_vs_all, calculate_wer_batch
+
+
+def _random_sequences(num_sequences, seed, max_length=8):
+    rng = random.Random(seed)
+    return [
+        " ".join(rng.choice(["a", "b", "c", "d", "e"]) for _ in range(rng.randint(0, max_length)))
+        for _ in range(num_sequences)
+    ]
+
+
+def test_pairwise_wer(tmp_path):
+    sequences_a = _random_sequences(23, seed=0)
+    sequences_b = _random_sequences(17, seed=1)
+    expected = np.array([[calculate_wer(a, b) for b in sequences_b] for a in sequences_a])
+
+    assert np.array_equal(pairwise_wer(sequences_a, sequences_b, n_jobs=1, tile_size=5), expected)
+    assert np.array_equal(pairwise_wer(sequences_a, sequences_b, n_jobs=2, tile_size=5), expected)
+
+    output_path = tmp_path / "wer.npy"
+    pairwise_wer(sequences_a, sequences_b, n_jobs=2, tile_size=5, output_path=str(output_path))
+    assert np.array_equal(np.load(output_path), expected)
+
+
+def test_batch_wer():
+    # the bit-parallel algorithm is used for up to 64 tokens, the DP for longer sequences
+    for max_length in [8, 64, 100]:
+        sequences_a = _random_sequences(50, seed=0, max_length=max_length)
+        sequences_b = _random_sequences(50, seed=1, max_length=max_length)
+        expected = [calculate_wer(a, b) for a, b in zip(sequences_a, sequences_b)]
+        assert calculate_wer_batch(sequences_a, sequences_b, batch_size=16).tolist() == expected
+
+    refs = np.array([[1, 2, 3, -1], [4, 4, 4, 4]])
+    hyps = np.array([[1, 3, -1], [5, -1, -1]])
+    assert batch_wer(refs, hyps, ref_lengths=[3, 4], hyp_lengths=[2, 1]).tolist() == [1, 4]
+
+
+def test_bounded_wer():
+    sequence_a = "a b c d e a b"
+    sequences_b = _random_sequences(100, seed=0) + ["a b c d e a b", "b c d e a b", "a b c x e a b y", ""]
+    expected = np.array([calculate_wer(sequence_a, b) for b in sequences_b])
+    for max_distance in [0, 1, 3, 10]:
+        distances = bounded_wer_one_vs_all(sequence_a, sequences_b, max_distance)
+        assert np.array_equal(distances, np.minimum(expected, max_distance + 1))
@@ -1,8 +1,6 @@
 import functools
-from tqdm import tqdm
-from multiprocessing import Pool
-from typing import Sequence, Dict, Any, List
-import json
+import itertools
+from typing import Sequence, Dict, Any, List, Optional
 import re
 import random
 from IPython.core.display import display, HTML
@@ -12,18 +10,19 @@ import numpy as np
 from allennlp.models import Model
 import Levenshtein as lvs
 
+from adat.jsonl import read_jsonlines
+from adat.metrics import normalized_accuracy_drop, normalized_accuracy_drop_with_perplexity
+from adat.wer import pairwise_wer
+
 
 def load_weights(model: Model, path: str, location: str = 'cpu') -> None:
     with open(path, 'rb') as f:
         model.load_state_dict(torch.load(f, map_location=location))
 
 
-def load_jsonlines(path: str) -> List[Dict[str, Any]]:
-    data = []
-    with open(path) as file:
-        for line in file.readlines():
-            data.append(json.loads(line))
-    return data
+def load_jsonlines(path: str, offset: int = 0, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    # only the first `offset + limit` lines are read, see `adat.jsonl.JsonlReader`
+    return list(read_jsonlines(path, offset=offset, limit=limit))
 
 
 @functools.lru_cache(maxsize=5000)
@@ -38,30 +37,21 @@ def calculate_wer(sequence_a: str, sequence_b: str) -> int:
     return lvs.distance(''.join(w1), ''.join(w2))
 
 
-def calculate_normalized_wer(sequence_a: str, sequence_b: str) -> float:
-    wer = calculate_wer(sequence_a, sequence_b)
-    return wer / max(len(sequence_a.split()), len(sequence_b.split()))
+def calculate_wer_one_vs_all(sequence_a: str, sequences_b: Sequence[str]) -> List[int]:
+    # the same as `calculate_wer` for every b, but `sequence_a` is split and mapped to chars only once
+    words_a = sequence_a.split()
+    words_b = [sequence_b.split() for sequence_b in sequences_b]
+    word2char = dict()
+    for word in itertools.chain(words_a, *words_b):
+        word2char.setdefault(word, chr(len(word2char)))
 
+    w1 = ''.join(word2char[w] for w in words_a)
+    return [lvs.distance(w1, ''.join(word2char[w] for w in words)) for words in words_b]
 
-def _wer_one_vs_all(x):
-    a, bs = x
-    return [calculate_wer(a, b) for b in bs]
 
-
-def pairwise_wer(
-    sequences_a: Sequence[str], sequences_b: Sequence[str], n_jobs: int = 5, verbose: bool = False
-) -> np.ndarray:
-    bar = tqdm if verbose else lambda iterable, total, desc: iterable
-
-    with Pool(n_jobs) as pool:
-        distances = list(
-            bar(
-                pool.imap(_wer_one_vs_all, zip(sequences_a, [sequences_b for _ in sequences_a])),
-                total=len(sequences_a),
-                desc="# WER {}x{}".format(len(sequences_a), len(sequences_b)),
-            )
-        )
-    return np.array(distances)
+def calculate_normalized_wer(sequence_a: str, sequence_b: str) -> float:
+    wer = calculate_wer(sequence_a, sequence_b)
+    return wer / max(len(sequence_a.split()), len(sequence_b.split()))
 
 
 def visualize_simple_diff(seq_a: str, seq_b: str, window: int = 3) -> None:
@@ -143,39 +133,3 @@ class SequenceModifier:
         if self.add_prob:
             splitted_sequence = self.add_token(splitted_sequence)
         return " ".join(splitted_sequence)
-
-
-def normalized_accuracy_drop(
-        wers: List[int],
-        y_true: List[int],
-        y_adv: List[int],
-        gamma: float = 1.0
-) -> float:
-    assert len(y_true) == len(y_adv)
-    nads = []
-    for wer, lab, alab in zip(wers, y_true, y_adv):
-        if wer > 0 and lab != alab:
-            nads.append(1 / wer ** gamma)
-        else:
-            nads.append(0.0)
-
-    return sum(nads) / len(nads)
-
-
-def normalized_accuracy_drop_with_perplexity(
-        wers: List[int],
-        y_true: List[int],
-        y_adv: List[int],
-        perp_true: List[float],
-        perp_adv: List[float],
-        gamma: float = 1.0
-) -> float:
-    assert len(y_true) == len(y_adv)
-    nads = []
-    for wer, lab, alab, pt, pa in zip(wers, y_true, y_adv, perp_true, perp_adv):
-        if wer > 0 and lab != alab:
-            nads.append((1 / wer ** gamma) * (pt / max(pt, pa)))
-        else:
-            nads.append(0.0)
-
-    return sum(nads) / len(nads)
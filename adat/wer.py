@@ -0,0 +1,330 @@
+import itertools
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from tqdm import tqdm
+import Levenshtein as lvs
+
+# token ids are passed to `Levenshtein.distance` as code points, surrogates are skipped
+_SURROGATES_START = 0xD800
+_NUM_SURROGATES = 0x800
+# maximum length of sequences compared with the bit-parallel algorithm
+_WORD_SIZE = 64
+
+# shared arrays of the worker processes, see `_init_worker`
+_worker_state: Dict[str, np.ndarray] = dict()
+
+
+def encode_sequences(
+        sequences: Sequence[str],
+        word_to_id: Optional[Dict[str, int]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits sequences on spaces and maps words to ids, new words are added to `word_to_id`.
+    Returns (total_num_words, ) ids and (len(sequences) + 1, ) offsets, the ids of the i-th sequence are
+    `ids[offsets[i]:offsets[i + 1]]`
+    """
+    word_to_id = dict() if word_to_id is None else word_to_id
+    words = [sequence.split() for sequence in sequences]
+    all_words = list(itertools.chain.from_iterable(words))
+    # only unique words are visited in python, in the order of their first occurrence
+    for word in dict.fromkeys(all_words):
+        if word not in word_to_id:
+            word_to_id[word] = len(word_to_id)
+
+    ids = np.fromiter(map(word_to_id.__getitem__, all_words), dtype=np.int32, count=len(all_words))
+    offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum([len(sequence_words) for sequence_words in words], out=offsets[1:])
+    return ids, offsets
+
+
+def ids_to_string(ids: np.ndarray) -> str:
+    # one character per token, the same distances as in `calculate_wer`
+    codes = ids.astype(np.uint32) + (ids >= _SURROGATES_START) * np.uint32(_NUM_SURROGATES)
+    return codes.astype("<u4").tobytes().decode("utf-32-le")
+
+
+def pad_ids(
+        ids: np.ndarray,
+        offsets: np.ndarray,
+        indexes: Optional[np.ndarray] = None,
+        padding_value: int = -1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pads the sequences `indexes` (all by default) of `encode_sequences` output.
+    Returns (len(indexes), max_length) ids and (len(indexes), ) lengths
+    """
+    indexes = np.arange(len(offsets) - 1) if indexes is None else np.asarray(indexes)
+    starts = offsets[indexes]
+    lengths = offsets[indexes + 1] - starts
+    positions = np.arange(lengths.max(initial=0))
+    is_token = positions < lengths[:, None]
+    padded = np.full(is_token.shape, padding_value, dtype=ids.dtype)
+    padded[is_token] = ids[(starts[:, None] + positions)[is_token]]
+    return padded, lengths
+
+
+def batch_wer(
+        refs: np.ndarray,
+        hyps: np.ndarray,
+        ref_lengths: Optional[np.ndarray] = None,
+        hyp_lengths: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Levenshtein distances between (batch_size, max_ref_length) and (batch_size, max_hyp_length)
+    padded token ids, the same as `calculate_wer`. Lengths are the full widths by default.
+    Sequences of at most 64 tokens are compared with the bit-parallel algorithm, longer ones with the DP.
+    """
+    refs, hyps = np.asarray(refs), np.asarray(hyps)
+    batch_size = refs.shape[0]
+    ref_lengths = np.full(batch_size, refs.shape[1]) if ref_lengths is None else np.asarray(ref_lengths)
+    hyp_lengths = np.full(batch_size, hyps.shape[1]) if hyp_lengths is None else np.asarray(hyp_lengths)
+
+    # the distance is symmetric
+    if hyps.shape[1] > _WORD_SIZE and refs.shape[1] <= _WORD_SIZE:
+        refs, hyps, ref_lengths, hyp_lengths = hyps, refs, hyp_lengths, ref_lengths
+    if hyps.shape[1] <= _WORD_SIZE:
+        return _batch_wer_bit_parallel(refs, hyps, ref_lengths, hyp_lengths)
+    return _batch_wer_dp(refs, hyps, ref_lengths, hyp_lengths)
+
+
+def _batch_wer_bit_parallel(
+        refs: np.ndarray,
+        hyps: np.ndarray,
+        ref_lengths: np.ndarray,
+        hyp_lengths: np.ndarray
+) -> np.ndarray:
+    # Myers' algorithm as in Hyyro, "Explaining and extending the bit-parallel approximate string
+    # matching algorithm of Myers": a column of the DP table over hyp tokens is stored as bit vectors
+    # of vertical deltas (+1 in `positive`, -1 in `negative`) and every ref token updates all of them at once
+    one = np.uint64(1)
+    # (batch_size, max_ref_length) bit masks of hyp positions equal to the ref token
+    is_equal = np.zeros((refs.shape[0], refs.shape[1], _WORD_SIZE), dtype=bool)
+    np.equal(refs[:, :, None], hyps[:, None, :], out=is_equal[:, :, :hyps.shape[1]])
+    matches = np.packbits(is_equal, axis=-1, bitorder="little").view("<u8")[:, :, 0].astype(np.uint64)
+
+    positive = np.full(refs.shape[0], np.iinfo(np.uint64).max, dtype=np.uint64)
+    negative = np.zeros(refs.shape[0], dtype=np.uint64)
+    last_bit = one << (np.maximum(hyp_lengths, 1) - 1).astype(np.uint64)
+    distances = hyp_lengths.astype(np.int32)
+    for i in range(ref_lengths.max(initial=0)):
+        eq = matches[:, i]
+        vertical = eq | negative
+        horizontal = (((eq & positive) + positive) ^ positive) | eq
+        horizontal_positive = negative | ~(horizontal | positive)
+        horizontal_negative = positive & horizontal
+
+        is_active = i < ref_lengths
+        distances += is_active & (horizontal_positive & last_bit != 0)
+        distances -= is_active & (horizontal_negative & last_bit != 0)
+
+        horizontal_positive = (horizontal_positive << one) | one
+        horizontal_negative = horizontal_negative << one
+        positive = horizontal_negative | ~(vertical | horizontal_positive)
+        negative = horizontal_positive & vertical
+    # an empty hyp has no bits to track
+    return np.where(hyp_lengths == 0, ref_lengths, distances).astype(np.int32)
+
+
+def _batch_wer_dp(
+        refs: np.ndarray,
+        hyps: np.ndarray,
+        ref_lengths: np.ndarray,
+        hyp_lengths: np.ndarray
+) -> np.ndarray:
+    # The DP table is filled row by row for the whole batch. Insertions make a row depend on itself:
+    # row[j] = min over k <= j of (cost[k] + j - k), which is a cumulative minimum of cost[k] - k.
+    rows = np.arange(refs.shape[0])
+    positions = np.arange(hyps.shape[1] + 1, dtype=np.int32)
+    # distances between the first `i` ref tokens and all hyp prefixes
+    previous = np.tile(positions, (refs.shape[0], 1))
+    distances = previous[rows, hyp_lengths]
+    for i in range(1, ref_lengths.max(initial=0) + 1):
+        current = np.empty_like(previous)
+        current[:, 0] = i
+        np.minimum(previous[:, 1:] + 1, previous[:, :-1] + (refs[:, i - 1:i] != hyps), out=current[:, 1:])
+        current = np.minimum.accumulate(current - positions, axis=1) + positions
+
+        is_finished = ref_lengths == i
+        distances[is_finished] = current[rows[is_finished], hyp_lengths[is_finished]]
+        previous = current
+    return distances
+
+
+def calculate_wer_batch(
+        sequences_a: Sequence[str],
+        sequences_b: Sequence[str],
+        batch_size: int = 4096
+) -> np.ndarray:
+    """
+    `calculate_wer` for every pair of `sequences_a` and `sequences_b`. Pairs are sorted by length,
+    so the sequences of a batch are padded as little as possible.
+    """
+    assert len(sequences_a) == len(sequences_b)
+    word_to_id = dict()
+    ids_a, offsets_a = encode_sequences(sequences_a, word_to_id)
+    ids_b, offsets_b = encode_sequences(sequences_b, word_to_id)
+
+    order = np.argsort(np.maximum(np.diff(offsets_a), np.diff(offsets_b)), kind="stable")
+    distances = np.zeros(len(sequences_a), dtype=np.int32)
+    for start in range(0, len(order), batch_size):
+        indexes = order[start:start + batch_size]
+        refs, ref_lengths = pad_ids(ids_a, offsets_a, indexes)
+        hyps, hyp_lengths = pad_ids(ids_b, offsets_b, indexes)
+        distances[indexes] = batch_wer(refs, hyps, ref_lengths, hyp_lengths)
+    return distances
+
+
+def bounded_wer_one_vs_all(sequence_a: str, sequences_b: Sequence[str], max_distance: int) -> np.ndarray:
+    """
+    `calculate_wer` between `sequence_a` and every b if it is at most `max_distance`, `max_distance + 1` otherwise.
+
+    Only the band of the DP table around the diagonal (|i - j| <= max_distance) is computed, for all b at once.
+    Pairs whose lengths differ by more than `max_distance` are rejected without the DP, and the DP stops
+    as soon as the minimum of the band (which never decreases) exceeds `max_distance` for all pairs.
+    """
+    word_to_id = dict()
+    ids_a, _ = encode_sequences([sequence_a], word_to_id)
+    ids_b, offsets_b = encode_sequences(sequences_b, word_to_id)
+    lengths_b = np.diff(offsets_b)
+    distances = np.full(len(sequences_b), max_distance + 1, dtype=np.int32)
+
+    candidates = np.flatnonzero(np.abs(lengths_b - len(ids_a)) <= max_distance)
+    if candidates.size == 0:
+        return distances
+    hyps, hyp_lengths = pad_ids(ids_b, offsets_b, candidates)
+
+    band_width = 2 * max_distance + 1
+    inf = np.int32(len(ids_a) + hyps.shape[1] + band_width)
+    # hyp tokens of the band of the i-th row are `shifted_hyps[:, i:i + band_width]`
+    shifted_hyps = np.full((len(candidates), len(ids_a) + band_width), -1, dtype=ids_b.dtype)
+    width = min(hyps.shape[1], shifted_hyps.shape[1] - max_distance - 1)
+    shifted_hyps[:, max_distance + 1:max_distance + 1 + width] = hyps[:, :width]
+
+    # the t-th cell of the band of the i-th row is D[i][i - max_distance + t]
+    offsets = np.arange(band_width, dtype=np.int32)
+    columns = offsets - max_distance
+    band = np.where((columns >= 0) & (columns <= hyp_lengths[:, None]), columns, inf).astype(np.int32)
+    is_rejected = np.zeros(len(candidates), dtype=bool)
+    for i in range(1, len(ids_a) + 1):
+        columns += 1
+        deletions = np.full_like(band, inf)
+        deletions[:, :-1] = band[:, 1:] + 1
+        substitutions = band + (shifted_hyps[:, i:i + band_width] != ids_a[i - 1])
+        band = np.minimum(deletions, substitutions)
+        # insertions: band[t] = min over s <= t of (band[s] + t - s)
+        band = np.minimum.accumulate(band - offsets, axis=1) + offsets
+        band[(columns < 0) | (columns > hyp_lengths[:, None])] = inf
+
+        is_rejected |= band.min(axis=1) > max_distance
+        if is_rejected.all():
+            return distances
+
+    candidate_distances = band[np.arange(len(candidates)), hyp_lengths - len(ids_a) + max_distance]
+    distances[candidates] = np.minimum(candidate_distances, max_distance + 1)
+    return distances
+
+
+def bounded_wer(sequence_a: str, sequence_b: str, max_distance: int) -> int:
+    return int(bounded_wer_one_vs_all(sequence_a, [sequence_b], max_distance)[0])
+
+
+def _to_shared(array: np.ndarray, typecode: str) -> RawArray:
+    shared = RawArray(typecode, max(array.size, 1))
+    np.frombuffer(shared, dtype=array.dtype)[:array.size] = array
+    return shared
+
+
+def _init_worker(
+        arrays: Dict[str, Tuple[RawArray, type]],
+        shape: Tuple[int, int],
+        output_path: Optional[str]
+) -> None:
+    _worker_state.clear()
+    for name, (shared, dtype) in arrays.items():
+        _worker_state[name] = np.frombuffer(shared, dtype=dtype)
+    if output_path is None:
+        _worker_state["output"] = _worker_state["output"][:shape[0] * shape[1]].reshape(shape)
+    else:
+        _worker_state["output"] = np.load(output_path, mmap_mode="r+")
+
+
+def _decode(name: str, start: int, end: int) -> List[str]:
+    ids, offsets = _worker_state[f"{name}_ids"], _worker_state[f"{name}_offsets"]
+    return [ids_to_string(ids[offsets[i]:offsets[i + 1]]) for i in range(start, end)]
+
+
+def _wer_tile(tile: Tuple[int, int, int, int]) -> int:
+    row_start, row_end, column_start, column_end = tile
+    rows = _decode("a", row_start, row_end)
+    columns = _decode("b", column_start, column_end)
+    output = _worker_state["output"]
+    for i, row in enumerate(rows, start=row_start):
+        output[i, column_start:column_end] = [lvs.distance(row, column) for column in columns]
+    return len(rows) * len(columns)
+
+
+def _tiles(num_rows: int, num_columns: int, tile_size: int) -> Iterator[Tuple[int, int, int, int]]:
+    for row_start in range(0, num_rows, tile_size):
+        for column_start in range(0, num_columns, tile_size):
+            yield (
+                row_start, min(row_start + tile_size, num_rows),
+                column_start, min(column_start + tile_size, num_columns)
+            )
+
+
+def pairwise_wer(
+    sequences_a: Sequence[str],
+    sequences_b: Sequence[str],
+    n_jobs: int = 5,
+    verbose: bool = False,
+    tile_size: int = 256,
+    output_path: Optional[str] = None
+) -> np.ndarray:
+    """
+    (len(sequences_a), len(sequences_b)) matrix of `calculate_wer` distances.
+
+    Both sides are split and mapped to integer ids only once, the ids are kept in shared memory.
+    Workers compute (tile_size, tile_size) tiles and write them directly to the output matrix,
+    which is shared memory or, if `output_path` is given, a memory-mapped .npy file.
+    """
+    word_to_id = dict()
+    ids_a, offsets_a = encode_sequences(sequences_a, word_to_id)
+    ids_b, offsets_b = encode_sequences(sequences_b, word_to_id)
+    shape = (len(sequences_a), len(sequences_b))
+
+    if output_path is not None:
+        output = np.lib.format.open_memmap(output_path, mode="w+", dtype=np.int32, shape=shape)
+        shared_output = None
+    else:
+        shared_output = RawArray("i", max(shape[0] * shape[1], 1))
+        output = np.frombuffer(shared_output, dtype=np.int32)[:shape[0] * shape[1]].reshape(shape)
+
+    arrays = {
+        "a_ids": (_to_shared(ids_a, "i"), np.int32),
+        "a_offsets": (_to_shared(offsets_a, "q"), np.int64),
+        "b_ids": (_to_shared(ids_b, "i"), np.int32),
+        "b_offsets": (_to_shared(offsets_b, "q"), np.int64),
+    }
+    if shared_output is not None:
+        arrays["output"] = (shared_output, np.int32)
+
+    tiles = list(_tiles(shape[0], shape[1], tile_size))
+    bar = tqdm(total=shape[0] * shape[1], desc=f"# WER {shape[0]}x{shape[1]}", disable=not verbose)
+    if n_jobs > 1 and len(tiles) > 1:
+        if output_path is not None:
+            output.flush()
+        with Pool(n_jobs, initializer=_init_worker, initargs=(arrays, shape, output_path)) as pool:
+            for num_pairs in pool.imap_unordered(_wer_tile, tiles):
+                bar.update(num_pairs)
+    else:
+        _init_worker(arrays, shape, output_path)
+        for tile in tiles:
+            bar.update(_wer_tile(tile))
+        _worker_state.clear()
+    bar.close()
+    if output_path is not None:
+        output.flush()
+    return output
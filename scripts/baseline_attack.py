@@ -8,7 +8,8 @@ from datetime import datetime
 from allennlp.common.util import dump_metrics
 
 from adat.utils import load_jsonlines
-from adat.attackers import FGSMAttacker, DeepFoolAttacker
+from adat.attack_cache import AttackCache, attack_key, file_digest
+from adat.attackers import FGSMAttacker, DeepFoolAttacker, AttackBudget
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config-path", type=str, required=True)
@@ -19,9 +20,17 @@ parser.add_argument("--out-dir", type=str, required=True)
 parser.add_argument("--attacker", type=str, choices=["fgsm", "deepfool"], required=True)
 
 parser.add_argument("--sample-size", type=int, default=None)
+parser.add_argument("--batch-size", type=int, default=1)
 parser.add_argument("--not-date-dir", action="store_true")
 parser.add_argument("--force", action="store_true")
 parser.add_argument("--cuda", type=int, default=-1)
+# per-sequence limits, see `AttackBudget`
+parser.add_argument("--max-time", type=float, default=None)
+parser.add_argument("--patience", type=int, default=None)
+parser.add_argument("--min-delta", type=float, default=0.0)
+# results of already attacked sequences are reused
+parser.add_argument("--cache-path", type=str, default=None)
+parser.add_argument("--cache-max-size-mb", type=float, default=1024.0)
 
 
 if __name__ == "__main__":
@@ -41,7 +50,7 @@ if __name__ == "__main__":
 
     dump_metrics(str(args_path), {**args.__dict__, **config})
 
-    data = load_jsonlines(args.test_path)[:args.sample_size]
+    data = load_jsonlines(args.test_path, limit=args.sample_size)
 
     if args.attacker == "fgsm":
         attacker = FGSMAttacker(args.classifier_dir, device=args.cuda, **config)
@@ -50,12 +59,40 @@ if __name__ == "__main__":
     else:
         raise NotImplementedError
 
+    budget = AttackBudget(max_time=args.max_time, patience=args.patience, min_delta=args.min_delta)
+
+    cache = None
+    if args.cache_path is not None:
+        cache = AttackCache(args.cache_path, max_size=int(args.cache_max_size_mb * 2 ** 20))
+        cache_config = {**config, **budget.__dict__}
+        archive_digests = [file_digest(Path(args.classifier_dir) / "model.tar.gz")]
+
     print(f"Saving results to {results_path}")
-    with jsonlines.open(results_path, "w") as writer:
-        for el in tqdm(data):
-            adversarial_output = attacker.attack(
-                sequence_to_attack=el["text"],
-                label_to_attack=el["label"]
-            )
-
-            writer.write(adversarial_output.__dict__)
+    with jsonlines.open(results_path, "w") as writer, tqdm(total=len(data)) as bar:
+        for i in range(0, len(data), args.batch_size):
+            batch = data[i:i + args.batch_size]
+
+            def attack(indexes):
+                adversarial_outputs = attacker.attack_batch(
+                    sequences_to_attack=[batch[j]["text"] for j in indexes],
+                    labels_to_attack=[batch[j]["label"] for j in indexes],
+                    budget=budget
+                )
+                return [adversarial_output.__dict__ for adversarial_output in adversarial_outputs]
+
+            if cache is None:
+                results = attack(list(range(len(batch))))
+            else:
+                keys = [
+                    attack_key(el["text"], el["label"], args.attacker, cache_config, archive_digests)
+                    for el in batch
+                ]
+                results = cache.get_or_attack(keys, attack)
+
+            for result in results:
+                writer.write(result)
+            bar.update(len(batch))
+
+    if cache is not None:
+        print(f"Cache stats: {cache.stats()}")
+        cache.close()
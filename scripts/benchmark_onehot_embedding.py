@@ -0,0 +1,85 @@
+import argparse
+import multiprocessing
+import time
+from pprint import pprint
+
+import numpy as np
+import torch
+
+from adat.models.onehot import onehot_embedding
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--vocab-size", type=int, default=50000)
+parser.add_argument("--embedding-dim", type=int, default=100)
+parser.add_argument("--sequence-length", type=int, default=256)
+parser.add_argument("--num-gumbel-samples", type=int, default=8)
+parser.add_argument("--num-steps", type=int, default=10)
+parser.add_argument("--cuda", type=int, default=-1)
+
+METHODS = {
+    "matmul": lambda onehot, weight: torch.matmul(onehot, weight),
+    "onehot_embedding": lambda onehot, weight: onehot_embedding(onehot, weight, hard=True),
+}
+
+
+def _reset_peak_memory(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        # resets the peak resident set size (VmHWM), linux only
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+
+
+def _peak_memory_mb(device: torch.device) -> float:
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 2 ** 10
+    raise RuntimeError("Unable to read peak memory usage")
+
+
+def run(method: str, args: argparse.Namespace, results: multiprocessing.Queue) -> None:
+    # every method runs in its own process, so the peak memory is not shared between them
+    device = torch.device(f"cuda:{args.cuda}" if args.cuda >= 0 else "cpu")
+    torch.manual_seed(0)
+    # embeddings of the classifier and Deep Levenshtein are trainable, so they get gradients as well
+    weight = torch.randn(args.vocab_size, args.embedding_dim, device=device, requires_grad=True)
+    logits = torch.randn(args.num_gumbel_samples, args.sequence_length, args.vocab_size, device=device)
+    # a leaf, so only the embedding lookup and its backward pass are measured
+    onehot = torch.nn.functional.gumbel_softmax(logits, hard=True).requires_grad_()
+    del logits
+    _reset_peak_memory(device)
+    initial_memory = _peak_memory_mb(device)
+
+    times = []
+    for _ in range(args.num_steps):
+        start = time.perf_counter()
+        embeddings = METHODS[method](onehot, weight)
+        embeddings.pow(2).mean().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+        onehot.grad = None
+        weight.grad = None
+
+    results.put(
+        {
+            "method": method,
+            "mean_step_time_ms": float(np.mean(times[1:] or times)) * 1000,
+            "peak_memory_increase_mb": _peak_memory_mb(device) - initial_memory
+        }
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    for method in METHODS:
+        process = context.Process(target=run, args=(method, args, results))
+        process.start()
+        pprint(results.get())
+        process.join()
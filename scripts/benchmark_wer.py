@@ -0,0 +1,67 @@
+import argparse
+import random
+import time
+from pprint import pprint
+
+import numpy as np
+
+from adat.utils import calculate_wer
+from adat.wer import batch_wer, calculate_wer_batch, encode_sequences, pad_ids
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num-pairs", type=int, default=100000)
+parser.add_argument("--vocab-size", type=int, default=10000)
+parser.add_argument("--min-length", type=int, default=5)
+parser.add_argument("--max-length", type=int, default=50)
+parser.add_argument("--batch-size", type=int, default=4096)
+parser.add_argument("--seed", type=int, default=0)
+
+
+def random_sequence(rng: random.Random, args: argparse.Namespace) -> str:
+    length = rng.randint(args.min_length, args.max_length)
+    return " ".join(f"w{rng.randrange(args.vocab_size)}" for _ in range(length))
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    sequences_a = [random_sequence(rng, args) for _ in range(args.num_pairs)]
+    # the second sequences are modified copies of the first ones, as in the attacks
+    sequences_b = []
+    for sequence in sequences_a:
+        words = sequence.split()
+        for _ in range(rng.randint(0, len(words))):
+            words[rng.randrange(len(words))] = f"w{rng.randrange(args.vocab_size)}"
+        sequences_b.append(" ".join(words))
+
+    start = time.perf_counter()
+    per_pair = [calculate_wer(a, b) for a, b in zip(sequences_a, sequences_b)]
+    per_pair_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = calculate_wer_batch(sequences_a, sequences_b, batch_size=args.batch_size)
+    batched_time = time.perf_counter() - start
+    assert np.array_equal(batched, per_pair)
+
+    # the attackers already have token ids, so the distances are measured without tokenization as well
+    word_to_id = dict()
+    ids_a, offsets_a = encode_sequences(sequences_a, word_to_id)
+    ids_b, offsets_b = encode_sequences(sequences_b, word_to_id)
+    batches = []
+    for indexes in np.array_split(np.arange(args.num_pairs), max(1, args.num_pairs // args.batch_size)):
+        batches.append(pad_ids(ids_a, offsets_a, indexes) + pad_ids(ids_b, offsets_b, indexes))
+    start = time.perf_counter()
+    for refs, ref_lengths, hyps, hyp_lengths in batches:
+        batch_wer(refs, hyps, ref_lengths, hyp_lengths)
+    token_ids_time = time.perf_counter() - start
+
+    pprint(
+        {
+            "num_pairs": args.num_pairs,
+            "calculate_wer_s": per_pair_time,
+            "calculate_wer_batch_s": batched_time,
+            "batch_wer_on_token_ids_s": token_ids_time,
+            "speedup": per_pair_time / batched_time,
+            "speedup_on_token_ids": per_pair_time / token_ids_time
+        }
+    )
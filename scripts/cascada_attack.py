@@ -8,7 +8,8 @@ from pathlib import Path
 from allennlp.common.util import dump_metrics
 
 from adat.utils import load_jsonlines
-from adat.attackers import Cascada, DistributionCascada
+from adat.attack_cache import AttackCache, attack_key, file_digest
+from adat.attackers import Cascada, DistributionCascada, SamplingFool, AttackBudget
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config-path", type=str, required=True)
@@ -23,7 +24,15 @@ parser.add_argument("--sample-size", type=int, default=None)
 parser.add_argument("--not-date-dir", action="store_true")
 parser.add_argument("--force", action="store_true")
 parser.add_argument("--distribution-level", action="store_true")
+parser.add_argument("--batch-size", type=int, default=1)
 parser.add_argument("--cuda", type=int, default=-1)
+# per-sequence limits, see `AttackBudget`
+parser.add_argument("--max-time", type=float, default=None)
+parser.add_argument("--patience", type=int, default=None)
+parser.add_argument("--min-delta", type=float, default=0.0)
+# results of already attacked sequences are reused
+parser.add_argument("--cache-path", type=str, default=None)
+parser.add_argument("--cache-max-size-mb", type=float, default=1024.0)
 
 
 if __name__ == "__main__":
@@ -43,10 +52,13 @@ if __name__ == "__main__":
 
     dump_metrics(str(args_path), {**args.__dict__, **config})
 
-    data = load_jsonlines(args.test_path)[:args.sample_size]
+    data = load_jsonlines(args.test_path, limit=args.sample_size)
 
     if args.distribution_level:
         cascada = DistributionCascada
+    elif config["lr"] == 0.0:
+        # the LM is not updated, so we only need to sample from it
+        cascada = SamplingFool
     else:
         cascada = Cascada
 
@@ -59,20 +71,55 @@ if __name__ == "__main__":
         lr=config["lr"],
         num_gumbel_samples=config.get("num_gumbel_samples", 1),
         tau=config.get("tau", 1.0),
+        max_gumbel_chunk=config.get("max_gumbel_chunk"),
+        top_k=config.get("top_k"),
+        adapter_rank=config.get("adapter_rank"),
+        max_wer=config.get("max_wer"),
         num_samples=config["num_samples"],
         temperature=config["temperature"],
         parameters_to_update=config["parameters_to_update"],
         device=args.cuda
     )
 
+    budget = AttackBudget(max_time=args.max_time, patience=args.patience, min_delta=args.min_delta)
+
+    cache = None
+    if args.cache_path is not None:
+        cache = AttackCache(args.cache_path, max_size=int(args.cache_max_size_mb * 2 ** 20))
+        cache_config = {**config, **budget.__dict__}
+        archive_digests = [
+            file_digest(Path(model_dir) / "model.tar.gz")
+            for model_dir in (args.lm_dir, args.classifier_dir, args.deep_levenshtein_dir)
+        ]
+
     print(f"Saving results to {results_path}")
-    with jsonlines.open(results_path, "w") as writer:
-        for el in tqdm(data):
-            adversarial_output = attacker.attack(
-                sequence_to_attack=el["text"],
-                label_to_attack=el["label"],
-                max_steps=config["max_steps"],
-                early_stopping=config["early_stopping"]
-            )
-
-            writer.write(adversarial_output.__dict__)
+    with jsonlines.open(results_path, "w") as writer, tqdm(total=len(data)) as bar:
+        for i in range(0, len(data), args.batch_size):
+            batch = data[i:i + args.batch_size]
+
+            def attack(indexes):
+                adversarial_outputs = attacker.attack_batch(
+                    sequences_to_attack=[batch[j]["text"] for j in indexes],
+                    labels_to_attack=[batch[j]["label"] for j in indexes],
+                    max_steps=config["max_steps"],
+                    early_stopping=config["early_stopping"],
+                    budget=budget
+                )
+                return [adversarial_output.__dict__ for adversarial_output in adversarial_outputs]
+
+            if cache is None:
+                results = attack(list(range(len(batch))))
+            else:
+                keys = [
+                    attack_key(el["text"], el["label"], cascada.__name__, cache_config, archive_digests)
+                    for el in batch
+                ]
+                results = cache.get_or_attack(keys, attack)
+
+            for result in results:
+                writer.write(result)
+            bar.update(len(batch))
+
+    if cache is not None:
+        print(f"Cache stats: {cache.stats()}")
+        cache.close()
@@ -7,7 +7,8 @@ import jsonlines
 import numpy as np
 from sklearn.model_selection import train_test_split
 
-from adat.utils import calculate_wer, load_jsonlines, SequenceModifier
+from adat.jsonl import read_jsonlines
+from adat.utils import calculate_wer, SequenceModifier
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--data-dir", type=str, required=True)
@@ -35,8 +36,11 @@ if __name__ == "__main__":
     assert not train_path.exists() and not test_path.exists()
 
     data_dir = Path(args.data_dir)
-    data = load_jsonlines(data_dir / "train.json") + load_jsonlines(data_dir / "test.json")
-    sequences = [str(el[args.field_name]) for el in data]
+    sequences = [
+        str(el[args.field_name])
+        for path in (data_dir / "train.json", data_dir / "test.json")
+        for el in read_jsonlines(path)
+    ]
     mean_len = float(np.mean([len(seq.split()) for seq in sequences]))
     vocab = []
     for seq in sequences:
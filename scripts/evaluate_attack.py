@@ -1,4 +1,5 @@
 import argparse
+import itertools
 from pathlib import Path
 from pprint import pprint
 from tqdm import tqdm
@@ -11,20 +12,22 @@ from allennlp.data import DatasetReader
 from allennlp.common.params import Params
 
 from adat.dataset_readers.lm_reader import SimpleLanguageModelingDatasetReaderFixed
-from adat.utils import load_jsonlines, normalized_accuracy_drop, normalized_accuracy_drop_with_perplexity
+from adat.jsonl import read_jsonlines
+from adat.metrics import AttackMetrics
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--adversarial-dir", type=str, required=True)
 parser.add_argument("--classifier-dir", type=str, required=True)
 parser.add_argument("--lm-dir", type=str, default=None)
 parser.add_argument("--gamma", type=float, default=1.0)
+parser.add_argument("--batch-size", type=int, default=256)
 parser.add_argument("--cuda", type=int, default=-1)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
     adversarial_dir = Path(args.adversarial_dir)
-    data = load_jsonlines(adversarial_dir / "attacked_data.json")
+    data_path = adversarial_dir / "attacked_data.json"
 
     if args.lm_dir is not None:
         lm_dir = Path(args.lm_dir)
@@ -36,14 +39,8 @@ if __name__ == "__main__":
                 lm_predictor._dataset_reader.text_to_instance(text)
             )["loss"]
         )
-        orig_perplexities = [get_perplexity(el["sequence"]) for el in tqdm(data)]
-        adv_perplexities = [get_perplexity(el["adversarial_sequence"]) for el in tqdm(data)]
-        perp_diff = [max(0.0, adv_perplexities[i] - orig_perplexities[i]) for i in range(len(data))]
-        mean_perplexity_rise = float(np.mean(perp_diff))
     else:
-        mean_perplexity_rise = None
-        orig_perplexities = None
-        adv_perplexities = None
+        get_perplexity = None
 
     classifier_dir = Path(args.classifier_dir)
     predictor = Predictor.from_path(
@@ -51,44 +48,37 @@ if __name__ == "__main__":
         predictor_name="text_classifier",
         cuda_device=args.cuda
     )
-    preds = predictor.predict_batch_json([{"sentence": el["sequence"]} for el in data])
-    y_true = [int(el["attacked_label"]) for el in data]
-    correctly_predicted = [y == int(np.argmax(p["probs"])) for y, p in zip(y_true, preds)]
 
-    adv_preds = predictor.predict_batch_json([{"sentence": el["adversarial_sequence"]} for el in data])
-    y_adv = [int(np.argmax(el["probs"])) for el in adv_preds]
+    # the results are scored batch by batch, so only the metric sums are kept in memory
+    accumulator = AttackMetrics(gamma=args.gamma)
+    records = read_jsonlines(data_path)
+    with tqdm() as bar:
+        for batch in iter(lambda: list(itertools.islice(records, args.batch_size)), []):
+            preds = predictor.predict_batch_json([{"sentence": el["sequence"]} for el in batch])
+            adv_preds = predictor.predict_batch_json([{"sentence": el["adversarial_sequence"]} for el in batch])
+            y_true = np.array([int(el["attacked_label"]) for el in batch])
+            probs = np.array([p["probs"] for p in preds])
+            adv_probs = np.array([p["probs"] for p in adv_preds])
+            rows = np.arange(len(batch))
 
-    prob_diffs = [p["probs"][l] - ap["probs"][l] for p, ap, l in zip(preds, adv_preds, y_true)]
-    wers = [el["wer"] for el in data]
+            if get_perplexity is not None:
+                orig_perplexities = [get_perplexity(el["sequence"]) for el in batch]
+                adv_perplexities = [get_perplexity(el["adversarial_sequence"]) for el in batch]
+            else:
+                orig_perplexities = None
+                adv_perplexities = None
 
-    misclassification_error = (np.array(y_true) != np.array(y_adv)).mean()
-    nad = normalized_accuracy_drop(
-        wers=wers,
-        y_true=y_true,
-        y_adv=y_adv,
-        gamma=args.gamma
-    )
+            accumulator.update(
+                wers=[el["wer"] for el in batch],
+                y_true=y_true,
+                y_adv=adv_probs.argmax(axis=-1),
+                prob_diffs=probs[rows, y_true] - adv_probs[rows, y_true],
+                perp_true=orig_perplexities,
+                perp_adv=adv_perplexities
+            )
+            bar.update(len(batch))
 
-    if orig_perplexities is not None and adv_perplexities is not None:
-        nad_with_perp = normalized_accuracy_drop_with_perplexity(
-            wers=wers,
-            y_true=y_true,
-            y_adv=y_adv,
-            perp_true=orig_perplexities,
-            perp_adv=adv_perplexities,
-            gamma=args.gamma
-        )
-    else:
-        nad_with_perp = None
-
-    metrics = dict(
-        mean_prob_diff=float(np.mean(prob_diffs)),
-        mean_wer=float(np.mean(wers)),
-        mean_perplexity_rise=mean_perplexity_rise
-    )
-    metrics[f"NAD_{args.gamma}"] = nad
-    metrics["misclassification_error"] = misclassification_error
-    metrics[f"NAD_with_perplexity_{args.gamma}"] = nad_with_perp
+    metrics = accumulator.get_metrics()
     metrics["path_to_classifier"] = str(classifier_dir.absolute())
     if args.lm_dir is not None:
         metrics["path_to_lm"] = str(Path(args.lm_dir).absolute())
@@ -9,6 +9,7 @@ from allennlp.predictors import Predictor
 from allennlp.common.util import dump_metrics
 
 from adat.utils import load_jsonlines, calculate_wer
+from adat.attack_cache import AttackCache, attack_key, file_digest
 from adat.attackers import HotFlipFixed, AttackerOutput
 
 parser = argparse.ArgumentParser()
@@ -17,11 +18,18 @@ parser.add_argument("--test-path", type=str, required=True)
 parser.add_argument("--out-dir", type=str, required=True)
 
 parser.add_argument("--max-tokens", type=int, default=None)
+# batched mode: the best of `num_candidates` flips at each of `num_positions` positions is kept at every step
+parser.add_argument("--num-positions", type=int, default=1)
+parser.add_argument("--num-candidates", type=int, default=1)
 
 parser.add_argument("--sample-size", type=int, default=None)
+parser.add_argument("--batch-size", type=int, default=1)
 parser.add_argument("--not-date-dir", action="store_true")
 parser.add_argument("--force", action="store_true")
 parser.add_argument("--cuda", type=int, default=-1)
+# results of already attacked sequences are reused
+parser.add_argument("--cache-path", type=str, default=None)
+parser.add_argument("--cache-max-size-mb", type=float, default=1024.0)
 
 
 if __name__ == "__main__":
@@ -38,7 +46,7 @@ if __name__ == "__main__":
 
     dump_metrics(args_path, args.__dict__)
 
-    data = load_jsonlines(args.test_path)[:args.sample_size]
+    data = load_jsonlines(args.test_path, limit=args.sample_size)
     predictor = Predictor.from_path(
         Path(args.classifier_dir) / "model.tar.gz",
         predictor_name="text_classifier",
@@ -48,37 +56,85 @@ if __name__ == "__main__":
 
     attacker = HotFlipFixed(
         predictor=predictor,
-        max_tokens=args.max_tokens or predictor._model.vocab.get_vocab_size("tokens")
+        max_tokens=args.max_tokens or predictor._model.vocab.get_vocab_size("tokens"),
+        num_positions=args.num_positions,
+        num_candidates=args.num_candidates
     )
 
+    cache = None
+    if args.cache_path is not None:
+        cache = AttackCache(args.cache_path, max_size=int(args.cache_max_size_mb * 2 ** 20))
+        archive_digests = [file_digest(Path(args.classifier_dir) / "model.tar.gz")]
+        cache_config = {
+            "max_tokens": args.max_tokens,
+            "num_positions": args.num_positions,
+            "num_candidates": args.num_candidates
+        }
+
+    def get_target(el):
+        # if it works then it's not stupid
+        probs = np.ones(predictor._model._num_labels)
+        probs[int(el["label"])] = 0
+        return {"probs": probs}
+
+    def to_result(el, p, out):
+        attacked_label = int(el["label"])
+        adversarial_sequence = " ".join(out["final"][0])
+        adversarial_probability = out["outputs"]["probs"]
+        if len(adversarial_probability) == 1 and isinstance(adversarial_probability[0], list):
+            adversarial_probabilities = adversarial_probability[0]
+        else:
+            adversarial_probabilities = adversarial_probability
+
+        adversarial_probability = adversarial_probabilities[attacked_label]
+        adversarial_label = int(np.argmax(adversarial_probabilities))
+
+        adversarial_output = AttackerOutput(
+            sequence=el["text"],
+            probability=p["probs"][attacked_label],
+            adversarial_sequence=adversarial_sequence,
+            adversarial_probability=adversarial_probability,
+            wer=calculate_wer(el["text"], adversarial_sequence),
+            prob_diff=(p["probs"][attacked_label] - adversarial_probability),
+            attacked_label=attacked_label,
+            adversarial_label=adversarial_label
+        )
+        return adversarial_output.__dict__
+
     print(f"Saving results to {results_path}")
-    with jsonlines.open(results_path, "w") as writer:
-        for el, p in tqdm(zip(data, preds)):
-
-            # if it works then it's not stupid
-            attacked_label = int(el["label"])
-            probs = np.ones(predictor._model._num_labels)
-            probs[attacked_label] = 0
-            out = attacker.attack_from_json({"sentence": el["text"].strip()}, target={"probs": probs})
-            adversarial_sequence = " ".join(out["final"][0])
-            adversarial_probability = out["outputs"]["probs"]
-            if len(adversarial_probability) == 1 and isinstance(adversarial_probability[0], list):
-                adversarial_probabilities = adversarial_probability[0]
-            else:
-                adversarial_probabilities = adversarial_probability
-
-            adversarial_probability = adversarial_probabilities[attacked_label]
-            adversarial_label = int(np.argmax(adversarial_probabilities))
-
-            adversarial_output = AttackerOutput(
-                sequence=el["text"],
-                probability=p["probs"][attacked_label],
-                adversarial_sequence=adversarial_sequence,
-                adversarial_probability=adversarial_probability,
-                wer=calculate_wer(el["text"], adversarial_sequence),
-                prob_diff=(p["probs"][attacked_label] - adversarial_probability),
-                attacked_label=attacked_label,
-                adversarial_label=adversarial_label
-            )
-
-            writer.write(adversarial_output.__dict__)
+    with jsonlines.open(results_path, "w") as writer, tqdm(total=len(data)) as bar:
+        for i in range(0, len(data), args.batch_size):
+            batch = data[i:i + args.batch_size]
+            batch_preds = preds[i:i + args.batch_size]
+
+            results = [None] * len(batch)
+            if cache is not None:
+                keys = [attack_key(el["text"], el["label"], "hotflip", cache_config, archive_digests) for el in batch]
+                results = [cache.get(key) for key in keys]
+            missing = [j for j, result in enumerate(results) if result is None]
+            finished = iter([])
+            if missing:
+                finished = attacker.attack_batch_from_json(
+                    [{"sentence": batch[j]["text"].strip()} for j in missing],
+                    targets=[get_target(batch[j]) for j in missing]
+                )
+
+            num_written = 0
+            while True:
+                # results are written in the original order as soon as all previous ones are finished
+                while num_written < len(batch) and results[num_written] is not None:
+                    writer.write(results[num_written])
+                    num_written += 1
+                    bar.update(1)
+
+                k, out = next(finished, (None, None))
+                if k is None:
+                    break
+                j = missing[k]
+                results[j] = to_result(batch[j], batch_preds[j], out)
+                if cache is not None:
+                    cache.put(keys[j], results[j])
+
+    if cache is not None:
+        print(f"Cache stats: {cache.stats()}")
+        cache.close()
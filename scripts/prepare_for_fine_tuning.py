@@ -2,6 +2,7 @@ import argparse
 from pathlib import Path
 import jsonlines
 
+from adat.jsonl import read_jsonlines
 from adat.utils import load_jsonlines
 
 parser = argparse.ArgumentParser()
@@ -15,7 +16,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
     adversarial_dir = Path(args.adversarial_dir)
 
-    data = load_jsonlines(adversarial_dir / "attacked_data.json")[:args.num_examples]
+    data = load_jsonlines(adversarial_dir / "attacked_data.json", limit=args.num_examples)
 
     postfix = args.num_examples or "all"
 
@@ -28,6 +29,5 @@ if __name__ == "__main__":
             writer.write({"text": ex["adversarial_sequence"], "label": ex["attacked_label"]})
 
         if args.mix_with_path is not None:
-            data_to_mix_with = load_jsonlines(args.mix_with_path)
-            for ex in data_to_mix_with:
+            for ex in read_jsonlines(args.mix_with_path):
                 writer.write(ex)